@@ -1,32 +1,44 @@
 # app.py
 # This is the main app of FlaskPress Alpha
+import argparse
 import datetime
-from flask import (abort, flash, Flask, g, redirect,
-                   render_template, request, send_from_directory, session, url_for)
-
-from flask_ckeditor import CKEditor
-from flask_dropzone import Dropzone
+import time
+from flask import (abort, before_render_template, current_app, flash, Flask, g, jsonify, redirect,
+                   render_template, request, session, template_rendered, url_for)
+from werkzeug.local import LocalProxy
 
 from forms import UsernamePasswordForm, LoginForm, RegisterForm, HTMLPageForm, PageForm, CSRF
+from indexes import IndexedDatabase, DuplicateKeyError
+from storage import open_database
+from coherence import shared_state_for
 from initialize import initialize
+from pagecache import PageCache, cached_page_response, make_cached_page
+from search import SearchIndex
+from routing import HOME_SLUG, SlugTrie
+from navigation import NavigationModel
+from metrics import Metrics, TimedDatabase, current_timer, scrape_allowed
+from sitemeta import LazyGlobals, MetaCache, refresh_site_globals
+from uploads import UploadManager, UploadError
+from blobs import BLOB_DIR, SHA256_RE, BlobStore, parse_blob_path
+from images import DERIVED_DIR, FORMATS, IMAGE_TYPES, DerivativeStore, image_size
+from serving import configure_access_log, send_upload
+from compression import ResponseCompressor
+from assets import AssetManifest, build_assets, send_asset
+from tasks import TaskQueue
+from markup import ContentRenderer, page_html
+from shortcodes import ShortcodeEngine
+from themes import PAGE_TEMPLATE, PAGE_TEMPLATE_NAMES, PAGE_TEMPLATES, ThemeRegistry, bytecode_cache
 
 import os
 
-from tinymongo import TinyMongoClient, Query, where
-
-from users import generate_password_hash
+from users import PASSWORD_METHOD
+from auth import AuthService, Throttled
 
 from utils import (slugify, login_required, form2object, object2form,
                    admin_required, token_generator, snippet)
 
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 
-app = Flask(__name__)
-app.config.from_pyfile('app.cfg')
-DB = TinyMongoClient().flaskpress
-
-
 ############### BLOG 2 META DEFAULTS #############
 # once running, you can override these defaults
 default_brand = "FlaskBlog"
@@ -51,57 +63,271 @@ We look forward to community involvement to add more to the project.
 """
 
 ###############
-app = Flask(__name__)
-app.secret_key = '&#*OnNyywiy1$#@'
-app.config.from_pyfile('app.cfg')
 HOST = '0.0.0.0'
 PORT = 5000
 DEBUG = False
 
-### DATABASE
-DB = TinyMongoClient().blog
-initialize(DB)
-
-### FILE UPLOADS PARAMETERS
-dropzone = Dropzone()
-dropzone.init_app(app)
-# UPLOAD FOLDER will have to change based on your own needs/deployment scenario
+# UPLOAD FOLDER will have to change based on your own needs/deployment scenario (UPLOAD_FOLDER in app.cfg)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-UPLOAD_FOLDER = os.path.join(BASE_DIR, './uploads')
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 ALLOWED_EXTENSIONS = set(['txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'])
+# room for the multipart headers and form fields around an uploaded file
+UPLOAD_FORM_SLACK = 64 * 1024
+SEARCH_RESULTS_PER_PAGE = 20
+
+### APP FACTORY
+# Importing this module does nothing but define things.  create_app() builds an
+# app with its own database, caches and pools (a SiteState, kept in
+# app.extensions['fpress']) and adds the views collected by @route.  Seeding
+# an empty site (admin user, home and about pages) is an explicit command:
+#   flask --app app seed    or    python app.py seed
+# `app` can still be imported (gunicorn app:app), it is created on first use.
+
+# (rule, view function, options) of every view, see route()
+VIEWS = []
+
+def route(rule, **options):
+    """app.route for the apps made by create_app()"""
+    def decorator(f):
+        VIEWS.append((rule, f, options))
+        return f
+    return decorator
+
+
+class SiteState(object):
+    """database, caches and worker pools of one app"""
+    def __init__(self, config):
+        ### DATABASE
+        # the backend (tinymongo or sqlite) is chosen in app.cfg, see storage.py
+        # collections are wrapped with in-memory hash indexes (slug, username, owner), see indexes.py
+        # with MULTIPROCESS = True writes are locked across worker processes, see coherence.py
+        self.db = IndexedDatabase(open_database(config), shared=shared_state_for(config))
+        # request timing, Server-Timing header and /metrics, see metrics.py
+        self.metrics = Metrics() if config.get('METRICS_ENABLED', True) else None
+        if self.metrics is not None:
+            self.db = TimedDatabase(self.db, self.metrics)
+            self.metrics.add_collector(self.collect_metrics)
+        # password hashing in a bounded pool and login throttling, see auth.py
+        self.auth = AuthService(method=config.get('PASSWORD_HASH_METHOD', PASSWORD_METHOD),
+                                workers=config.get('AUTH_WORKERS', 2),
+                                queue_limit=config.get('AUTH_QUEUE_LIMIT', 16),
+                                attempts_per_minute=config.get('LOGIN_ATTEMPTS_PER_MINUTE', 10),
+                                burst=config.get('LOGIN_ATTEMPTS_BURST', 5))
+        self.page_cache_size = config.get('PAGE_CACHE_SIZE', 1024)
+        self.shortcode_cache_size = config.get('SHORTCODE_CACHE_SIZE', 1024)
+        self.reset_caches()
+
+        ### FILE UPLOADS
+        upload_folder = config['UPLOAD_FOLDER']
+        # partial (chunked) uploads are kept here until complete, see uploads.py
+        self.uploads = UploadManager(config.get('UPLOAD_TMP_FOLDER') or os.path.join(upload_folder, '.partial'),
+                                     max_file_size=config.get('MAX_UPLOAD_SIZE', 0))
+        # completed uploads are stored once per content, see blobs.py
+        self.blobs = BlobStore(os.path.join(upload_folder, BLOB_DIR), self.db)
+        # resized variants of uploaded images, see images.py
+        self.images = DerivativeStore(os.path.join(upload_folder, DERIVED_DIR),
+                                      widths=config.get('IMAGE_WIDTHS', (320, 640, 1280)),
+                                      fmt=config.get('IMAGE_FORMAT', 'webp'),
+                                      quality=config.get('IMAGE_QUALITY', 80),
+                                      max_bytes=config.get('IMAGE_CACHE_BYTES', 512 * 1024 * 1024),
+                                      workers=config.get('IMAGE_WORKERS', 2))
+        # gzip/brotli for dynamic responses, see compression.py
+        self.compressor = None
+        if config.get('COMPRESS_ENABLED', True):
+            self.compressor = ResponseCompressor(min_size=config.get('COMPRESS_MIN_SIZE', 500),
+                                                 gzip_level=config.get('COMPRESS_GZIP_LEVEL', 6),
+                                                 brotli_quality=config.get('COMPRESS_BROTLI_QUALITY', 5))
+        # fingerprinted static files (set by create_app), see assets.py
+        self.assets = None
+        # theme template lookup, see themes.py
+        self.themes = None
+        # work that follows a save, run after the response (set by create_app), see tasks.py
+        self.tasks = None
+        # Markdown rendering and HTML sanitizing at save, memoized by content hash, see markup.py
+        self.renderer = ContentRenderer(max_entries=config.get('MARKDOWN_CACHE_SIZE', 256))
+        # seconds create_app() took, set when it is done
+        self.startup_seconds = None
+
+    def reset_caches(self):
+        """(re)create everything derived from the database, e.g. after seed() wrote to it"""
+        # full-text index behind /search, built on first search and kept current by page_edit/page_delete
+        self.search_index = SearchIndex()
+        # published pages by slug path, for breadcrumbs and section listings, see routing.py
+        self.slug_trie = SlugTrie()
+        # navigation menu (show_nav pages) and sidebar/footer fragments, see navigation.py
+        self.navigation = NavigationModel()
+        # rendered pages for site(), invalidated on page save/delete and meta changes
+        self.page_cache = PageCache(max_entries=self.page_cache_size)
+        # compiled shortcodes, their cached results and the pages depending on them, see shortcodes.py
+        self.shortcodes = ShortcodeEngine(max_results=self.shortcode_cache_size)
+        # the meta document (brand, theme...), see sitemeta.py
+        self.meta_cache = MetaCache()
+
+    def collect_metrics(self):
+        """startup time and page cache counters for /metrics (the hit rate is hits / (hits + misses))"""
+        cache = self.page_cache
+        return [('fpress_startup_seconds', 'gauge', "Time create_app() took", (), self.startup_seconds or 0),
+                ('fpress_page_cache_hits_total', 'counter', "Page cache hits", (), cache.hits),
+                ('fpress_page_cache_misses_total', 'counter', "Page cache misses", (), cache.misses),
+                ('fpress_page_cache_entries', 'gauge', "Pages in the page cache", (), len(cache)),
+                ('fpress_render_cache_hits_total', 'counter', "Content renders served from the render cache", (),
+                 self.renderer.hits),
+                ('fpress_render_cache_misses_total', 'counter', "Content renders done", (), self.renderer.misses),
+                ('fpress_shortcode_cache_hits_total', 'counter', "Shortcode results served from cache", (),
+                 self.shortcodes.hits),
+                ('fpress_shortcode_cache_misses_total', 'counter', "Shortcodes run", (), self.shortcodes.misses),
+                ('fpress_task_queue_depth', 'gauge', "Background tasks waiting", (), self.tasks.depth())] + \
+               [('fpress_tasks_total', 'counter', "Background tasks by outcome", (('outcome', outcome),), count)
+                for outcome, count in sorted(self.tasks.counts.items())]
+
+
+def site_state():
+    """the SiteState of the current app"""
+    return current_app.extensions['fpress']
+
+# the current app's state under the names the views use
+AUTH = LocalProxy(lambda: site_state().auth)
+SEARCH_INDEX = LocalProxy(lambda: site_state().search_index)
+SLUG_TRIE = LocalProxy(lambda: site_state().slug_trie)
+NAVIGATION = LocalProxy(lambda: site_state().navigation)
+PAGE_CACHE = LocalProxy(lambda: site_state().page_cache)
+UPLOADS = LocalProxy(lambda: site_state().uploads)
+BLOBS = LocalProxy(lambda: site_state().blobs)
+IMAGES = LocalProxy(lambda: site_state().images)
+TASKS = LocalProxy(lambda: site_state().tasks)
+SHORTCODES = LocalProxy(lambda: site_state().shortcodes)
+
+
+def create_app(config=None):
+    """build an app from app.cfg, the file named by FPRESS_SETTINGS (if set)
+    and config (a dict), in that order.  The database is not seeded, see seed()
+    """
+    started = time.perf_counter()
+    app = Flask(__name__)
+    app.secret_key = '&#*OnNyywiy1$#@'
+    # theme, brand, stylesheet etc. on g are computed on first use, see sitemeta.py
+    app.app_ctx_globals_class = LazyGlobals
+    app.config.from_pyfile('app.cfg')
+    # a settings file overriding app.cfg, e.g. for a scratch site
+    app.config.from_envvar('FPRESS_SETTINGS', silent=True)
+    if config:
+        app.config.update(config)
+    if not app.config.get('UPLOAD_FOLDER'):
+        app.config['UPLOAD_FOLDER'] = os.path.join(BASE_DIR, './uploads')
+
+    state = app.extensions['fpress'] = SiteState(app.config)
+    if app.config.get('TEMPLATE_BYTECODE_CACHE', True):
+        # compiled templates on disk, a restarted worker does not compile them again
+        app.jinja_env.bytecode_cache = bytecode_cache(app.config.get('TEMPLATE_CACHE_DIR')
+                                                      or os.path.join(BASE_DIR, '.template_cache'))
+    state.themes = ThemeRegistry(app.jinja_env)
+    state.assets = AssetManifest(app.static_folder)
+    # asset_url('css/bulma-minty.css') in templates, the fingerprinted file once built
+    app.add_template_global(state.assets.url, 'asset_url')
+    # page_html(page) in templates, the stored rendering of Markdown pages
+    app.add_template_global(page_html, 'page_html')
+    state.tasks = TaskQueue(app, workers=app.config.get('TASK_WORKERS', 2),
+                            max_attempts=app.config.get('TASK_MAX_ATTEMPTS', 5),
+                            retry_delay=app.config.get('TASK_RETRY_DELAY', 1.0),
+                            durable=app.config.get('TASKS_DURABLE', False))
+    state.tasks.register('index_page', index_page_task)
+    state.tasks.register('process_file', process_file_task)
+    for rule, view, options in VIEWS:
+        app.add_url_rule(rule, view.__name__, view, **options)
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.context_processor(navigation_context)
+    app.cli.command('seed')(seed_command)
+    app.cli.command('assets')(assets_command)
+    if state.metrics is not None:
+        before_render_template.connect(state.metrics.template_started, app)
+        template_rendered.connect(state.metrics.template_finished, app)
+    if app.config.get('DROPZONE_ENABLED'):
+        # flask-dropzone's assets, the upload page does not use them (static/js/upload.js)
+        from flask_dropzone import Dropzone
+        Dropzone(app)
+    if app.config.get('ACCESS_LOG'):
+        configure_access_log()
+    if app.config.get('TEMPLATE_PRECOMPILE'):
+        precompile_templates(app)
+
+    state.startup_seconds = time.perf_counter() - started
+    app.logger.info("app created in %.1f ms", state.startup_seconds * 1000)
+    return app
+
+def precompile_templates(app):
+    """compile every template now, so the first request of each does not pay for it"""
+    app.logger.info("%d templates compiled", app.extensions['fpress'].themes.precompile())
+
+def seed(app):
+    """create the admin user and the default home/about pages if they are missing"""
+    state = app.extensions['fpress']
+    initialize(state.db, hasher=state.auth.hash_password)
+    state.reset_caches()
+
+def seed_command():
+    """Create the admin user and the default pages of an empty site."""
+    seed(current_app)
+
+def assets_command():
+    """Build fingerprinted, precompressed copies of the static files."""
+    manifest = build_assets(current_app.static_folder)
+    site_state().assets.reload()
+    print("{} assets built".format(len(manifest)))
+
+# created by the first `from app import app` (or gunicorn app:app)
+_default_app = None
+
+def __getattr__(name):
+    global _default_app
+    if name != 'app':
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    if _default_app is None:
+        _default_app = create_app()
+        # the app a WSGI server serves, see TEMPLATE_PRECOMPILE
+        precompile_templates(_default_app)
+    return _default_app
 
 
-@app.before_request
 def before_request():
     """tasks before request is executed"""
-    g.db = DB
+    state = site_state()
+    g.db = state.db
+    if state.metrics is not None:
+        state.metrics.start_request()
     
     g.username = session.get('username')
     g.is_authenticated = session.get('is_authenticated')
     g.is_admin = session.get('is_admin')
-    g.macro_csrf_token = token_generator(size=24)
-    
-    meta = g.db.meta.find_one()
-    if meta:
-        g.theme = meta.get('theme','default')
-        g.brand = meta.get('brand', 'FlaskPress')
-        g.navbackground = meta.get('navbackground', False)
-        g.stylesheet = meta.get('stylesheet')
-    else:
-        g.theme = 'default'
-        g.brand = 'FlaskPress'
-        g.navbackground = False
-        
-    if g.stylesheet is None:
-        g.stylesheet = "https://cdnjs.cloudflare.com/ajax/libs/bulma/0.8.0/css/bulma.min.css"
+    # g.theme, g.brand, g.stylesheet, g.navbackground and g.macro_csrf_token
+    # are filled in lazily from the cached meta document (sitemeta.LazyGlobals)
+
+def navigation_context():
+    """nav_menu and nav_fragment(slug) for the templates, see navigation.py"""
+    db = getattr(g, 'db', None) or site_state().db
+    NAVIGATION.ensure(db, db.pages.epoch())
+    return {'nav_menu': NAVIGATION.menu, 'nav_fragment': lambda slug: NAVIGATION.fragment(db, slug)}
 
-@app.after_request
 def after_request(response):
     """tasks after request is executed"""
+    state = site_state()
+    if state.compressor is not None:
+        response = state.compressor(response, request)
+    metrics = state.metrics
+    if metrics is not None:
+        response = metrics.finish_request(response)
     return response
 
-@app.route('/login', methods=['GET','POST'])
+@route('/metrics')
+def metrics():
+    """Prometheus metrics of this worker process, for admins and scrapers, see metrics.scrape_allowed"""
+    metrics = site_state().metrics
+    if metrics is None:
+        abort(404)
+    if not (g.is_admin or scrape_allowed(request, current_app.config)):
+        abort(403)
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@route('/login', methods=['GET','POST'])
 def login():
     """handle basic login"""
     if g.is_authenticated:
@@ -112,35 +338,45 @@ def login():
     if form.validate_on_submit():
         # see if user exists
         user = g.db.users.find_one({'username':form.username.data})
-        if user:
-            if check_password_hash(user.get('password'), form.password.data):
-                # inject session data
-                session['username'] = form.username.data
-                session['is_authenticated'] = True
-                if user.get('is_admin'):
-                    session['is_admin'] = True
-
-                msg = "Welcome {}!".format(form.username.data)
-                flash(msg, category="success")
-                return redirect(url_for('site'))
+        try:
+            # unknown users are checked too, a failure takes as long either way
+            ok, new_hash = AUTH.authenticate(user.get('password') if user else None, form.password.data,
+                                             username=form.username.data, address=request.remote_addr)
+        except Throttled as e:
+            flash("Too many login attempts, please try again in {} seconds".format(e.retry_after), category="danger")
+            return render_template('login.html', form=form), 429, {'Retry-After': str(e.retry_after)}
+        if user and ok:
+            if new_hash:
+                # stored hash used older parameters, upgrade it while we know the password
+                g.db.users.update_one({'_id': user['_id']}, {'$set': {'password': new_hash}})
+            # inject session data
+            session['username'] = form.username.data
+            session['is_authenticated'] = True
+            if user.get('is_admin'):
+                session['is_admin'] = True
+
+            msg = "Welcome {}!".format(form.username.data)
+            flash(msg, category="success")
+            return redirect(url_for('site'))
 
         flash("Incorrect username or password",category="danger")
 
     return render_template('login.html', form=form)
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     session.clear()
     flash("You are now logged out!",category="info")
     return redirect(url_for('site'))
 
 
-@app.route('/admin', methods=('GET','POST'), strict_slashes=False)
+@route('/admin', methods=('GET','POST'), strict_slashes=False)
 @admin_required
 def admin():
-    meta = g.db.meta.find_one()
-    
     """view for basic admin tasks"""
+    # copy, the cached snapshot is shared between requests
+    meta = dict(g.meta)
+    
     form = CSRF()
     if form.validate_on_submit():
         # get data from the form
@@ -151,24 +387,46 @@ def admin():
         meta['brand'] = brand
         meta['stylesheet'] = stylesheet
         g.db.meta.update_one({'_id':meta.get('_id')}, meta)
+        site_state().meta_cache.invalidate()
+        refresh_site_globals()
+        # brand, stylesheet... are part of every rendered page
+        PAGE_CACHE.clear()
     
     return render_template('admin.html', form=form)
 
-@app.route('/admin/users', methods=('GET','POST'))
+def admin_listing(collection, columns, fields):
+    """one page of an admin listing, sorted by the sort/order request args
+    and continued from the after cursor, see IndexedCollection.find_page
+    """
+    sort = request.args.get('sort')
+    if sort not in columns:
+        sort = columns[0]
+    order = 'desc' if request.args.get('order') == 'desc' else 'asc'
+    after = request.args.get('after') or None
+    try:
+        items, next_cursor = collection.find_page(sort=sort, descending=(order == 'desc'), after=after,
+                                                  limit=current_app.config.get('ADMIN_PAGE_SIZE', 50), fields=fields)
+    except ValueError:
+        abort(400)
+    return {'items': items, 'sort': sort, 'order': order, 'after': after, 'next': next_cursor,
+            'endpoint': request.endpoint}
+
+@route('/admin/users', methods=('GET','POST'))
 @admin_required
 def admin_users():
     """view for administering users"""
-    users = g.db.users.find()
-    return render_template('users.html', users=users)
+    listing = admin_listing(g.db.users, ('username', 'displayname', 'is_admin', 'is_active'),
+                            fields=('username', 'displayname', 'is_admin', 'is_active'))
+    return render_template('users.html', listing=listing)
 
-@app.route('/admin/user/add', strict_slashes=False)
+@route('/admin/user/add', strict_slashes=False)
 @admin_required
 def user_add():
     """ADMIN-ONLY view to add a user"""
     return redirect(url_for('user_edit'))
 
-@app.route('/admin/user', methods=('GET','POST'), strict_slashes=False)
-@app.route('/admin/user/<user_id>', methods=('GET','POST'))
+@route('/admin/user', methods=('GET','POST'), strict_slashes=False)
+@route('/admin/user/<user_id>', methods=('GET','POST'))
 @admin_required
 def user_edit(user_id=None):
     """ADMIN-ONLY view to edit a user or create a user if no user_id supplied"""
@@ -195,26 +453,29 @@ def user_edit(user_id=None):
             
             if user.get('password') != password:
                 # password changed, rehash the password
-                user['password'] = generate_password_hash(password)
+                user['password'] = AUTH.hash_password(password)
             
             user['email'] = email
             user['is_active'] = is_active
             user['is_admin'] = is_admin
         
-            if user_id:
-                g.db.users.update_one({'_id':user_id}, user)
-                flash("User information changed", category="success")
-            else:
-                g.db.users.insert_one(user)
-                flash("New user created", category="success")
-            return redirect(url_for('admin_users'))
+            try:
+                if user_id:
+                    g.db.users.update_one({'_id':user_id}, user)
+                    flash("User information changed", category="success")
+                else:
+                    g.db.users.insert_one(user)
+                    flash("New user created", category="success")
+                return redirect(url_for('admin_users'))
+            except DuplicateKeyError:
+                flash('Username "{}" is already taken'.format(username), category="danger")
         else:
             flash('Username and password must be filled in', category="danger")
     
     return render_template('user.html', user=user, form=form)
 
-@app.route('/user_delete/<user_id>')
-@app.route('/user_delete/<user_id>/<hard_delete>')
+@route('/user_delete/<user_id>')
+@route('/user_delete/<user_id>/<hard_delete>')
 @admin_required
 def user_delete(user_id, hard_delete=False):
     """delete a user. A soft delete only sets the is_active to false
@@ -229,14 +490,17 @@ def user_delete(user_id, hard_delete=False):
     
     if user['username'] != session.get('username'):
         if hard_delete:
-            # reassign all pages to admin who is deleting
-            pages = g.db.pages.find({'owner':user['username']})
-            for page in pages:
-                page['owner'] = session.get('username')
-                g.db.pages.update_one({'_id':page['_id']}, page)
+            # reassign all pages and files to admin who is deleting, one bulk write each
+            new_owner = {'$set': {'owner': session.get('username')}}
+            pages = g.db.pages.update_many({'owner':user['username']}, new_owner)
+            files = g.db.files.update_many({'owner':user['username']}, new_owner)
+            if pages.matched_count:
+                # owner is part of the rendered pages (edit links)
+                PAGE_CACHE.clear()
             
             g.db.users.remove(user_key)
-            flash("User fully deleted, {} pages reassigned to {}.".format(len(pages), g.username), category="primary")
+            flash("User fully deleted, {} pages and {} files reassigned to {}.".format(
+                pages.matched_count, files.matched_count, g.username), category="primary")
         else:
             user['is_active'] = False
             g.db.users.update_one(user_key, user)
@@ -250,18 +514,19 @@ def user_delete(user_id, hard_delete=False):
     else:
         return redirect(request.referrer)  
 
-@app.route('/admin/pages', methods=('GET','POST'))
+@route('/admin/pages', methods=('GET','POST'))
 @admin_required
 def admin_pages():
     """ADMIN-ONLY view to look at all pages.
     TODO: change view to support non-admin users
     """
-    # find all pages
-    pages = g.db.pages.find()
-    return render_template('admin_pages.html', pages=pages)
+    # one page of pages, without their content
+    listing = admin_listing(g.db.pages, ('title', 'owner', 'slug', 'modified_at'),
+                            fields=('title', 'owner', 'slug', 'created_at', 'modified_at'))
+    return render_template('admin_pages.html', listing=listing)
 
 
-@app.route('/file_delete/<file_id>')
+@route('/file_delete/<file_id>')
 @login_required
 def file_delete(file_id):
     """view to delete an existing file object and physical file (owned by user)"""
@@ -271,11 +536,15 @@ def file_delete(file_id):
         flash("Unable to locate file id={}".format(file_id), category="danger")
         return redirect(url_for('admin_files'))
     
-    pathname = os.path.join(app.config['UPLOAD_FOLDER'], f.get('filepath'))
     if f.get('owner') == session['username'] or session['is_admin']:
         g.db.files.remove(file_key)
+        files_changed()
         try:
-            os.remove(pathname)
+            if f.get('blob'):
+                # other file objects may share the blob, it goes with the last one
+                BLOBS.release(f['blob'])
+            else:
+                os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], f.get('filepath')))
             flash('File Successfully Deleted', category="success")
         except:
             flash("Error: problems removing physical file. Check log for details.", category="warning")
@@ -288,7 +557,7 @@ def file_delete(file_id):
     else:
         return redirect(url_for('admin_files'))  
 
-@app.route('/file_edit/<file_id>', methods=['GET','POST'])
+@route('/file_edit/<file_id>', methods=['GET','POST'])
 @admin_required
 def file_edit(file_id):
     """view to allow edit/delete of a File resource"""
@@ -303,6 +572,7 @@ def file_edit(file_id):
             if title:
                 file['title'] = title
                 g.db.files.update_one(file_key, file)
+                files_changed()
                 flash("File information changed", category="success")
                 return redirect(url_for('admin_files'))
             else:
@@ -313,78 +583,157 @@ def file_edit(file_id):
     return render_template('file_edit.html',file=file)
     
   
-@app.route('/admin/files')
+@route('/admin/files')
 @admin_required
 def admin_files():
     """ADMIN-ONLY view for all File resources
     TODO: change this view to support non-admin users
     """
-    files = g.db.files.find()
-    return render_template('admin_files.html', files=files)
+    listing = admin_listing(g.db.files, ('title', 'owner', 'size', 'created_at'),
+                            fields=('title', 'owner', 'url', 'size', 'created_at'))
+    return render_template('admin_files.html', listing=listing)
+
+@route('/admin/tasks')
+@admin_required
+def admin_tasks():
+    """ADMIN-ONLY view of the background task queue: depth, totals and recent failures"""
+    stats = TASKS.stats()
+    failed = []
+    if stats['durable']:
+        # failures of every process (and earlier runs) are kept in the tasks collection
+        failed = [t for t in g.db.tasks.find({'status': 'failed'})]
+    return render_template('admin_tasks.html', stats=stats, failures=list(TASKS.failures), failed=failed)
+
+def upload_serving_options():
+    """send_upload() options from the config"""
+    return {'offload': current_app.config.get('UPLOAD_OFFLOAD'),
+            'offload_prefix': current_app.config.get('UPLOAD_OFFLOAD_PREFIX', '/_uploads/')}
+
+def remaining_upload_quota(username):
+    """bytes the user may still upload, None if there is no quota"""
+    quota = current_app.config.get('USER_UPLOAD_QUOTA', 0)
+    if not quota:
+        return None
+    used = sum(f.get('size', 0) for f in g.db.files.find({'owner': username}))
+    return max(quota - used, 0)
+
+def store_upload(completed):
+    """store a completed upload as a blob and create its file object.
+    The file is served as /uploads/blob/<sha256>/<filename>, identical content
+    uploaded again shares the stored blob, and names never collide.
+    """
+    filename = secure_filename(completed.filename)
+    BLOBS.add(completed.path, completed.sha256, completed.size, completed.content_type)
+
+    local_filepath = BLOBS.filepath(completed.sha256, filename)
+    url = url_for('file_uploads', path=local_filepath)
+    file_object = {'title': filename, 'filepath': local_filepath, 'owner': g.username, 'url':url,
+                   'size': completed.size, 'sha256': completed.sha256, 'content_type': completed.content_type,
+                   'blob': completed.sha256, 'created_at': str(datetime.datetime.now())}
+    g.db.files.insert_one(file_object)
+    if completed.content_type in IMAGE_TYPES:
+        # image size and resized variants are worked out after the response
+        TASKS.enqueue('process_file', file_object['_id'])
+    files_changed()
+    return file_object
+
+def process_file_task(file_id):
+    """task: record the size of an uploaded image and render its variants"""
+    state = site_state()
+    f = state.db.files.find_one({'_id': file_id})
+    if f is None or not f.get('blob') or f.get('content_type') not in IMAGE_TYPES:
+        return
+    path = state.blobs.path(f['blob'])
+    if not f.get('width'):
+        size = image_size(path)
+        if size is None:
+            return
+        f['width'], f['height'] = size
+        state.db.files.update_one({'_id': file_id}, {'$set': {'width': f['width'], 'height': f['height']}})
+    # thumbnails and responsive widths are rendered in the image process pool
+    state.images.schedule(path, f['blob'], f['width'])
 
-@app.route('/_upload', methods=['GET', 'POST'])
+@route('/_upload', methods=['GET', 'POST'])
 @login_required
 def file_upload_handler():
-    """File upload handling"""
+    """File upload handling.
+    A POST carries either a whole file or, with the Dropzone chunking fields
+    (dzuuid, dzchunkbyteoffset, dztotalfilesize), one chunk of a resumable upload.
+    Chunk requests are answered with JSON, see uploads.py and static/js/upload.js
+    """
     if request.method == 'POST':
+        max_size = current_app.config.get('MAX_UPLOAD_SIZE', 0)
+        chunk_size = current_app.config.get('UPLOAD_CHUNK_SIZE', 0)
+        length = request.content_length or 0
+        # refuse oversized requests before reading the body (MAX_UPLOAD_SIZE = 0 is no limit)
+        if max_size and length > max(max_size, chunk_size) + UPLOAD_FORM_SLACK:
+            return jsonify({'message': 'Request too large'}), 413
+        upload_id = request.form.get('dzuuid')
+        # a chunk is never larger than UPLOAD_CHUNK_SIZE, whole files only have MAX_UPLOAD_SIZE
+        if upload_id and chunk_size and length > chunk_size + UPLOAD_FORM_SLACK:
+            return jsonify({'message': 'Request too large'}), 413
         # check if the post request has the file part
         if 'file' not in request.files:
+            if upload_id:
+                return jsonify({'message': 'No file part'}), 400
             flash('No file part')
             return redirect(request.url)
         file = request.files['file']
         # if user does not select file, browser also
         # submit a empty part without filename
-        if file.filename == '':
+        if file.filename == '' or not allowed_file(file.filename):
+            if upload_id:
+                return jsonify({'message': 'File type not allowed'}), 400
             flash('No selected file')
             return redirect(request.url)
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            subfolder = datetime.datetime.strftime(datetime.datetime.now(), "%Y%m/")
-            pathname = os.path.join(app.config['UPLOAD_FOLDER'], subfolder, filename)
-
-            # handle name collision if needed
-            # filename will add integers at beginning of filename in dotted fashion
-            # hello.jpg => 1.hello.jpg => 2.hello.jpg => ...
-            # until it finds an unused name
-            i=1
-            while os.path.isfile(pathname):
-                parts = filename.split('.')
-                parts.insert(0,str(i))
-                filename = '.'.join(parts)
-                i += 1
-                if i > 100:
-                    # probably under attack, so just fail
-                    raise ValueError("too many filename collisions, administrator should check this out")
-
-                pathname = os.path.join(app.config['UPLOAD_FOLDER'], subfolder, filename)
 
+        if upload_id:
+            # one chunk of a resumable upload
+            try:
+                offset = int(request.form.get('dzchunkbyteoffset', 0))
+                total_size = int(request.form['dztotalfilesize'])
+            except (KeyError, ValueError):
+                return jsonify({'message': 'Bad chunk parameters'}), 400
+            # the quota is summed up for the first chunk only, the upload manager keeps it
+            quota = remaining_upload_quota(g.username) if offset == 0 else None
             try:
-                # ensure directory where we are storing exists, and create it
-                directory = os.path.join(app.config['UPLOAD_FOLDER'], subfolder)
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-                # finally, save the file AND create its resource object in database
-                file.save(pathname)
-                
-                # put our file reference into the database
-                local_filepath = os.path.join(subfolder, filename)
-                url = url_for('file_uploads', path=local_filepath)
-                file_object = {'title': filename, 'filepath': local_filepath, 'owner': g.username, 'url':url}
-                g.db.files.insert(file_object)
-                # check if we can find the object
-                file_object = g.db.files.find_one(file_object)
-                flash("File upload success")
-                return redirect(url_for('file_edit', file_id=file_object['_id']))
-            except Exception as e:
-                print(e)
-                flash("Something went wrong here-- please let administrator know", category="danger")
-                raise ValueError("Something went wrong with file upload.")
+                received, completed = UPLOADS.receive(g.username, upload_id, file.filename, file.stream,
+                                                      offset=offset, total_size=total_size,
+                                                      remaining_quota=quota)
+            except UploadError as e:
+                return jsonify({'message': e.message, 'received': e.received}), e.status
+            if completed is None:
+                return jsonify({'received': received, 'complete': False})
+            file_object = store_upload(completed)
+            return jsonify({'received': received, 'complete': True, 'message': 'File upload success',
+                            'file_id': file_object['_id'], 'url': file_object['url']})
+
+        # the whole file in one request, still streamed through the upload manager
+        try:
+            received, completed = UPLOADS.receive(g.username, token_generator(size=24), file.filename,
+                                                  file.stream, remaining_quota=remaining_upload_quota(g.username))
+        except UploadError as e:
+            flash(e.message, category="danger")
+            return redirect(url_for('admin_files'))
+        file_object = store_upload(completed)
+        flash("File upload success")
+        return redirect(url_for('file_edit', file_id=file_object['_id']))
 
     # TODO, replace with fancier upload drag+drop
     # session['no_csrf'] = True
     return redirect(url_for('admin_files'))
 
-@app.route('/admin/firstuse', methods=('GET', 'POST'))
+@route('/_upload/status')
+@login_required
+def file_upload_status():
+    """bytes already received for a resumable upload (?dzuuid=...)"""
+    try:
+        received = UPLOADS.status(g.username, request.args.get('dzuuid'))
+    except UploadError as e:
+        return jsonify({'message': e.message}), e.status
+    return jsonify({'received': received})
+
+@route('/admin/firstuse', methods=('GET', 'POST'))
 def admin_first_use():
     """view for first-use.  This view is triggered by EMPTY User table"""
     # this route should only work on empty user table
@@ -415,20 +764,121 @@ def admin_first_use():
     
     return render_template('first_use.html')
 
+def index_page_task(page_id):
+    """task: store the snippet of a saved page and (re-)index it for search"""
+    state = site_state()
+    page = state.db.pages.find_one({'_id': page_id})
+    if page is None:
+        state.search_index.remove(page_id)
+        return
+    text = snippet(page_html(page))
+    if page.get('snippet') != text:
+        state.db.pages.update_one({'_id': page_id}, {'$set': {'snippet': text}})
+        page['snippet'] = text
+    state.search_index.add(page)
+
+def page_saved(page, old_slug=None):
+    """keep the slug trie and page cache current after a page is stored,
+    snippet and search index follow in the background (index_page_task)
+    """
+    TASKS.enqueue('index_page', page['_id'])
+    SLUG_TRIE.ensure(g.db, g.db.pages.epoch())
+    # pages showing this one in their breadcrumbs or child list, before and after
+    stale = set(SLUG_TRIE.related(old_slug)) if old_slug else set()
+    SLUG_TRIE.add(page)
+    stale.update(SLUG_TRIE.related(page.get('slug')))
+    stale.update([old_slug, page.get('slug')])
+    # pages showing this one as a sidebar or footer
+    NAVIGATION.ensure(g.db, g.db.pages.epoch())
+    menu_changed, referrers = NAVIGATION.page_saved(page, old_slug)
+    stale.update(referrers)
+    # pages embedding this one (or listing it) through shortcodes
+    SHORTCODES.ensure(g.db, shortcode_epoch())
+    stale.update(SHORTCODES.page_saved(page, old_slug))
+    if HOME_SLUG in stale or menu_changed:
+        # the home page heads every breadcrumb trail, the menu is on every page
+        PAGE_CACHE.clear()
+    for slug in stale:
+        if slug:
+            PAGE_CACHE.invalidate(slug)
+
+def page_removed(page):
+    """forget a deleted page in the search index, slug trie and page cache"""
+    SEARCH_INDEX.remove(page['_id'])
+    SLUG_TRIE.ensure(g.db, g.db.pages.epoch())
+    stale = SLUG_TRIE.related(page.get('slug'))
+    SLUG_TRIE.remove(page['_id'])
+    NAVIGATION.ensure(g.db, g.db.pages.epoch())
+    menu_changed, referrers = NAVIGATION.page_removed(page)
+    SHORTCODES.ensure(g.db, shortcode_epoch())
+    referrers.update(SHORTCODES.page_removed(page))
+    if menu_changed:
+        PAGE_CACHE.clear()
+    for slug in stale + list(referrers) + [page.get('slug')]:
+        PAGE_CACHE.invalidate(slug)
+
+def shortcode_epoch():
+    """what the shortcode results are computed from, changed by other processes"""
+    return (g.db.pages.epoch(), g.db.files.epoch())
+
+def files_changed():
+    """re-render the pages listing files after an upload, rename or delete"""
+    SHORTCODES.ensure(g.db, shortcode_epoch())
+    for slug in SHORTCODES.files_changed():
+        PAGE_CACHE.invalidate(slug)
+
 def allowed_file(filename):
     """return True if filename is allowed for upload, False if not allowed"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@app.route('/uploads/<path:path>')
+@route('/uploads/<path:path>')
 def file_uploads(path):
-    """serve up a file in our uploads"""
-    print("access path={}".format(path))
-    return send_from_directory(app.config['UPLOAD_FOLDER'], path)
+    """serve up a file in our uploads, see serving.py"""
+    options = upload_serving_options()
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    blob = parse_blob_path(path)
+    if blob is not None:
+        sha256, filename = blob
+        # the hash is the content, blob paths never change
+        return send_upload(upload_folder, os.path.join(BLOB_DIR, BLOBS.relpath(sha256)), served_path=path,
+                           sha256=sha256, immutable=True, **options)
+    # files uploaded before blob storage keep their YYYYMM/filename paths
+    return send_upload(upload_folder, path, max_age=current_app.config.get('UPLOAD_MAX_AGE', 3600), **options)
+
+@route('/static/dist/<path:filename>')
+def static_asset(filename):
+    """a fingerprinted static file, cached for a year, see assets.py"""
+    return send_asset(current_app.static_folder, filename)
+
+@route('/img/<sha256>/<int:width>.<fmt>')
+def image_derivative(sha256, width, fmt):
+    """an uploaded image resized to width.  serves the original image while
+    the variant renders in the background, or if none is needed
+    """
+    f = g.db.files.find_one({'sha256': sha256}) if SHA256_RE.match(sha256) else None
+    if f is None or f.get('content_type') not in IMAGE_TYPES or width not in IMAGES.widths or fmt not in FORMATS:
+        abort(404)
+    if f.get('blob'):
+        source = os.path.join(BLOB_DIR, BLOBS.relpath(sha256))
+    else:
+        source = f['filepath']
+    options = upload_serving_options()
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    derived = IMAGES.get(os.path.join(upload_folder, source), sha256, width, fmt, image_width=f.get('width'))
+    if derived is None:
+        # not cached while the variant renders, the next request gets it
+        max_age = 0 if IMAGES.pending(sha256, width, fmt) else current_app.config.get('UPLOAD_MAX_AGE', 3600)
+        return send_upload(upload_folder, source, served_path=request.path, sha256=sha256,
+                           mimetype=f['content_type'], max_age=max_age, **options)
+    # every rendering parameter is part of the derived path, so it never changes
+    return send_upload(upload_folder, os.path.join(DERIVED_DIR, derived), served_path=request.path,
+                       sha256='{}-{}'.format(sha256, os.path.basename(derived)), mimetype=FORMATS[fmt][1],
+                       immutable=True, **options)
 
 
-@app.route('/page/create', methods=['GET','POST'])
-@app.route('/page/edit/<id>', methods=['GET','POST'])
+@route('/page/create', methods=['GET','POST'])
+@route('/page/edit/<id>', methods=['GET','POST'])
 @login_required
 def page_edit(id=None):
     """edit or create a page"""
@@ -450,27 +900,38 @@ def page_edit(id=None):
         flash("You are not the page owner",category="danger")
         return redirect(url_for('site',path=page['slug']))    
 
+    old_slug = page.get('slug')
+
     # maybe modify this if a different theme is being used
     page_template = 'page_edit.html'
     form = CSRF() # brings in only the CSRF protection of WTForms
 
-    if form.validate_on_submit():
+    submitted = form.validate_on_submit()
+    template = request.form.get('template') or PAGE_TEMPLATE
+    if submitted and template not in PAGE_TEMPLATE_NAMES:
+        # only the offered templates, the other theme files are partials
+        flash('Unknown page template "{}"'.format(template), category="danger")
+        submitted = False
+
+    if submitted:
         # the only validation was that the CSRF token was good
         page['content'] = request.form.get('content')
         page['title'] = request.form.get('title')
         page['slug'] = request.form.get('slug')
-        page['snippet'] = snippet(page['content'])
         page['is_published'] = request.form.get('is_published') == 'on'
         page['show_title'] = request.form.get('show_title') == 'on'
         page['show_nav'] = request.form.get('show_nav') == 'on'
+        # list the pages below this slug (people => people/dirk-gently ...)
+        page['show_children'] = request.form.get('show_children') == 'on'
         # page should be treated as a sidebar, this will come into play later
         page['is_sidebar'] = request.form.get('is_sidebar') == 'on'
         # this is the basic auxilliary CUSTOM content
-        # e.g. a theme would have to support a custom template, for now, lets ignore this
-        page['template'] = request.form.get('template')
+        # the template picks themes/<theme>/<template>.html if the theme has it, see themes.py
+        page['template'] = template
         page['sidebar_right'] = request.form.get('sidebar_right')
         page['sidebar_left'] = request.form.get('sidebar_left')
         page['footer'] = request.form.get('footer')
+        page['is_markdown'] = request.form.get('is_markdown') == 'on'
         if id:
             page['modified_at'] = str(datetime.datetime.now())
         else:
@@ -478,24 +939,38 @@ def page_edit(id=None):
       
         if not(page['slug']):
             page['slug'] = slugify(page['title'])
-        if id:
-            # for an existing page, we use update.
-            g.db.pages.update_one({'_id':id}, page)
+        # Markdown is rendered (and HTML from non-admins sanitized) once, here, not on every view.
+        # This stays in the request, unlike indexing: unsanitized content must never be stored,
+        # the redirect below shows the rendering, and page_saved needs the shortcode dependencies.
+        # Unchanged content costs a hash (see markup.py).
+        site_state().renderer.render_page(page, sanitize=current_app.config.get('SANITIZE_HTML', True) and not g.is_admin)
+        body_field = 'html' if page['is_markdown'] else 'content'
+        if current_app.config.get('IMAGE_SRCSET') and IMAGES.available and page[body_field]:
+            # uploaded images get responsive srcset/sizes attributes
+            page[body_field] = IMAGES.rewrite_content(page[body_field], lambda src: g.db.files.find_one({'url': src}))
+        # shortcodes are parsed here, views only expand them
+        SHORTCODES.compile_page(page)
+        try:
+            if id:
+                # for an existing page, we use update.
+                g.db.pages.update_one({'_id':id}, page)
+            else:
+                # a new page is inserted into collection
+                g.db.pages.insert_one(page)
+            page_saved(page, old_slug)
+        except DuplicateKeyError:
+            # slugs are unique, see indexes.INDEXES
+            flash('Slug "{}" is already used by another page'.format(page['slug']), category="danger")
         else:
-            # a new page is inserted into collection
-            g.db.pages.insert_one(page)
-
-        flash('Page saved.', category="info")
-        # redirecting to a slug is equivalent to a path navigation on the site
-        return redirect(url_for('site', path=page.get('slug')))
+            flash('Page saved.', category="info")
+            # redirecting to a slug is equivalent to a path navigation on the site
+            return redirect(url_for('site', path=page.get('slug')))
 
 
-    templates = [('one_column','One column'), ('sidebar_left','Left Sidebar'), 
-                 ('sidebar_right','Right Sidebar'), ('front_page','Front page'), ('sidebar_left_right','Sidebar Both')]
-    return render_template(page_template, form=form, page=page, id=id, title="Edit page", templates=templates)
+    return render_template(page_template, form=form, page=page, id=id, title="Edit page", templates=PAGE_TEMPLATES)
 
     
-@app.route('/page/delete/<page_id>')
+@route('/page/delete/<page_id>')
 @login_required
 def page_delete(page_id):
     pquery = {'_id':page_id}
@@ -508,39 +983,42 @@ def page_delete(page_id):
         abort(404)
 
     g.db.pages.delete_many(pquery)
+    page_removed(page)
     # move the deleted page into deleted collection!
     g.db.deleted.insert(page)
 
-    g.db.meta.find_one()
     return redirect(url_for('site'))
 
 
-@app.route('/register', methods=['GET','POST'])
+@route('/register', methods=['GET','POST'])
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
         flash("the data validated", category="success")
     return render_template('generic_form_ckedit.html', form=form)
 
-@app.route('/search')
+@route('/search')
 def search():
     search_term = request.args.get('s','')
-    pages = list(g.db.pages.find())
-    found = []
-    for page in pages:
-        if search_term.lower() in page.get('content').lower():
-            found.append(page)
-            
-    return render_template('search.html', search_term=search_term, pages=found)
+    try:
+        page_number = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        page_number = 1
+    SEARCH_INDEX.ensure(g.db, g.db.pages.epoch())
+    found, total = SEARCH_INDEX.search(search_term, page=page_number, per_page=SEARCH_RESULTS_PER_PAGE)
+    pages = (total + SEARCH_RESULTS_PER_PAGE - 1) // SEARCH_RESULTS_PER_PAGE
+    return render_template('search.html', search_term=search_term, pages=found,
+                           total=total, page_number=page_number, page_count=pages,
+                           per_page=SEARCH_RESULTS_PER_PAGE)
 
-@app.route('/upload')
+@route('/upload')
 @login_required
 def file_upload():
-    return render_template('upload_file.html')
+    return render_template('upload_file.html', chunk_size=current_app.config.get('UPLOAD_CHUNK_SIZE', 2 * 1024 * 1024))
 
 # this is the general SITE route "catchment" for page view
-@app.route("/")
-@app.route("/<path:path>")
+@route("/")
+@route("/<path:path>")
 def site(path=None):
     """view for pages referenced via their slug (which can look like a path
     If you want to modify what happens when an empty path comes in
@@ -554,26 +1032,69 @@ def site(path=None):
         """modify here to change behavior of the home-index"""
         path = 'home'
 
-    page = g.db.pages.find_one({'slug': path})
+    # pending flash messages are rendered into the page, never cache those
+    cacheable = '_flashes' not in session
+    max_age = current_app.config.get('PAGE_CACHE_MAX_AGE', 0)
+    page = None
+    if g.is_authenticated:
+        # the logged in navbar and Edit button depend on who is looking
+        page = g.db.pages.find_one({'slug': path})
+        if page is None:
+            abort(404)
+        variant = 'admin' if g.is_admin else 'user'
+        if page.get('owner') == g.username:
+            variant += '-owner'
+    else:
+        variant = 'anonymous'
+
+    cache_key = (path, g.theme, variant)
+    # another worker process changing pages, files (listed by shortcodes) or meta makes every entry suspect
+    PAGE_CACHE.sync((g.db.pages.epoch(), g.db.files.epoch(), g.db.meta.epoch()))
+    if cacheable:
+        entry = PAGE_CACHE.get(cache_key)
+        timer = current_timer()
+        if timer is not None:
+            timer.cache = 'miss' if entry is None else 'hit'
+        if entry is not None:
+            return cached_page_response(entry, public=not g.is_authenticated, max_age=max_age,
+                                        compressor=site_state().compressor)
+
     if page is None:
-        abort(404)
+        page = g.db.pages.find_one({'slug': path})
+        if page is None:
+            abort(404)
         
-    ##### removed get shortcodes
-    # shortcodes = find_shortcodes(page.get('content'))
-    # modify page object with shortcode content directives, return new object
-    # page = page_mod_shortcodes(page, shortcodes)
+    # shortcodes were compiled at save, their results come from the shortcode cache
+    SHORTCODES.ensure(g.db, shortcode_epoch())
+    content = SHORTCODES.expand(g.db, page)
     if page.get('author') is None:
         page['author'] = None
     if page.get('date') is None:
         page['date'] = None
         
-    page_template = 'themes/default/page.html'
-    try:
-        return render_template(page_template, page=page)
-    except:
-        flash("Template <{}> not found".format(page.get('template')), category="danger")
-        return render_template('themes/default/page.html', page=page)
+    SLUG_TRIE.ensure(g.db, g.db.pages.epoch())
+    breadcrumbs = SLUG_TRIE.breadcrumbs(page.get('slug'), lambda slug: url_for('site', path=slug))
+    children = SLUG_TRIE.children(page.get('slug')) if page.get('show_children') else []
+
+    # themes/<theme>/<page template>.html, or the fallback worked out at startup, see themes.py
+    page_template = site_state().themes.resolve(g.theme, page.get('template'))
+    body = render_template(page_template, page=page, content=content, breadcrumbs=breadcrumbs, children=children)
+
+    entry = make_cached_page(body)
+    if cacheable:
+        PAGE_CACHE.put(cache_key, entry)
+    return cached_page_response(entry, public=not g.is_authenticated, max_age=max_age,
+                                compressor=site_state().compressor)
 
 
 if __name__ == '__main__':
-    app.run(host=HOST, port=PORT, debug=DEBUG)
\ No newline at end of file
+    # python app.py [run|seed], the development server seeds an empty site first
+    parser = argparse.ArgumentParser(description="FlaskPress development server")
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'seed'])
+    args = parser.parse_args()
+    # create_app logs its startup time
+    app = create_app()
+    seed(app)
+    if args.command == 'run':
+        precompile_templates(app)
+        app.run(host=HOST, port=PORT, debug=DEBUG)
@@ -0,0 +1,179 @@
+# assets.py
+# static asset build: fingerprinted copies of static/ and a manifest
+#
+#   python assets.py [STATIC_DIR]      or      flask --app app assets
+#
+# Every file below static/ (except the build output) is copied to
+# static/dist/<dir>/<name>.<hash>.<ext>, stylesheets minified first, with
+# .gz (and .br, if the brotli package is installed) siblings, and
+# static/dist/manifest.json maps source names to the copies.  Templates link
+# assets through asset_url(), which returns the fingerprinted URL when the
+# manifest has one and the plain /static/ URL otherwise.  A fingerprinted
+# file never changes, so /static/dist/ is served with a one year immutable
+# Cache-Control and the precompressed variant the client accepts; a changed
+# file gets a new name, so browsers never keep a stale stylesheet.
+#
+# Run the build after changing anything in static/ (and before deploying).
+import argparse
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+from compression import compress_siblings, is_compressible, negotiate
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+HASH_LENGTH = 10
+# a year, the longest max-age worth sending
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# file name suffix of a precompressed variant
+ENCODING_SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+CSS_COMMENT_RE = re.compile(r'/\*(?!!).*?\*/', re.DOTALL)
+CSS_SPACE_RE = re.compile(r'\s+')
+CSS_PUNCTUATION_RE = re.compile(r'\s*([{};,>])\s*')
+
+
+def minify_css(text):
+    """drop comments (not /*! license */ ones) and needless whitespace.
+    conservative: spaces around ':' are kept, they matter in selectors
+    """
+    text = CSS_COMMENT_RE.sub('', text)
+    text = CSS_SPACE_RE.sub(' ', text)
+    text = CSS_PUNCTUATION_RE.sub(r'\1', text)
+    return text.replace(';}', '}').strip() + '\n'
+
+# extension => minifier(text), files of other types are copied unchanged
+MINIFIERS = {'.css': minify_css}
+
+
+def fingerprinted_name(relpath, data):
+    """css/site.css => css/site.<hash>.css"""
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    root, ext = os.path.splitext(relpath)
+    return '{}.{}{}'.format(root, digest, ext)
+
+def source_files(static_folder):
+    """relative paths (with /) of the files to build, the build output excluded"""
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder:
+            dirs[:] = [d for d in dirs if d != DIST_DIR]
+        dirs.sort()
+        for name in sorted(files):
+            if name.startswith('.') or os.path.splitext(name)[1] in ('.gz', '.br'):
+                continue
+            yield os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+
+def build_assets(static_folder):
+    """build static_folder/dist and its manifest, returns the manifest.
+    copies that are already current are not rewritten, stale ones are removed
+    """
+    dist = os.path.join(static_folder, DIST_DIR)
+    manifest = {}
+    for relpath in source_files(static_folder):
+        with open(os.path.join(static_folder, *relpath.split('/')), 'rb') as f:
+            data = f.read()
+        minifier = MINIFIERS.get(os.path.splitext(relpath)[1].lower())
+        if minifier is not None:
+            data = minifier(data.decode('utf-8')).encode('utf-8')
+        target = fingerprinted_name(relpath, data)
+        manifest[relpath] = target
+        path = os.path.join(dist, *target.split('/'))
+        if os.path.isfile(path):
+            # same name, same content
+            continue
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'wb') as f:
+            f.write(data)
+        compress_siblings(path, data)
+
+    keep = set(manifest.values())
+    for root, dirs, files in os.walk(dist):
+        for name in files:
+            relpath = os.path.relpath(os.path.join(root, name), dist).replace(os.sep, '/')
+            base, ext = os.path.splitext(relpath)
+            if relpath == MANIFEST_NAME or relpath in keep or (ext in ('.gz', '.br') and base in keep):
+                continue
+            os.remove(os.path.join(root, name))
+
+    if not os.path.isdir(dist):
+        os.makedirs(dist)
+    tmp = os.path.join(dist, MANIFEST_NAME + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(dist, MANIFEST_NAME))
+    return manifest
+
+
+class AssetManifest(object):
+    """source name => fingerprinted name, read from static/dist/manifest.json"""
+    def __init__(self, static_folder):
+        self.static_folder = static_folder
+        self.reload()
+
+    def reload(self):
+        try:
+            with open(os.path.join(self.static_folder, DIST_DIR, MANIFEST_NAME)) as f:
+                self.files = json.load(f)
+        except (IOError, OSError, ValueError):
+            # not built, plain /static/ URLs
+            self.files = {}
+
+    def url(self, filename):
+        """URL of a static file, fingerprinted if built.
+        filename is relative to static/ ('css/bulma-minty.css'), a /static/ path
+        or an absolute URL (returned as is, e.g. a CDN stylesheet)
+        """
+        if not filename or '//' in filename:
+            return filename
+        if filename.startswith('/'):
+            prefix = url_for('static', filename='')
+            if not filename.startswith(prefix):
+                return filename
+            filename = filename[len(prefix):]
+        built = self.files.get(filename)
+        if built is not None:
+            return url_for('static', filename=DIST_DIR + '/' + built)
+        return url_for('static', filename=filename)
+
+
+def send_asset(static_folder, filename):
+    """a file of static/dist, immutable, in the precompressed variant the client accepts"""
+    directory = os.path.join(static_folder, DIST_DIR)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    name, encoding = filename, None
+    if is_compressible(mimetype):
+        encoding = negotiate(request.accept_encodings)
+        if encoding is not None:
+            candidate = safe_join(directory, filename + ENCODING_SUFFIXES[encoding])
+            if candidate is not None and os.path.isfile(candidate):
+                name = filename + ENCODING_SUFFIXES[encoding]
+            else:
+                encoding = None
+    response = send_from_directory(directory, name, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if is_compressible(mimetype):
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="build fingerprinted static assets")
+    parser.add_argument('static_dir', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'),
+                        help="static folder (default: the one next to this file)")
+    args = parser.parse_args(argv)
+    manifest = build_assets(args.static_dir)
+    print("{} assets built into {}".format(len(manifest), os.path.join(args.static_dir, DIST_DIR)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# auth.py
+# password hashing off the request threads, login throttling, hash upgrades
+#
+# Password hashes are deliberately slow.  Hashing and checking run in a small
+# thread pool (hashlib releases the GIL while it works) with a limit on the
+# queued jobs, so a login storm costs at most `workers` cores and everything
+# beyond the queue limit gets an immediate 503 instead of piling up.  Login
+# attempts are throttled per username and per client address with token
+# buckets.  A hash made with older parameters than PASSWORD_HASH_METHOD is
+# replaced on the next successful login.
+import concurrent.futures
+import threading
+import time
+
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.security import check_password_hash
+
+from users import PASSWORD_METHOD, hash_password
+
+
+class Overloaded(ServiceUnavailable):
+    """too many hashing jobs queued, answered with 503"""
+    description = "The server is busy, please try again in a moment."
+
+
+class Throttled(TooManyRequests):
+    """too many login attempts, answered with 429"""
+    description = "Too many login attempts, please wait a moment."
+
+
+class TokenBucket(object):
+    """per key token buckets: burst tokens, refilled at rate tokens per second"""
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key => (tokens, time of last update)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """use a token, returns 0 or the seconds until a token is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+            return 0
+
+    def _prune(self, now):
+        # full buckets carry no information
+        full = [key for key, (tokens, last) in self._buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for key in full:
+            del self._buckets[key]
+
+
+class AuthService(object):
+    """hashes and checks passwords in a bounded pool"""
+    def __init__(self, method=PASSWORD_METHOD, workers=2, queue_limit=16, timeout=10,
+                 attempts_per_minute=10, burst=5):
+        self.method = method
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.throttle = TokenBucket(attempts_per_minute / 60.0, burst)
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='auth')
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._prefix = None
+        # checked against when the username does not exist, so that takes as long
+        self._dummy_hash = None
+
+    def _run(self, fn, *args):
+        """fn(*args) in the pool, Overloaded if the queue is full or it takes too long"""
+        with self._lock:
+            if self._pending >= self.queue_limit:
+                raise Overloaded(retry_after=1)
+            self._pending += 1
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            self._done(None)
+            raise
+        # a hash that timed out keeps its place in the queue until it finishes
+        future.add_done_callback(self._done)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise Overloaded(retry_after=self.timeout)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def hash_password(self, password):
+        return self._run(hash_password, password, self.method)
+
+    def _current_prefix(self):
+        # method and parameters, e.g. scrypt:32768:8:1, of a hash made today
+        if self._prefix is None:
+            self._prefix = hash_password('', self.method).split('$', 1)[0]
+        return self._prefix
+
+    def needs_rehash(self, password_hash):
+        """True if password_hash was made with other parameters than ours"""
+        return password_hash.split('$', 1)[0] != self._current_prefix()
+
+    def _check(self, password_hash, password):
+        """runs in the pool: (password ok, upgraded hash or None)"""
+        if password_hash is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = hash_password('', self.method)
+            check_password_hash(self._dummy_hash, password)
+            return False, None
+        if not check_password_hash(password_hash, password):
+            return False, None
+        if self.needs_rehash(password_hash):
+            return True, hash_password(password, self.method)
+        return True, None
+
+    def authenticate(self, password_hash, password, username, address=None):
+        """check a login attempt against a stored hash (None for unknown users)
+        returns (password ok, new hash to store or None)
+        raises Throttled when username or address tried too often, Overloaded when busy
+        """
+        for key in ('user:' + (username or ''), 'addr:{}'.format(address)):
+            wait = self.throttle.take(key)
+            if wait:
+                raise Throttled(retry_after=int(wait) + 1)
+        return self._run(self._check, password_hash, password)
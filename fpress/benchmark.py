@@ -0,0 +1,409 @@
+# benchmark.py
+# reproducible load benchmark on a synthetic site
+#
+#   python benchmark.py [--pages N] [--page-bytes B] [--users N] [--files N]
+#                       [--threads T] [--requests R] [--backend tinymongo|sqlite|journal]
+#                       [--scenarios page_view,search,...] [--seed S]
+#                       [--output results.json] [--baseline old.json] [--tolerance 0.2]
+#
+# A scratch site (an app from create_app() with its database and uploads in
+# a temporary directory) is filled with a generated corpus through the
+# regular data layer: users, pages of about --page-bytes of HTML arranged in
+# sections, and uploaded files.  Each scenario is then driven through the
+# Flask test client by --threads threads (one client per thread) for
+# --requests requests, after a short warm-up.  For every scenario the
+# latency percentiles (p50/p95/p99), throughput and errors are reported,
+# plus the peak RSS of the process.
+#
+# --output writes the results as JSON.  With --baseline, the run is compared
+# against an earlier results file: a scenario whose p50/p95 latency grew, or
+# whose throughput dropped, by more than --tolerance is a regression and the
+# exit status is 1, so the benchmark can gate a deploy.  Only compare runs
+# made on the same machine with the same corpus options.
+import argparse
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SCENARIOS = ['page_view', 'page_view_user', 'search', 'login', 'page_save', 'admin_pages', 'upload', 'mixed']
+# the metrics compared against a baseline, and whether bigger is worse
+COMPARED = [('p50_ms', True), ('p95_ms', True), ('throughput_rps', False)]
+BENCH_PASSWORD = 'benchmark'
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+         'et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip '
+         'ex ea commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla '
+         'pariatur excepteur sint occaecat cupidatat non proident sunt culpa qui officia deserunt mollit anim '
+         'id est laborum flask press python page section').split()
+
+
+################ corpus ################
+
+def words(rng, count):
+    return ' '.join(rng.choice(WORDS) for i in range(count))
+
+def html_content(rng, size):
+    """paragraphs of random words, about size bytes of html"""
+    parts = []
+    length = 0
+    while length < size:
+        paragraph = '<p>{}</p>\n'.format(words(rng, rng.randint(20, 80)))
+        if rng.random() < 0.2:
+            paragraph = '<h2>{}</h2>\n'.format(words(rng, 4).title()) + paragraph
+        parts.append(paragraph)
+        length += len(paragraph)
+    return ''.join(parts)
+
+def generate_corpus(DB, blobs, rng, pages=1000, page_bytes=4096, users=10, files=100, hasher=None):
+    """fill a database with a synthetic site, returns what the scenarios need:
+    published slugs, page ids, usernames and search terms
+    """
+    from users import create_user, hash_password
+    from utils import snippet
+
+    hasher = hasher or hash_password
+    usernames = []
+    for n in range(users):
+        username = 'user{}'.format(n)
+        create_user(DB, username, BENCH_PASSWORD, hasher=hasher)
+        usernames.append(username)
+    owners = usernames or ['admin']
+
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+    sections = max(1, pages // 50)
+    DB.pages.insert_one({'slug': 'sidebar', 'title': 'Sidebar', 'owner': 'admin', 'is_published': True,
+                         'is_sidebar': True, 'content': html_content(rng, 512), 'created_at': now})
+    slugs = []
+    page_ids = []
+    for n in range(pages):
+        section = 'section-{}'.format(n % sections)
+        if n < sections:
+            # the first page of each section is its index, listing the pages below it
+            slug, title = section, 'Section {}'.format(n)
+        else:
+            slug, title = '{}/page-{}'.format(section, n), words(rng, 4).title()
+        content = html_content(rng, page_bytes)
+        page = {'slug': slug, 'title': title, 'owner': rng.choice(owners), 'content': content,
+                'snippet': snippet(content), 'is_published': rng.random() < 0.95,
+                'show_title': True, 'show_nav': n < 5, 'show_children': n < sections,
+                'is_markdown': False, 'template': 'one_column', 'created_at': now,
+                'sidebar_right': 'sidebar' if rng.random() < 0.3 else '', 'sidebar_left': '', 'footer': ''}
+        DB.pages.insert_one(page)
+        page_ids.append(page['_id'])
+        if page['is_published']:
+            slugs.append(slug)
+
+    for n in range(files):
+        data = ('{}\n'.format(words(rng, 200))).encode('utf-8')
+        sha256 = hashlib.sha256(data).hexdigest()
+        fd, source = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        blobs.add(source, sha256, len(data), 'text/plain')
+        filename = 'file-{}.txt'.format(n)
+        filepath = blobs.filepath(sha256, filename)
+        DB.files.insert_one({'title': filename, 'filepath': filepath, 'owner': rng.choice(owners),
+                             'url': '/uploads/' + filepath, 'size': len(data), 'sha256': sha256,
+                             'content_type': 'text/plain', 'blob': sha256, 'created_at': now})
+
+    return {'slugs': slugs, 'page_ids': page_ids, 'usernames': usernames, 'terms': WORDS}
+
+
+################ scenarios ################
+
+def log_in(client, username, is_admin=False):
+    """a test client with a logged in session"""
+    with client.session_transaction() as session:
+        session['username'] = username
+        session['is_authenticated'] = True
+        if is_admin:
+            session['is_admin'] = True
+    return client
+
+
+class Scenarios(object):
+    """one method per scenario: request(clients, rng) => response"""
+    def __init__(self, app, DB, corpus):
+        self.app = app
+        self.db = DB
+        self.corpus = corpus
+        self._uploads = 0
+        self._lock = threading.Lock()
+
+    def clients(self):
+        """the test clients of one load thread"""
+        user = self.corpus['usernames'][0] if self.corpus['usernames'] else 'admin'
+        return {'anonymous': self.app.test_client(),
+                'user': log_in(self.app.test_client(), user),
+                'admin': log_in(self.app.test_client(), 'admin', is_admin=True)}
+
+    def page_view(self, clients, rng):
+        return clients['anonymous'].get('/' + rng.choice(self.corpus['slugs']))
+
+    def page_view_user(self, clients, rng):
+        return clients['user'].get('/' + rng.choice(self.corpus['slugs']))
+
+    def search(self, clients, rng):
+        return clients['anonymous'].get('/search', query_string={'s': ' '.join(rng.sample(self.corpus['terms'], 2))})
+
+    def login(self, clients, rng):
+        # a fresh client each time, a logged in one is sent away
+        username = rng.choice(self.corpus['usernames'] or ['admin'])
+        password = BENCH_PASSWORD if username != 'admin' else 'admin'
+        return self.app.test_client().post('/login', data={'username': username, 'password': password})
+
+    def page_save(self, clients, rng):
+        page_id = rng.choice(self.corpus['page_ids'])
+        page = self.db.pages.find_one({'_id': page_id})
+        content = html_content(rng, len(page.get('content') or '') or 1024)
+        form = {'title': page['title'], 'slug': page['slug'], 'content': content,
+                'sidebar_right': page.get('sidebar_right') or '', 'sidebar_left': '', 'footer': '',
+                'template': page.get('template') or 'one_column'}
+        for flag in ('is_published', 'show_title', 'show_nav', 'show_children'):
+            if page.get(flag):
+                form[flag] = 'on'
+        return clients['admin'].post('/page/edit/{}'.format(page_id), data=form)
+
+    def admin_pages(self, clients, rng):
+        return clients['admin'].get('/admin/pages', query_string={'sort': rng.choice(['title', 'slug', 'owner'])})
+
+    def upload(self, clients, rng):
+        with self._lock:
+            self._uploads += 1
+            n = self._uploads
+        data = '{} {}\n'.format(n, words(rng, 400)).encode('utf-8')
+        return clients['admin'].post('/_upload', data={'file': (io.BytesIO(data), 'upload-{}.txt'.format(n))},
+                                     content_type='multipart/form-data')
+
+    def mixed(self, clients, rng):
+        """a read heavy mix: mostly anonymous page views"""
+        roll = rng.random()
+        if roll < 0.80:
+            return self.page_view(clients, rng)
+        if roll < 0.90:
+            return self.search(clients, rng)
+        if roll < 0.97:
+            return self.page_view_user(clients, rng)
+        return self.page_save(clients, rng)
+
+
+################ load driver ################
+
+def percentile(ordered, fraction):
+    """nearest rank percentile of a sorted list"""
+    if not ordered:
+        return None
+    rank = max(1, int(round(fraction * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+def peak_rss_mb():
+    """peak resident set size of this process in MB, None where unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        peak /= 1024.0
+    return round(peak / 1024.0, 1)
+
+def run_scenario(scenarios, name, threads, requests, warmup, seed):
+    """drive one scenario with threads threads, returns its statistics"""
+    request = getattr(scenarios, name)
+    latencies = []
+    statuses = {}
+    errors = []
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker(index):
+        rng = random.Random('{}-{}-{}'.format(seed, name, index))
+        clients = scenarios.clients()
+        try:
+            for i in range(warmup // threads):
+                request(clients, rng)
+        finally:
+            # the clock starts when every thread is warm
+            ready.wait()
+        mine = []
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                status = request(clients, rng).status_code
+            except Exception as e:
+                status = 'exception'
+                with lock:
+                    errors.append(repr(e))
+            mine.append(time.perf_counter() - start)
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+        with lock:
+            latencies.extend(mine)
+
+    ready = threading.Barrier(threads + 1)
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    ready.wait()
+    start = time.perf_counter()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    failed = sum(count for status, count in statuses.items() if status == 'exception' or status >= 400)
+    ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {'requests': len(latencies),
+            'errors': failed,
+            'statuses': dict((str(status), count) for status, count in sorted(statuses.items(), key=str)),
+            'p50_ms': ms(percentile(latencies, 0.50)),
+            'p95_ms': ms(percentile(latencies, 0.95)),
+            'p99_ms': ms(percentile(latencies, 0.99)),
+            'max_ms': ms(latencies[-1] if latencies else None),
+            'mean_ms': ms(sum(latencies) / len(latencies) if latencies else None),
+            'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'peak_rss_mb': peak_rss_mb(),
+            'exceptions': errors[:5]}
+
+
+################ comparison ################
+
+def compare(results, baseline, tolerance=0.2):
+    """regressions of results against a baseline, as readable lines"""
+    regressions = []
+    for name, stats in sorted(results['scenarios'].items()):
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        for metric, bigger_is_worse in COMPARED:
+            old, new = before.get(metric), stats.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / float(old)
+            if (change > tolerance) if bigger_is_worse else (change < -tolerance):
+                regressions.append('{} {}: {} -> {} ({:+.0%})'.format(name, metric, old, new, change))
+    return regressions
+
+def print_results(results, baseline=None):
+    print('{:<16} {:>8} {:>7} {:>9} {:>9} {:>9} {:>10} {:>8}'.format(
+        'scenario', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'rss MB'))
+    for name, stats in results['scenarios'].items():
+        print('{:<16} {:>8} {:>7} {:>9} {:>9} {:>9} {:>10} {:>8}'.format(
+            name, stats['requests'], stats['errors'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            stats['throughput_rps'], stats['peak_rss_mb']))
+        old = (baseline or {}).get('scenarios', {}).get(name)
+        if old:
+            print('{:<16} {:>8} {:>7} {:>9} {:>9} {:>9} {:>10} {:>8}'.format(
+                '  (baseline)', old.get('requests'), old.get('errors'), old.get('p50_ms'), old.get('p95_ms'),
+                old.get('p99_ms'), old.get('throughput_rps'), old.get('peak_rss_mb')))
+    print('app startup {startup_ms} ms, setup {setup_seconds}s, peak RSS {peak_rss_mb} MB'.format(**results))
+
+
+################ main ################
+
+def scratch_settings(directory, backend):
+    """create_app() settings of a scratch site in directory"""
+    settings = {
+        'DATABASE_BACKEND': backend,
+        'DATABASE_PATH': os.path.join(directory, 'data'),
+        'UPLOAD_FOLDER': os.path.join(directory, 'uploads'),
+        # the test client posts forms without tokens
+        'WTF_CSRF_ENABLED': False,
+        # the login scenario measures hashing, not the throttle
+        'LOGIN_ATTEMPTS_PER_MINUTE': 10 ** 9,
+        'LOGIN_ATTEMPTS_BURST': 10 ** 9,
+        'MULTIPROCESS': False,
+    }
+    if backend == 'journal':
+        settings['JOURNAL_FSYNC'] = False
+    return settings
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark FlaskPress on a synthetic site")
+    parser.add_argument('--pages', type=int, default=1000, help="pages to generate")
+    parser.add_argument('--page-bytes', type=int, default=4096, help="html size of a generated page")
+    parser.add_argument('--users', type=int, default=10, help="users to generate")
+    parser.add_argument('--files', type=int, default=100, help="uploaded files to generate")
+    parser.add_argument('--threads', type=int, default=4, help="concurrent clients")
+    parser.add_argument('--requests', type=int, default=1000, help="measured requests per scenario")
+    parser.add_argument('--warmup', type=int, default=50, help="unmeasured requests per scenario")
+    parser.add_argument('--backend', default='tinymongo', choices=['tinymongo', 'sqlite', 'journal'])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help="comma separated, from: " + ', '.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=1, help="seed of the corpus and the request mix")
+    parser.add_argument('--output', help="write the results as JSON")
+    parser.add_argument('--baseline', help="results JSON of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown before it is a regression")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch site")
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenario: " + ', '.join(unknown))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    directory = tempfile.mkdtemp(prefix='fpress-bench-')
+    try:
+        setup = time.perf_counter()
+        from app import create_app, seed
+        app = create_app(scratch_settings(directory, args.backend))
+        state = app.extensions['fpress']
+        seed(app)
+        corpus = generate_corpus(state.db, state.blobs, random.Random(args.seed), pages=args.pages,
+                                 page_bytes=args.page_bytes, users=args.users, files=args.files,
+                                 hasher=state.auth.hash_password)
+        setup = time.perf_counter() - setup
+
+        scenarios = Scenarios(app, state.db, corpus)
+        results = {'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'options': {'pages': args.pages, 'page_bytes': args.page_bytes, 'users': args.users,
+                               'files': args.files, 'threads': args.threads, 'requests': args.requests,
+                               'warmup': args.warmup, 'backend': args.backend, 'seed': args.seed},
+                   'startup_ms': round(state.startup_seconds * 1000, 1),
+                   'setup_seconds': round(setup, 2),
+                   'scenarios': {}}
+        for name in names:
+            results['scenarios'][name] = run_scenario(scenarios, name, args.threads, args.requests,
+                                                      args.warmup, args.seed)
+        results['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if baseline is not None:
+        if baseline.get('options') != results['options']:
+            print("warning: the baseline was made with other options", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print("REGRESSION " + line)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
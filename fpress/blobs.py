@@ -0,0 +1,99 @@
+# blobs.py
+# content-addressed storage for uploaded files
+#
+# Uploads are stored once per distinct content under UPLOAD_FOLDER/blobs,
+# sharded by hash: blobs/ab/cd/abcd...(sha256).  File objects reference the
+# blob by hash and the 'blobs' collection counts the references, so uploading
+# the same file twice costs no disk and the blob is deleted with its last
+# file object.  The public path of a blob file is blob/<sha256>/<filename>,
+# which never collides and never needs renaming.
+import os
+import re
+import shutil
+import threading
+
+BLOB_PREFIX = 'blob/'
+# blob files live in this subfolder of UPLOAD_FOLDER
+BLOB_DIR = 'blobs'
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def parse_blob_path(path):
+    """(sha256, filename) for a blob/<sha256>/<filename> path, None for other paths"""
+    if not path.startswith(BLOB_PREFIX):
+        return None
+    parts = path[len(BLOB_PREFIX):].split('/', 1)
+    if len(parts) != 2 or not SHA256_RE.match(parts[0]) or not parts[1]:
+        return None
+    return parts[0], parts[1]
+
+
+class BlobStore(object):
+    """hash-sharded blob files plus reference counts in db.blobs"""
+    def __init__(self, root, db):
+        self.root = root
+        self.db = db
+        self._lock = threading.Lock()
+
+    def relpath(self, sha256):
+        """path of a blob relative to root"""
+        return os.path.join(sha256[:2], sha256[2:4], sha256)
+
+    def path(self, sha256):
+        return os.path.join(self.root, self.relpath(sha256))
+
+    def filepath(self, sha256, filename):
+        """public path (under /uploads) of a blob served as filename"""
+        return '{}{}/{}'.format(BLOB_PREFIX, sha256, filename)
+
+    def _locked(self):
+        # the reference count update is a read-modify-write, with several
+        # worker processes it needs the database wide lock as well
+        shared = getattr(self.db, 'shared', None)
+        return shared.lock if shared is not None else _NoLock()
+
+    def add(self, source, sha256, size, content_type=None):
+        """store the file at source (moved or deleted) and add a reference"""
+        with self._lock, self._locked():
+            blob = self.db.blobs.find_one({'_id': sha256})
+            target = self.path(sha256)
+            if blob is not None and os.path.isfile(target):
+                os.remove(source)
+                self.db.blobs.update_one({'_id': sha256}, {'$set': {'refs': blob.get('refs', 0) + 1}})
+                return False
+            directory = os.path.dirname(target)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            shutil.move(source, target)
+            if blob is None:
+                self.db.blobs.insert_one({'_id': sha256, 'refs': 1, 'size': size, 'content_type': content_type})
+            else:
+                # the file had gone missing, the new upload restores it
+                self.db.blobs.update_one({'_id': sha256}, {'$set': {'refs': blob.get('refs', 0) + 1}})
+            return True
+
+    def release(self, sha256):
+        """drop a reference, the blob file goes with the last one.
+        returns True if the blob was deleted
+        """
+        with self._lock, self._locked():
+            blob = self.db.blobs.find_one({'_id': sha256})
+            if blob is None:
+                return False
+            refs = blob.get('refs', 1) - 1
+            if refs > 0:
+                self.db.blobs.update_one({'_id': sha256}, {'$set': {'refs': refs}})
+                return False
+            self.db.blobs.delete_many({'_id': sha256})
+            target = self.path(sha256)
+            if os.path.isfile(target):
+                os.remove(target)
+            return True
+
+
+class _NoLock(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
@@ -0,0 +1,99 @@
+# coherence.py
+# cross-process write locking and change detection for the data store
+#
+# With several worker processes (gunicorn -w N) every process keeps its own
+# in-memory copy of the collections (indexes.py).  SharedState coordinates them:
+#   - one exclusive file lock serializes writers across processes (TinyMongo
+#     rewrites one JSON file for all collections, so the lock is database wide)
+#   - a small generation file per collection is bumped after each write; a
+#     process whose copy is older than the generation on disk reloads it.
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # no flock (Windows), multi-process mode is not available
+    fcntl = None
+
+
+class FileLock(object):
+    """exclusive lock on a file, shared by all threads of a process.
+    Re-entrant within a thread; other threads wait on the in-process lock,
+    other processes on flock().
+    """
+    def __init__(self, path):
+        if fcntl is None:
+            raise RuntimeError("multi-process locking needs fcntl (POSIX systems only)")
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class SharedState(object):
+    """lock file and per collection generation counters in a directory"""
+    def __init__(self, directory, prefix='.fpress'):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.prefix = prefix
+        self.lock = FileLock(os.path.join(directory, prefix + '.lock'))
+
+    def _path(self, name):
+        return os.path.join(self.directory, '{}-{}.gen'.format(self.prefix, name))
+
+    def generation(self, name):
+        """current generation of a collection (0 if it was never written)"""
+        try:
+            with open(self._path(name)) as f:
+                return int(f.read() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def bump(self, name):
+        """advance the generation of a collection, call with the lock held"""
+        generation = self.generation(name) + 1
+        path = self._path(name)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(str(generation))
+        # readers see either the old or the new value, never a partial write
+        os.replace(tmp, path)
+        return generation
+
+
+def shared_state_for(config):
+    """SharedState for the configured database, None unless MULTIPROCESS is on"""
+    if not config.get('MULTIPROCESS'):
+        return None
+    directory = config.get('COHERENCE_DIR')
+    if not directory:
+        path = config.get('DATABASE_PATH', 'tinydb')
+        if config.get('DATABASE_BACKEND', 'tinymongo') == 'sqlite':
+            directory = os.path.dirname(os.path.abspath(path))
+        else:
+            directory = path
+    return SharedState(directory, prefix='.fpress-' + config.get('DATABASE_NAME', 'blog'))
@@ -0,0 +1,101 @@
+# compression.py
+# gzip / brotli for responses and precompressed files
+#
+# Dynamic responses (pages, search, admin listings...) are compressed in
+# after_request when the client accepts it and the body is at least
+# COMPRESS_MIN_SIZE bytes; brotli is preferred when the brotli package is
+# installed.  Cached pages keep their compressed bodies, so a page cache hit
+# does not compress again (see pagecache.py).  File responses (uploads,
+# static files) are left alone, the static build ships .gz/.br siblings
+# instead (see assets.py), as does the static export (see export.py).
+import gzip
+import io
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# extensions worth precompressing
+COMPRESSIBLE = set(['.html', '.css', '.js', '.txt', '.svg', '.json', '.xml'])
+# content types worth compressing on the fly
+COMPRESSIBLE_TYPES = set(['application/json', 'application/javascript', 'application/xml',
+                          'application/rss+xml', 'application/atom+xml', 'image/svg+xml'])
+# preferred first
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def compress(data, encoding, level=None):
+    """data (bytes) compressed with encoding ('gzip' or 'br').
+    level is the gzip level (1-9) or brotli quality (0-11), the maximum by default
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if level is None else level)
+    buf = io.BytesIO()
+    # mtime=0 keeps the output reproducible
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9 if level is None else level, mtime=0) as gz:
+        gz.write(data)
+    return buf.getvalue()
+
+def compress_siblings(path, data=None):
+    """write path.gz and path.br next to a compressible file"""
+    if os.path.splitext(path)[1].lower() not in COMPRESSIBLE:
+        return
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+    for encoding, suffix in (('gzip', '.gz'), ('br', '.br')):
+        if encoding in ENCODINGS:
+            with open(path + suffix, 'wb') as f:
+                f.write(compress(data, encoding))
+
+def negotiate(accept_encodings):
+    """the encoding to answer with for a request's accept_encodings, None for identity"""
+    best, best_quality = None, 0
+    for encoding in ENCODINGS:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def is_compressible(mimetype):
+    return bool(mimetype) and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES)
+
+
+class ResponseCompressor(object):
+    """after_request hook compressing dynamic responses"""
+    def __init__(self, min_size=500, gzip_level=6, brotli_quality=5):
+        self.min_size = min_size
+        self.levels = {'gzip': gzip_level, 'br': brotli_quality}
+
+    def encode(self, data, encoding):
+        return compress(data, encoding, self.levels[encoding])
+
+    def __call__(self, response, request):
+        """compress response in place if worthwhile, returns it"""
+        if (response.status_code != 200 or response.direct_passthrough or request.method == 'HEAD'
+                or 'Content-Encoding' in response.headers or not is_compressible(response.mimetype)
+                or 'no-transform' in response.headers.get('Cache-Control', '')):
+            return response
+        # the representation depends on Accept-Encoding, whether or not this one is compressed
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate(request.accept_encodings)
+        if encoding is None:
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+        set_encoded_body(response, self.encode(data, encoding), encoding)
+        return response
+
+
+def set_encoded_body(response, body, encoding):
+    """replace the body of response with its encoded form"""
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # the bytes differ from the identity representation, a strong validator would lie
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
@@ -0,0 +1,293 @@
+# export.py
+# static site export: prerender published pages into a flat directory tree
+#
+#   python export.py OUTPUT_DIR [--workers N] [--full]
+#
+# Every published page is rendered through the regular site() view (as an
+# anonymous visitor) and written to OUTPUT_DIR/<slug>/index.html, the home
+# page to OUTPUT_DIR/index.html.  /static and /uploads are copied alongside.
+# Text files get .gz (and .br, if the brotli package is installed) siblings
+# for nginx gzip_static / brotli_static.
+#
+# Re-running the export only re-renders the pages that would look different:
+# each page's stamp covers its own modified_at and what it shows of other
+# pages (sidebars, footer, breadcrumbs, child list, shortcode embeds and
+# listings), and a change to the meta document or the navigation menu
+# re-renders everything.  See the manifest file written into OUTPUT_DIR.
+#
+# Pages are rendered by a pool of worker processes, each with its own app.
+# The journal backend keeps the data in one process, so with it the pages are
+# rendered by the exporting app itself, one at a time.
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+from blobs import BLOB_DIR, BlobStore, parse_blob_path
+from compression import compress_siblings
+from images import DERIVED_DIR, DERIVED_NAME_RE
+from navigation import fragment_refs, nav_signature
+from routing import SlugTrie
+from shortcodes import ShortcodeEngine, listing_signature
+
+MANIFEST = '.fpress-export.json'
+HOME_SLUG = 'home'
+
+# per worker process test client, see _init_worker
+_client = None
+
+
+def fingerprint(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def page_stamp(page):
+    """the value that changes whenever a page is saved"""
+    return page.get('modified_at') or page.get('created_at') or ''
+
+def page_filename(output_dir, slug):
+    """where a page with a slug lives in the exported tree"""
+    if slug == HOME_SLUG:
+        return os.path.join(output_dir, 'index.html')
+    return os.path.join(output_dir, *slug.split('/')) + os.sep + 'index.html'
+
+def meta_stamp(meta):
+    """fingerprint of the meta document, a brand/stylesheet change re-renders everything"""
+    return fingerprint(meta)
+
+def menu_stamp(pages):
+    """fingerprint of the navigation menu, which every page shows"""
+    return fingerprint(sorted(signature for signature in map(nav_signature, pages) if signature is not None))
+
+
+class PageStamps(object):
+    """stamp of each page: its own modified_at and what it shows of other pages
+    and files, so a page is re-rendered when any of those change
+    """
+    def __init__(self, DB):
+        pages = list(DB.pages.find())
+        self.pages = dict((page['slug'], page) for page in pages if page.get('slug'))
+        self.trie = SlugTrie()
+        self.trie.ensure(DB)
+        self.shortcodes = ShortcodeEngine()
+        self.listing = fingerprint(sorted(signature for signature in map(listing_signature, pages)
+                                          if signature is not None))
+        self.files = fingerprint(sorted((f.get('created_at'), f.get('title'), f.get('url'))
+                                        for f in DB.files.find()))
+        self.menu = menu_stamp(pages)
+        self._stamps = {}
+
+    def stamp(self, slug, embedding=()):
+        """stamp of the page at slug, None if there is none.
+        embedding are the pages embedding this one, an embed cycle stops there
+        """
+        if slug in self._stamps:
+            return self._stamps[slug]
+        page = self.pages.get(slug)
+        if page is None:
+            return None
+        parts = [page_stamp(page),
+                 [(ref, page_stamp(self.pages.get(ref, {}))) for ref in sorted(fragment_refs(page))],
+                 self.trie.breadcrumbs(slug, lambda crumb: crumb)]
+        if page.get('show_children'):
+            parts.append([(child['slug'], child['title']) for child in self.trie.children(slug)])
+        for dep in self.shortcodes.page_deps(page):
+            if dep == 'pages':
+                parts.append(self.listing)
+            elif dep == 'files':
+                parts.append(self.files)
+            else:
+                embedded = dep.split(':', 1)[1]
+                if embedded == slug or embedded in embedding:
+                    continue
+                parts.append((embedded, self.stamp(embedded, embedding + (slug,))))
+        stamp = self._stamps[slug] = fingerprint(parts)
+        return stamp
+
+def write_file(path, data):
+    """write data (bytes) and its precompressed siblings"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(data)
+    compress_siblings(path, data)
+
+def remove_file(path):
+    for name in (path, path + '.gz', path + '.br'):
+        if os.path.isfile(name):
+            os.remove(name)
+
+def copy_file(source, target):
+    """copy source to target unless target is current, returns True if copied"""
+    st = os.stat(source)
+    if os.path.isfile(target):
+        tt = os.stat(target)
+        if tt.st_size == st.st_size and tt.st_mtime >= st.st_mtime:
+            return False
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    shutil.copy2(source, target)
+    compress_siblings(target)
+    return True
+
+def sync_tree(src, dst, exclude=()):
+    """copy new or changed files from src to dst, returns the number copied
+    exclude names top level directories of src to skip
+    """
+    copied = 0
+    if not os.path.isdir(src):
+        return copied
+    for root, dirs, files in os.walk(src):
+        if root == src:
+            dirs[:] = [d for d in dirs if d not in exclude]
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        for name in files:
+            if copy_file(os.path.join(root, name), os.path.join(target_root, name)):
+                copied += 1
+    return copied
+
+def sync_blobs(DB, upload_folder, dst):
+    """copy content-addressed uploads to the paths they are served at,
+    uploads/blob/<sha256>/<filename>, returns the number copied
+    """
+    blobs = BlobStore(os.path.join(upload_folder, BLOB_DIR), DB)
+    copied = 0
+    for f in DB.files.find():
+        blob = parse_blob_path(f.get('filepath') or '')
+        if blob is None or not os.path.isfile(blobs.path(blob[0])):
+            continue
+        if copy_file(blobs.path(blob[0]), os.path.join(dst, *f['filepath'].split('/'))):
+            copied += 1
+    return copied
+
+def sync_derived(upload_folder, dst):
+    """copy rendered image variants to the paths they are served at,
+    img/<sha256>/<width>.<fmt>, returns the number copied
+    """
+    copied = 0
+    for root, dirs, files in os.walk(os.path.join(upload_folder, DERIVED_DIR)):
+        for name in files:
+            match = DERIVED_NAME_RE.match(name)
+            if match is None:
+                continue
+            target = os.path.join(dst, os.path.basename(root), '{}.{}'.format(match.group(1), match.group(3)))
+            if copy_file(os.path.join(root, name), target):
+                copied += 1
+    return copied
+
+
+def _init_worker(config=None):
+    """process pool initializer, one app and test client per worker.
+    config is passed to create_app
+    """
+    global _client
+    from app import create_app
+    _client = create_app(config).test_client()
+
+def render_pages(output_dir, slugs, client=None):
+    """render pages through site() and write them, runs in a worker process
+    unless client (a test client of this process's app) is given
+    """
+    client = client or _client
+    done = []
+    for slug in slugs:
+        response = client.get('/' + slug)
+        if response.status_code == 200:
+            write_file(page_filename(output_dir, slug), response.get_data())
+            done.append(slug)
+        else:
+            print("export: skipped {} (HTTP {})".format(slug, response.status_code), file=sys.stderr)
+    return done
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def export_site(DB, output_dir, upload_folder, static_folder, workers=None, full=False, batch_size=50,
+                app_config=None, app=None):
+    """export published pages, uploads and static files into output_dir
+    returns a dict with counts of rendered, removed and copied files.
+    app_config is the create_app config of the render workers.  With app the
+    pages are rendered by it, in this process, and no workers are started
+    """
+    if app is None and (app_config or {}).get('DATABASE_BACKEND') == 'journal':
+        raise ValueError("the journal backend cannot be opened by export workers, pass the app")
+    output_dir = os.path.abspath(output_dir)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    manifest = {}
+    if os.path.isfile(manifest_path) and not full:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    meta = meta_stamp(DB.meta.find_one() or {})
+    page_stamps = PageStamps(DB)
+    previous = manifest.get('pages', {})
+    # pages of the last export, removed below if they are gone or unpublished
+    exported = list(previous)
+    if manifest.get('meta') != meta or manifest.get('menu') != page_stamps.menu:
+        # brand, stylesheet or menu changed, every page looks different
+        previous = {}
+
+    stamps = {}
+    for slug, page in sorted(page_stamps.pages.items()):
+        if page.get('is_published'):
+            stamps[slug] = page_stamps.stamp(slug)
+    stale = sorted(slug for slug, stamp in stamps.items()
+                   if previous.get(slug) != stamp or not os.path.isfile(page_filename(output_dir, slug)))
+
+    rendered = []
+    if stale and app is not None:
+        rendered = render_pages(output_dir, stale, app.test_client())
+    elif stale:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                    initargs=(app_config,)) as pool:
+            futures = [pool.submit(render_pages, output_dir, batch) for batch in chunks(stale, batch_size)]
+            for future in concurrent.futures.as_completed(futures):
+                rendered.extend(future.result())
+
+    removed = [slug for slug in exported if slug not in stamps]
+    for slug in removed:
+        remove_file(page_filename(output_dir, slug))
+
+    # blob files are copied under their public names, partial uploads not at all
+    copied = sync_tree(upload_folder, os.path.join(output_dir, 'uploads'), exclude=(BLOB_DIR, DERIVED_DIR, '.partial'))
+    copied += sync_blobs(DB, upload_folder, os.path.join(output_dir, 'uploads'))
+    copied += sync_derived(upload_folder, os.path.join(output_dir, 'img'))
+    copied += sync_tree(static_folder, os.path.join(output_dir, 'static'))
+
+    # pages that failed to render are retried next time
+    pages = dict((slug, stamp) for slug, stamp in stamps.items()
+                 if slug in rendered or (slug not in stale and slug in previous))
+    with open(manifest_path, 'w') as f:
+        json.dump({'meta': meta, 'menu': page_stamps.menu, 'pages': pages}, f, indent=1, sort_keys=True)
+
+    return {'rendered': len(rendered), 'removed': len(removed), 'copied': copied}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="export the published site as static files")
+    parser.add_argument('output_dir', help="directory to write the site into")
+    parser.add_argument('--workers', type=int, default=None, help="render processes (default: one per CPU)")
+    parser.add_argument('--full', action='store_true', help="re-render every page, ignore the previous export")
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    app = create_app()
+    # only this process may open a journal database, it renders the pages itself
+    in_process = app.config.get('DATABASE_BACKEND') == 'journal'
+    result = export_site(app.extensions['fpress'].db, args.output_dir,
+                         upload_folder=app.config['UPLOAD_FOLDER'],
+                         static_folder=app.static_folder,
+                         workers=args.workers, full=args.full,
+                         app=app if in_process else None)
+    print("{rendered} pages rendered, {removed} removed, {copied} files copied".format(**result))
+
+if __name__ == '__main__':
+    main()
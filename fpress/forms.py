@@ -4,7 +4,7 @@ from wtforms import (StringField, PasswordField, SubmitField,
                      BooleanField, TextAreaField, HiddenField, SelectField)
 from flask_ckeditor import CKEditorField
 from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
-from werkzeug.security import generate_password_hash
+from users import hash_password
 from utils import slugify
 import os
 
@@ -41,8 +41,8 @@ def username_exists(form, field):
 def autohash(form, field):
     """hash password if necessary"""
     # check hashing type, rehash if not hashed
-    if not ('pbkdf2:sha256' in field.data):
-        field.data = generate_password_hash(field.data)
+    if not (field.data.startswith(('pbkdf2:', 'scrypt:')) and field.data.count('$') == 2):
+        field.data = hash_password(field.data)
         
 def autoslug(form, field):
     """if slug is empty, autoslug it"""
@@ -103,10 +103,8 @@ class PageInfoForm(BaseForm):
                        validators=[autoslug])
     is_published = BooleanField('is published')
     theme = SelectField('Theme selector', choices=theme_choices)
-    # maybe add markdown later--
-    # markdown would be a good choice for unprivileged editors
-    # but... we can put a safety filter on HTML as it goes into the database, it could strip script tags
-    # is_markdown = BooleanField('use markdown format')
+    # Markdown is rendered and sanitized at save, a good choice for unprivileged editors (see markup.py)
+    is_markdown = BooleanField('use Markdown format')
     
 class PageForm(PageInfoForm):
     """Inherits PageInfoForm, non-HTML"""
@@ -0,0 +1,276 @@
+# images.py
+# resized / re-encoded variants (derivatives) of uploaded images
+#
+# After an image upload the configured widths are rendered in a small process
+# pool, so the request does not wait and a slow resize cannot starve the web
+# workers.  Derivatives are served from /img/<sha256>/<width>.<fmt> and live
+# in UPLOAD_FOLDER/derived/ab/<sha256>/<width>w-q<quality>.<fmt>, so they are
+# keyed by the source content and every rendering parameter.  A request for
+# one that does not exist yet is answered with the original while it renders
+# in the background.  When no variant is needed (the image is not wider than
+# the width, animated or unreadable) an empty <name>.none marker records it,
+# so the work is not submitted again.  The folder is kept below max_bytes by
+# evicting the least recently served files.
+#
+# Needs Pillow (pip install Pillow).  Without it nothing is generated and
+# /img/ serves the original file.
+import concurrent.futures
+import os
+import re
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DERIVED_DIR = 'derived'
+IMAGE_TYPES = set(['image/png', 'image/jpeg', 'image/gif'])
+# format => (Pillow format name, content type)
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+}
+# a served derivative's mtime is refreshed (for LRU eviction) at most this often
+TOUCH_INTERVAL = 3600
+
+# suffix of the marker of a derivative that is not needed
+NO_VARIANT = '.none'
+
+# file name of a derivative: <width>w-q<quality>.<fmt>
+DERIVED_NAME_RE = re.compile(r'^(\d+)w-q(\d+)\.(\w+)$')
+IMG_TAG_RE = re.compile(r'<img\b[^>]*>', re.IGNORECASE)
+SRC_RE = re.compile(r'''\bsrc\s*=\s*(["'])(.*?)\1''', re.IGNORECASE | re.DOTALL)
+
+
+def image_size(path):
+    """(width, height) of an image file, None if Pillow is missing or the file is no image"""
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except (IOError, OSError, ValueError):
+        return None
+
+def write_marker(target):
+    """record that target is not needed"""
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    open(target + NO_VARIANT, 'wb').close()
+
+def render_derivative(source, target, width, fmt, quality):
+    """resize source to width (never up) and save it as fmt at target.
+    runs in a pool process.  returns False for images that are not resized
+    (animated gifs, images narrower than width, files Pillow cannot read),
+    leaving a marker for them
+    """
+    try:
+        with Image.open(source) as img:
+            if getattr(img, 'is_animated', False) or img.size[0] <= width:
+                resized = None
+            else:
+                height = max(1, round(img.size[1] * width / float(img.size[0])))
+                if fmt == 'jpeg' and img.mode not in ('RGB', 'L'):
+                    img = img.convert('RGB')
+                elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                    img = img.convert('RGBA')
+                resized = img.resize((width, height), Image.LANCZOS)
+    except FileNotFoundError:
+        # nothing is known about the image yet
+        raise
+    except (IOError, OSError, ValueError):
+        resized = None
+    if resized is None:
+        write_marker(target)
+        return False
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = '{}.{}.tmp'.format(target, os.getpid())
+    resized.save(tmp, FORMATS[fmt][0], quality=quality, optimize=True)
+    os.replace(tmp, target)
+    return True
+
+
+class DerivativeStore(object):
+    """renders, caches and evicts image derivatives"""
+    def __init__(self, directory, widths=(320, 640, 1280), fmt='webp', quality=80,
+                 max_bytes=512 * 1024 * 1024, workers=2, queue_limit=64):
+        self.directory = directory
+        self.widths = tuple(sorted(widths))
+        self.fmt = fmt
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._pool = None
+        # relative path => future of the rendering in progress
+        self._pending = {}
+        # re-entrant: a future that is already done runs its callback at once
+        self._lock = threading.RLock()
+        # bytes in directory, measured on the first rendering
+        self._size = None
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def relpath(self, sha256, width, fmt=None):
+        name = '{}w-q{}.{}'.format(width, self.quality, fmt or self.fmt)
+        return os.path.join(sha256[:2], sha256, name)
+
+    def url_path(self, sha256, width, fmt=None):
+        """public path of a derivative, below /img/"""
+        return '{}/{}.{}'.format(sha256, width, fmt or self.fmt)
+
+    def _executor(self):
+        # created on first use, after a preforking server has forked
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def _submit(self, source, sha256, width, fmt):
+        """future rendering a derivative, None if the queue is full (lock held)"""
+        rel = self.relpath(sha256, width, fmt)
+        future = self._pending.get(rel)
+        if future is not None:
+            return future
+        if len(self._pending) >= self.queue_limit:
+            return None
+        future = self._executor().submit(render_derivative, source, os.path.join(self.directory, rel),
+                                         width, fmt, self.quality)
+        self._pending[rel] = future
+        future.add_done_callback(lambda f: self._rendered(rel, f))
+        return future
+
+    def _rendered(self, rel, future):
+        with self._lock:
+            self._pending.pop(rel, None)
+        if future.cancelled() or future.exception() is not None or not future.result():
+            return
+        try:
+            added = os.path.getsize(os.path.join(self.directory, rel))
+        except OSError:
+            return
+        with self._lock:
+            # callbacks of several renderings finish at once, the count is shared
+            if self._size is None:
+                self.start_accounting()
+                return
+            self._size += added
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def schedule(self, source, sha256, image_width=None):
+        """render every configured width of a new upload in the background"""
+        if not self.available:
+            return
+        with self._lock:
+            for width in self.widths:
+                if image_width is not None and width >= image_width:
+                    break
+                path = os.path.join(self.directory, self.relpath(sha256, width))
+                if not (os.path.isfile(path) or os.path.isfile(path + NO_VARIANT)):
+                    if self._submit(source, sha256, width, self.fmt) is None:
+                        break
+
+    def pending(self, sha256, width, fmt=None):
+        """True while a derivative is rendering in this process"""
+        with self._lock:
+            return self.relpath(sha256, width, fmt) in self._pending
+
+    def get(self, source, sha256, width, fmt=None, image_width=None):
+        """path of a derivative relative to directory, None when there is none yet
+        (rendering in the background, busy, failed) or none is needed (no Pillow,
+        image_width or the image not wider than width); the caller serves the original then
+        """
+        fmt = fmt or self.fmt
+        if not self.available or width not in self.widths or fmt not in FORMATS:
+            return None
+        if image_width is not None and width >= image_width:
+            return None
+        rel = self.relpath(sha256, width, fmt)
+        path = os.path.join(self.directory, rel)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        if mtime is not None:
+            now = time.time()
+            if now - mtime > TOUCH_INTERVAL:
+                os.utime(path, (now, now))
+            return rel
+        if os.path.isfile(path + NO_VARIANT):
+            return None
+        with self._lock:
+            self._submit(source, sha256, width, fmt)
+        return None
+
+    def _files(self):
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st
+
+    def evict(self):
+        """delete least recently served derivatives until below 90% of max_bytes"""
+        with self._lock:
+            files = sorted(self._files(), key=lambda item: item[1].st_mtime)
+            size = sum(st.st_size for path, st in files)
+            for path, st in files:
+                if size <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= st.st_size
+            self._size = size
+
+    def start_accounting(self):
+        """measure the folder once, later additions are counted as they happen"""
+        with self._lock:
+            if self._size is None:
+                self._size = sum(st.st_size for path, st in self._files())
+                if self._size > self.max_bytes:
+                    self.evict()
+
+    def srcset(self, url, sha256, image_width):
+        """srcset value for an image: the derivatives narrower than the image plus the original"""
+        candidates = ['/img/{} {}w'.format(self.url_path(sha256, width), width)
+                      for width in self.widths if width < image_width]
+        if not candidates:
+            return None
+        candidates.append('{} {}w'.format(url, image_width))
+        return ', '.join(candidates)
+
+    def rewrite_content(self, content, lookup):
+        """add srcset/sizes to <img> tags of html content.
+        lookup(src) returns the file object of an uploaded image or None
+        """
+        def rewrite(match):
+            tag = match.group(0)
+            if 'srcset' in tag.lower():
+                return tag
+            src = SRC_RE.search(tag)
+            if src is None:
+                return tag
+            f = lookup(src.group(2))
+            if not f or not f.get('sha256') or not f.get('width'):
+                return tag
+            srcset = self.srcset(src.group(2), f['sha256'], f['width'])
+            if srcset is None:
+                return tag
+            end = -2 if tag.endswith('/>') else -1
+            return '{} srcset="{}" sizes="(max-width: {w}px) 100vw, {w}px"{}'.format(
+                tag[:end].rstrip(), srcset, tag[end:], w=f['width'])
+        return IMG_TAG_RE.sub(rewrite, content)
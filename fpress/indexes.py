@@ -0,0 +1,478 @@
+# indexes.py
+# in-memory secondary indexes over the storage backend collections
+#
+# TinyMongo answers every find_one() by scanning the whole collection.  The
+# IndexedDatabase below wraps the database (see storage.py), keeps an in-memory copy of
+# each collection it touches and maintains hash indexes over the fields we
+# look things up by (slug, username, owner), so those lookups are O(1).
+# All writes must go through the wrapper to keep the indexes consistent.
+# With several worker processes, pass a coherence.SharedState: writes are then
+# serialized across processes and copies changed by another process are reloaded.
+#
+# find_page() serves listings: sorted, keyset (cursor) paginated and projected
+# to a few fields.  The sort order of each field asked for is kept as a sorted
+# list that writes update with bisect, so any page of a listing is cheap.
+import base64
+import bisect
+import contextlib
+import copy
+import json
+import threading
+
+from storage import apply_update
+
+# collection name => list of (field, unique)
+INDEXES = {
+    'pages': [('slug', True), ('owner', False)],
+    'users': [('username', True)],
+    'files': [('owner', False), ('sha256', False), ('url', False)],
+}
+
+SCALAR_TYPES = (str, int, float, bool)
+
+
+class DuplicateKeyError(ValueError):
+    """raised when a write would break a unique index"""
+    def __init__(self, collection, field, value):
+        self.collection = collection
+        self.field = field
+        self.value = value
+        msg = "duplicate {}.{} value: {!r}".format(collection, field, value)
+        super(DuplicateKeyError, self).__init__(msg)
+
+
+def indexable(value):
+    """only plain scalar values are indexed (missing/None/list values are not)"""
+    return value is not None and isinstance(value, SCALAR_TYPES)
+
+def is_plain_filter(query):
+    """True if query is a simple {field: value} equality filter TinyMongo would match literally"""
+    for key, value in query.items():
+        if key.startswith('$') or '.' in key or isinstance(value, (dict, list)):
+            return False
+    return True
+
+def has_operators(doc):
+    """True if doc is an update document ($set etc.) rather than a replacement"""
+    return any(key.startswith('$') for key in doc)
+
+def copy_doc(doc, fields=None):
+    """copy of a cached document, so callers can change it freely.
+    fields limits the copy to those fields (and _id)
+    """
+    if fields is not None:
+        doc = {k: doc[k] for k in doc if k in fields or k == '_id'}
+    return {k: (copy.deepcopy(v) if isinstance(v, (dict, list)) else v) for k, v in doc.items()}
+
+def sort_key(value):
+    """total order over the values a field can hold: missing, numbers, text (case-insensitive), other"""
+    if value is None:
+        return (0,)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value.lower(), value)
+    return (3, json.dumps(value, sort_keys=True, default=str))
+
+def encode_cursor(value, _id):
+    """opaque listing cursor for the position after a document"""
+    raw = json.dumps([value, _id], default=str).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """(value, _id) of a cursor, ValueError if it is garbage"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, _id = json.loads(raw.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError("invalid cursor")
+    return value, _id
+
+
+class HashIndex(object):
+    """maps a field value to the _ids of the documents holding it.
+    A unique index maps to a single _id. Ids are kept in insertion order
+    so lookups return documents in the same order a scan would.
+    """
+    def __init__(self, field, unique=False):
+        self.field = field
+        self.unique = unique
+        self.entries = {}
+
+    def lookup(self, value):
+        """list of _ids with field == value"""
+        if self.unique:
+            _id = self.entries.get(value)
+            return [] if _id is None else [_id]
+        return list(self.entries.get(value, ()))
+
+    def owner(self, value):
+        """_id holding value in a unique index (or None)"""
+        return self.entries.get(value)
+
+    def add(self, doc):
+        value = doc.get(self.field)
+        if not indexable(value):
+            return
+        if self.unique:
+            # first document wins, same as the find_one() it replaces
+            self.entries.setdefault(value, doc['_id'])
+        else:
+            self.entries.setdefault(value, {})[doc['_id']] = True
+
+    def discard(self, doc):
+        value = doc.get(self.field)
+        if not indexable(value):
+            return
+        if self.unique:
+            if self.entries.get(value) == doc['_id']:
+                del self.entries[value]
+        else:
+            ids = self.entries.get(value)
+            if ids is not None:
+                ids.pop(doc['_id'], None)
+                if not ids:
+                    del self.entries[value]
+
+    def clear(self):
+        self.entries = {}
+
+
+class IndexedCollection(object):
+    """wraps a backend collection with an in-memory copy and hash indexes.
+    Supports the calls the app makes: find, find_one, find_page, insert_one,
+    insert, update_one, update_many, delete_many and remove.  Filters that are not plain equality
+    filters are handed to the backend untouched.
+    """
+    def __init__(self, collection, name, indexes=(), shared=None):
+        self.collection = collection
+        self.name = name
+        self.indexes = {field: HashIndex(field, unique) for field, unique in indexes}
+        self.shared = shared
+        self._docs = None
+        # field => sorted list of (sort_key(value), _id), see find_page
+        self._orders = {}
+        self._lock = threading.RLock()
+        # generation (see coherence.py) our copy corresponds to
+        self._generation = None
+        # number of times another process changed the collection under us
+        self._epoch = 0
+
+    # ---- loading -------------------------------------------------------
+
+    def _load(self):
+        """read the whole collection once and build the indexes"""
+        with self._lock:
+            if self._docs is None:
+                docs = {}
+                for doc in self.collection.find():
+                    docs[doc['_id']] = dict(doc)
+                for index in self.indexes.values():
+                    index.clear()
+                    for doc in docs.values():
+                        index.add(doc)
+                self._orders = {}
+                self._docs = docs
+            return self._docs
+
+    def reload(self):
+        """drop the in-memory copy, it is rebuilt on next access"""
+        with self._lock:
+            self._docs = None
+
+    def _sync(self):
+        """drop our copy if another process wrote to the collection"""
+        if self.shared is None:
+            return
+        generation = self.shared.generation(self.name)
+        if generation != self._generation:
+            if self._generation is not None:
+                # backends caching reads (TinyDB's query cache) must re-read the file too
+                refresh = getattr(self.collection, 'refresh', None)
+                if refresh is not None:
+                    refresh()
+                self._docs = None
+                self._epoch += 1
+            self._generation = generation
+
+    def epoch(self):
+        """changes made by other processes so far. Caches built from this
+        collection compare it to know when to throw themselves away
+        (changes made by this process are announced by the app directly)
+        """
+        with self._lock:
+            self._sync()
+            return self._epoch
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """hold the write lock(s), bring our copy up to date first and
+        announce the write to other processes afterwards"""
+        with self._lock:
+            if self.shared is None:
+                yield
+                return
+            with self.shared.lock:
+                self._sync()
+                try:
+                    yield
+                finally:
+                    self._generation = self.shared.bump(self.name)
+
+    def _cache(self, doc):
+        if self._docs is not None:
+            self._docs[doc['_id']] = doc
+            for index in self.indexes.values():
+                index.add(doc)
+            for field, order in self._orders.items():
+                bisect.insort(order, (sort_key(doc.get(field)), doc['_id']))
+
+    def _uncache(self, _id):
+        if self._docs is not None:
+            doc = self._docs.pop(_id, None)
+            if doc is not None:
+                for index in self.indexes.values():
+                    index.discard(doc)
+                for field, order in self._orders.items():
+                    entry = (sort_key(doc.get(field)), _id)
+                    i = bisect.bisect_left(order, entry)
+                    if i < len(order) and order[i] == entry:
+                        del order[i]
+
+    # ---- queries -------------------------------------------------------
+
+    def _match_ids(self, query):
+        """_ids of documents matching a plain equality filter"""
+        docs = self._load()
+        if not query:
+            return list(docs)
+        if '_id' in query:
+            candidates = [query['_id']] if query['_id'] in docs else []
+        else:
+            candidates = None
+            for field, value in query.items():
+                if field in self.indexes and indexable(value):
+                    candidates = self.indexes[field].lookup(value)
+                    break
+            if candidates is None:
+                candidates = docs
+        return [_id for _id in candidates
+                if all(docs[_id].get(k) == v for k, v in query.items())]
+
+    def find(self, filter=None, *args, **kwargs):
+        """list of documents matching filter"""
+        query = filter or {}
+        if args or kwargs or not is_plain_filter(query):
+            return list(self.collection.find(query, *args, **kwargs))
+        with self._lock:
+            self._sync()
+            docs = self._load()
+            return [copy_doc(docs[_id]) for _id in self._match_ids(query)]
+
+    def find_one(self, filter=None, *args, **kwargs):
+        """first document matching filter or None"""
+        query = filter or {}
+        if args or kwargs or not is_plain_filter(query):
+            return self.collection.find_one(query, *args, **kwargs)
+        with self._lock:
+            self._sync()
+            docs = self._load()
+            ids = self._match_ids(query)
+            return copy_doc(docs[ids[0]]) if ids else None
+
+    def _order(self, field):
+        """sorted (sort_key, _id) list of field, built on first use"""
+        order = self._orders.get(field)
+        if order is None:
+            order = sorted((sort_key(doc.get(field)), _id) for _id, doc in self._load().items())
+            self._orders[field] = order
+        return order
+
+    def find_page(self, filter=None, sort='_id', descending=False, after=None, limit=50, fields=None):
+        """one page of a sorted listing, keyset paginated.
+        after is the cursor returned with the previous page, fields the
+        fields to return (all if None).
+        returns (list of documents, cursor of the next page or None)
+        """
+        query = filter or {}
+        with self._lock:
+            self._sync()
+            docs = self._load()
+            order = self._order(sort)
+            if not query:
+                allowed = None
+            elif is_plain_filter(query):
+                allowed = set(self._match_ids(query))
+            else:
+                allowed = set(doc['_id'] for doc in self.collection.find(query))
+            if after is None:
+                start = len(order) - 1 if descending else 0
+            else:
+                value, _id = decode_cursor(after)
+                position = (sort_key(value), _id)
+                if descending:
+                    start = bisect.bisect_left(order, position) - 1
+                else:
+                    start = bisect.bisect_right(order, position)
+            step = -1 if descending else 1
+            ids = []
+            i = start
+            while 0 <= i < len(order) and len(ids) <= limit:
+                _id = order[i][1]
+                if allowed is None or _id in allowed:
+                    ids.append(_id)
+                i += step
+            next_cursor = None
+            if len(ids) > limit:
+                ids = ids[:limit]
+                next_cursor = encode_cursor(docs[ids[-1]].get(sort), ids[-1])
+            return [copy_doc(docs[_id], fields) for _id in ids], next_cursor
+
+    # ---- writes --------------------------------------------------------
+
+    def _check_unique(self, doc, _id=None):
+        """raise DuplicateKeyError if doc collides with another document"""
+        for field, index in self.indexes.items():
+            if not index.unique:
+                continue
+            value = doc.get(field)
+            if indexable(value):
+                owner = index.owner(value)
+                if owner is not None and owner != _id:
+                    raise DuplicateKeyError(self.name, field, value)
+
+    def _updated(self, doc, update):
+        """copy of doc with the update document applied, None for an operator we
+        do not mirror (the backend applies it and the result is re-read)
+        """
+        try:
+            return apply_update(copy_doc(doc), update)
+        except NotImplementedError:
+            if any(index.unique for index in self.indexes.values()):
+                # the unique check has to happen before the write, refuse it
+                raise
+            return None
+
+    def insert_one(self, doc):
+        with self._writing():
+            if any(index.unique for index in self.indexes.values()):
+                self._load()
+                self._check_unique(doc)
+            result = self.collection.insert_one(doc)
+            doc['_id'] = result.inserted_id
+            self._cache(dict(doc))
+            return result
+
+    def insert(self, docs):
+        """legacy TinyMongo insert, a document or a list of documents"""
+        if isinstance(docs, list):
+            return [self.insert_one(doc) for doc in docs]
+        return self.insert_one(docs)
+
+    def update_one(self, filter, doc):
+        """update the first match. doc is either an update document ($set ...)
+        or, like the old TinyMongo accepted, a whole replacement document
+        """
+        with self._writing():
+            docs = self._load()
+            if is_plain_filter(filter):
+                ids = self._match_ids(filter)
+            else:
+                found = self.collection.find_one(filter)
+                ids = [found['_id']] if found else []
+            if not ids:
+                return None
+            _id = ids[0]
+            if has_operators(doc):
+                current = docs.get(_id) or self.collection.find_one({'_id': _id})
+                new_doc = self._updated(current, doc)
+                if new_doc is not None:
+                    # checked before the write, a collision must not reach storage
+                    self._check_unique(new_doc, _id)
+                result = self.collection.update_one({'_id': _id}, doc)
+                if new_doc is None:
+                    new_doc = dict(self.collection.find_one({'_id': _id}))
+            else:
+                new_doc = dict(doc)
+                new_doc['_id'] = _id
+                self._check_unique(new_doc, _id)
+                result = self.collection.update_one({'_id': _id}, new_doc)
+            self._uncache(_id)
+            self._cache(new_doc)
+            return result
+
+    def update_many(self, filter, update):
+        """apply an update document ($set ...) to every match, one backend write"""
+        if not has_operators(update):
+            raise ValueError("update_many needs an update document ($set/$unset)")
+        with self._writing():
+            docs = self._load()
+            query = filter or {}
+            if is_plain_filter(query):
+                ids = self._match_ids(query)
+            else:
+                ids = [doc['_id'] for doc in self.collection.find(query)]
+            new_docs = [self._updated(docs[_id], update) for _id in ids]
+            if None in new_docs:
+                new_docs = None
+            else:
+                # a unique field set on several documents collides with itself
+                for field, index in self.indexes.items():
+                    if index.unique and field in update.get('$set', {}) and len(ids) > 1:
+                        raise DuplicateKeyError(self.name, field, update['$set'][field])
+                for new_doc in new_docs:
+                    self._check_unique(new_doc, new_doc['_id'])
+            result = self.collection.update_many(query, update)
+            if new_docs is None:
+                self._docs = None
+            else:
+                for new_doc in new_docs:
+                    self._uncache(new_doc['_id'])
+                    self._cache(new_doc)
+            return result
+
+    def _delete(self, method, filter):
+        with self._writing():
+            query = filter or {}
+            if is_plain_filter(query):
+                ids = self._match_ids(query)
+            else:
+                ids = [doc['_id'] for doc in self.collection.find(query)]
+            result = getattr(self.collection, method)(query)
+            for _id in ids:
+                self._uncache(_id)
+            return result
+
+    def delete_many(self, filter):
+        return self._delete('delete_many', filter)
+
+    def remove(self, filter):
+        return self._delete('remove', filter)
+
+
+class IndexedDatabase(object):
+    """wraps a storage backend, collections are IndexedCollections
+    e.g. IndexedDatabase(TinyMongoBackend()).pages.find_one({'slug':'home'})
+    """
+    def __init__(self, db, indexes=None, shared=None):
+        self.db = db
+        self.indexes = INDEXES if indexes is None else indexes
+        self.shared = shared
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            with self._lock:
+                collection = self._collections.get(name)
+                if collection is None:
+                    collection = IndexedCollection(self.db[name], name, self.indexes.get(name, ()),
+                                                   shared=self.shared)
+                    self._collections[name] = collection
+        return collection
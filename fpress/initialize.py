@@ -1,8 +1,9 @@
 # initialize.py
-from users import create_user
+from indexes import DuplicateKeyError
+from users import create_user, hash_password
 from utils import token_generator
 
-def initialize(DB):
+def initialize(DB, hasher=hash_password):
     """initialize the app"""
     # this is called before the app starts
     # we're using a separte function because it has hashing and checking
@@ -11,7 +12,7 @@ def initialize(DB):
     password = 'admin'
     u  = create_user(DB, username=admin,
                      password=password,
-                     is_admin=True)
+                     is_admin=True, hasher=hasher)
     if u:
         # replace with a randomization
         print('WRITE THIS DOWN!')
@@ -19,19 +20,26 @@ def initialize(DB):
         
     # These are the default HOME and ABOUT pages-- can be easily changed later.
     # will not overwrite existing home and about pages.
+    # (a DuplicateKeyError means another worker process created the page first)
     p = DB.pages.find_one({'slug':'home'})
     if p is None:
         # create only if page IS NOT present
-        DB.pages.insert_one({'slug':'home', 'title':'Home', 'owner':'admin',
-                             'content':'<b>Welcome, please change me.</b>  I am the <i>default</i> Home page!', 
-                             'is_markdown':False, 'owner':'admin', 'show_nav':True, 'is_published': True})
-        print("default HOME page created")
+        try:
+            DB.pages.insert_one({'slug':'home', 'title':'Home', 'owner':'admin',
+                                 'content':'<b>Welcome, please change me.</b>  I am the <i>default</i> Home page!', 
+                                 'is_markdown':False, 'owner':'admin', 'show_nav':True, 'is_published': True})
+            print("default HOME page created")
+        except DuplicateKeyError:
+            pass
     p = DB.pages.find_one({'slug':'about'})
     if p is None:
-        DB.pages.insert_one({'slug':'about', 'title':'About', 'owner':'admin',
-                             'content':'<b>Welcome</b>, please change me.  I am the <i>default</i> boilerplate About page.',
-                             'is_markdown':False, 'owner':'admin', 'show_nav':True, 'is_published': True})
-        print("default ABOUT page created")
+        try:
+            DB.pages.insert_one({'slug':'about', 'title':'About', 'owner':'admin',
+                                 'content':'<b>Welcome</b>, please change me.  I am the <i>default</i> boilerplate About page.',
+                                 'is_markdown':False, 'owner':'admin', 'show_nav':True, 'is_published': True})
+            print("default ABOUT page created")
+        except DuplicateKeyError:
+            pass
         
     m = DB.meta.find_one({})
     if m is None:
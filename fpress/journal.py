@@ -0,0 +1,363 @@
+# journal.py
+# journaled JSON store: append-only write log, group commit, background compaction
+#
+# TinyMongo serializes and rewrites the whole database file on every write.
+# The journal backend keeps all collections in memory and turns each write into
+# one appended JSON line in <name>.journal.  Appends are fsync()ed by a commit
+# thread that waits a short window (commit_window) to batch the writes of
+# concurrent requests into one fsync (group commit); a writer returns once its
+# line is durable.  The fsync runs without the journal lock, so writers keep
+# appending (into the next batch) while a batch is synced.  On startup <name>.snapshot.json is loaded and the journal
+# replayed on top of it.  A compaction thread folds the journal into a new
+# snapshot once it grows past compact_bytes.
+#
+# Every journal line holds the complete new state of one document (or a
+# delete), so replaying a line twice is harmless.  A journal ending in a torn
+# line (a crash mid-append, never acknowledged) is folded into the snapshot at
+# startup, so new lines are never appended after the torn one.  This makes compaction
+# crash safe: the journal is rotated to <name>.journal.old, the snapshot is
+# written, then the old journal is removed.
+#
+# The journal backend is for a single process (MULTIPROCESS = False).
+import atexit
+import collections
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+from storage import (COLLECTIONS, InsertOneResult, UpdateResult, DeleteResult,
+                     new_id, has_operators, apply_update)
+
+log = logging.getLogger('fpress.journal')
+
+
+def matches(doc, query):
+    """plain {field: value} equality match"""
+    for field, value in query.items():
+        if field.startswith('$') or isinstance(value, dict):
+            raise NotImplementedError("query operators are not supported by the journal backend")
+        if doc.get(field) != value:
+            return False
+    return True
+
+
+class Journal(object):
+    """append-only log file with group commit"""
+    def __init__(self, path, commit_window=0.002, fsync=True):
+        self.path = path
+        self.commit_window = commit_window
+        self.fsync = fsync
+        self.file = open(path, 'ab')
+        self._cond = threading.Condition()
+        # held from flush to fsync, so the file is not swapped or closed in between
+        self._commit_lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._commit_loop, name='journal-commit')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, record):
+        """write a record, returns its sequence number for wait()"""
+        line = json.dumps(record, default=str).encode('utf-8') + b'\n'
+        with self._cond:
+            self.file.write(line)
+            self._written += 1
+            self._cond.notify_all()
+            return self._written
+
+    def wait(self, seq):
+        """block until record seq is on disk"""
+        with self._cond:
+            while self._synced < seq and not self._closed:
+                self._cond.wait()
+
+    def _commit_loop(self):
+        while True:
+            with self._cond:
+                while self._synced == self._written and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            # let concurrent writers join this commit
+            if self.commit_window:
+                time.sleep(self.commit_window)
+            self._commit()
+
+    def _commit(self):
+        """make the lines written so far durable, then wake their writers"""
+        with self._commit_lock:
+            with self._cond:
+                if self._closed:
+                    return
+                target = self._written
+                self.file.flush()
+                fileno = self.file.fileno()
+            if self.fsync:
+                os.fsync(fileno)
+            with self._cond:
+                self._synced = max(self._synced, target)
+                self._cond.notify_all()
+
+    def _commit_all(self):
+        """commit everything written, lock and commit lock held"""
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self._synced = self._written
+        self._cond.notify_all()
+
+    def rotate(self, old_path):
+        """commit, move the log to old_path and start an empty one.
+        rare (compaction), so writers wait for this fsync
+        """
+        with self._commit_lock, self._cond:
+            self._commit_all()
+            self.file.close()
+            os.replace(self.path, old_path)
+            self.file = open(self.path, 'ab')
+
+    def size(self):
+        with self._cond:
+            return self.file.tell()
+
+    def close(self):
+        with self._commit_lock, self._cond:
+            if self._closed:
+                return
+            self._commit_all()
+            self._closed = True
+            self.file.close()
+            self._cond.notify_all()
+
+
+class JournalCollection(object):
+    """a collection held in memory, writes go to the backend's journal"""
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    @property
+    def docs(self):
+        return self.backend.collections.setdefault(self.name, collections.OrderedDict())
+
+    def find(self, filter=None, *args, **kwargs):
+        query = filter or {}
+        with self.backend.lock:
+            return [copy.deepcopy(doc) for doc in self.docs.values() if matches(doc, query)]
+
+    def find_one(self, filter=None, *args, **kwargs):
+        query = filter or {}
+        with self.backend.lock:
+            if '_id' in query:
+                doc = self.docs.get(query['_id'])
+                return copy.deepcopy(doc) if doc is not None and matches(doc, query) else None
+            for doc in self.docs.values():
+                if matches(doc, query):
+                    return copy.deepcopy(doc)
+        return None
+
+    def insert_one(self, doc):
+        return self.insert([doc])[0]
+
+    def insert(self, docs):
+        """a document or a list of documents, a list costs one commit"""
+        single = not isinstance(docs, list)
+        if single:
+            docs = [docs]
+        if not docs:
+            return []
+        with self.backend.lock:
+            for doc in docs:
+                if doc.get('_id') is None:
+                    doc['_id'] = new_id()
+                stored = copy.deepcopy(doc)
+                self.docs[stored['_id']] = stored
+                seq = self.backend.log('put', self.name, stored)
+        self.backend.journal.wait(seq)
+        results = [InsertOneResult(doc['_id']) for doc in docs]
+        return results[0] if single else results
+
+    def update_one(self, filter, doc):
+        """$set/$unset update or whole replacement of the first match"""
+        with self.backend.lock:
+            current = self.find_one(filter)
+            if current is None:
+                return UpdateResult(0, 0)
+            if has_operators(doc):
+                new_doc = apply_update(copy.deepcopy(current), doc)
+            else:
+                new_doc = copy.deepcopy(doc)
+            new_doc['_id'] = current['_id']
+            self.docs[new_doc['_id']] = new_doc
+            seq = self.backend.log('put', self.name, new_doc)
+        self.backend.journal.wait(seq)
+        return UpdateResult(1, int(new_doc != current))
+
+    def update_many(self, filter, doc):
+        """$set/$unset update of every match, the lines share one commit"""
+        if not has_operators(doc):
+            raise ValueError("update_many needs an update document ($set/$unset)")
+        query = filter or {}
+        seq = None
+        matched = modified = 0
+        with self.backend.lock:
+            for current in [d for d in self.docs.values() if matches(d, query)]:
+                matched += 1
+                new_doc = apply_update(copy.deepcopy(current), doc)
+                if new_doc == current:
+                    continue
+                modified += 1
+                self.docs[new_doc['_id']] = new_doc
+                seq = self.backend.log('put', self.name, new_doc)
+        if seq is not None:
+            self.backend.journal.wait(seq)
+        return UpdateResult(matched, modified)
+
+    def delete_many(self, filter):
+        query = filter or {}
+        with self.backend.lock:
+            ids = [_id for _id, doc in self.docs.items() if matches(doc, query)]
+            if not ids:
+                return DeleteResult(0)
+            for _id in ids:
+                del self.docs[_id]
+            seq = self.backend.log('delete', self.name, ids)
+        self.backend.journal.wait(seq)
+        return DeleteResult(len(ids))
+
+    def remove(self, filter):
+        return self.delete_many(filter)
+
+
+class JournalBackend(object):
+    """all collections in memory, persisted as snapshot + journal in a folder"""
+    def __init__(self, path='journaldb', name='blog', commit_window=0.002, fsync=True,
+                 compact_bytes=4 * 1024 * 1024, compact_interval=30):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.snapshot_path = os.path.join(path, name + '.snapshot.json')
+        self.journal_path = os.path.join(path, name + '.journal')
+        self.old_journal_path = self.journal_path + '.old'
+        self.compact_bytes = compact_bytes
+        self.compact_interval = compact_interval
+        self.lock = threading.RLock()
+        self.collections = {}
+        self._compacting = threading.Lock()
+        self._collection_objects = {}
+
+        # a torn last line must not have new records appended after it,
+        # replay would stop there and lose them
+        torn = self._load()
+        if torn or os.path.isfile(self.old_journal_path):
+            self._checkpoint()
+        self.journal = Journal(self.journal_path, commit_window, fsync)
+        self._stop = threading.Event()
+        self._compactor = threading.Thread(target=self._compact_loop, name='journal-compact')
+        self._compactor.daemon = True
+        self._compactor.start()
+        atexit.register(self.close)
+
+    # ---- startup -------------------------------------------------------
+
+    def _load(self):
+        """load the snapshot and replay the journals, True if one ended in a torn line"""
+        torn = False
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            for name, docs in snapshot.items():
+                self.collections[name] = collections.OrderedDict((doc['_id'], doc) for doc in docs)
+        # a leftover .old journal means we crashed during compaction, it still
+        # has to be replayed (harmless if the snapshot already contains it)
+        for path in (self.old_journal_path, self.journal_path):
+            if os.path.isfile(path):
+                torn = not self._replay(path) or torn
+        return torn
+
+    def _write_snapshot(self, state):
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+    def _checkpoint(self):
+        """write everything loaded at startup into the snapshot, drop both journals"""
+        self._write_snapshot(dict((name, list(docs.values())) for name, docs in self.collections.items()))
+        for path in (self.old_journal_path, self.journal_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _replay(self, path):
+        """apply the records of a journal, False if it ends in a torn line"""
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("no end of line")
+                    record = json.loads(line)
+                except ValueError:
+                    # torn write at the end of the log, it was never acknowledged
+                    return False
+                self._apply(record)
+        return True
+
+    def _apply(self, record):
+        docs = self.collections.setdefault(record['c'], collections.OrderedDict())
+        if record['op'] == 'put':
+            docs[record['doc']['_id']] = record['doc']
+        elif record['op'] == 'delete':
+            for _id in record['ids']:
+                docs.pop(_id, None)
+
+    # ---- writing -------------------------------------------------------
+
+    def log(self, op, collection, value):
+        """append a record for a change already applied in memory (lock held)"""
+        if op == 'put':
+            record = {'op': 'put', 'c': collection, 'doc': value}
+        else:
+            record = {'op': 'delete', 'c': collection, 'ids': value}
+        return self.journal.append(record)
+
+    def __getitem__(self, name):
+        collection = self._collection_objects.get(name)
+        if collection is None:
+            collection = self._collection_objects[name] = JournalCollection(self, name)
+        return collection
+
+    def collection_names(self):
+        return [name for name in COLLECTIONS if name in self.collections] + \
+               sorted(name for name in self.collections if name not in COLLECTIONS)
+
+    # ---- compaction ----------------------------------------------------
+
+    def _compact_loop(self):
+        while not self._stop.wait(self.compact_interval):
+            try:
+                if self.journal.size() > self.compact_bytes:
+                    self.compact()
+            except Exception:
+                # the journal keeps growing, tried again next interval
+                log.exception("journal compaction failed")
+
+    def compact(self):
+        """fold the journal into a new snapshot"""
+        with self._compacting:
+            with self.lock:
+                # documents are never changed in place, replaced instead,
+                # so copying the mappings is enough for a consistent view
+                state = dict((name, list(docs.values())) for name, docs in self.collections.items())
+                self.journal.rotate(self.old_journal_path)
+            self._write_snapshot(state)
+            os.remove(self.old_journal_path)
+
+    def close(self):
+        self._stop.set()
+        self.journal.close()
@@ -0,0 +1,280 @@
+# markup.py
+# page content rendering: Markdown to HTML and HTML sanitizing, done at save
+#
+# A Markdown page (is_markdown) keeps its source in `content` and the
+# rendered HTML in `html`, written by page_edit when the page is saved, so a
+# page view only outputs stored HTML.  The rendered HTML is always
+# sanitized: tags and attributes outside an allowlist are dropped, as are
+# script/style elements and javascript: URLs.  HTML pages saved by users who
+# are not admins are sanitized the same way (SANITIZE_HTML).
+#
+# `content_hash` of a Markdown page records which source its `html` was
+# rendered from, so saving a page with unchanged content renders nothing,
+# and a bounded LRU keyed by that hash lets identical content (bulk imports,
+# boilerplate copied across pages) render once.
+#
+# Uses the markdown package (pip install Markdown) when installed.  Without
+# it a small built-in renderer handles paragraphs, headings, lists, block
+# quotes, code, emphasis, links and images.
+import collections
+import hashlib
+import html
+import re
+import threading
+from html.parser import HTMLParser
+
+try:
+    import markdown
+except ImportError:
+    markdown = None
+
+# bump when rendering or sanitizing changes, stored hashes then no longer match
+RENDER_VERSION = 2
+MARKDOWN_EXTENSIONS = ['extra', 'sane_lists']
+
+ALLOWED_TAGS = frozenset([
+    'a', 'abbr', 'b', 'blockquote', 'br', 'caption', 'code', 'dd', 'del', 'div', 'dl', 'dt', 'em',
+    'figcaption', 'figure', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'kbd', 'li',
+    'mark', 'ol', 'p', 'pre', 's', 'small', 'span', 'strong', 'sub', 'sup', 'table', 'tbody', 'td',
+    'tfoot', 'th', 'thead', 'tr', 'u', 'ul'])
+VOID_TAGS = frozenset(['br', 'hr', 'img'])
+# elements dropped together with their content
+DROP_CONTENT_TAGS = frozenset(['script', 'style', 'iframe', 'object', 'embed', 'template', 'noscript',
+                               'textarea', 'select', 'svg', 'math'])
+# tag => attributes, '*' applies to every tag
+ALLOWED_ATTRIBUTES = {
+    '*': frozenset(['title', 'class', 'id']),
+    'a': frozenset(['href', 'rel']),
+    'img': frozenset(['src', 'alt', 'width', 'height', 'srcset', 'sizes']),
+    'td': frozenset(['colspan', 'rowspan', 'align']),
+    'th': frozenset(['colspan', 'rowspan', 'align']),
+    'ol': frozenset(['start']),
+}
+URL_ATTRIBUTES = frozenset(['href', 'src'])
+ALLOWED_SCHEMES = frozenset(['http', 'https', 'mailto'])
+SCHEME_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*):')
+# control characters and whitespace browsers ignore inside a URL scheme
+URL_JUNK_RE = re.compile(r'[\x00-\x20\x7f]+')
+
+
+def safe_url(url):
+    """True if url is relative or uses an allowed scheme"""
+    match = SCHEME_RE.match(URL_JUNK_RE.sub('', url))
+    return match is None or match.group(1).lower() in ALLOWED_SCHEMES
+
+
+class Sanitizer(HTMLParser):
+    """rebuilds HTML keeping only allowlisted tags, attributes and URLs"""
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.out = []
+        self.open = []
+        # depth inside a dropped element (script, style...)
+        self.dropping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            if tag not in VOID_TAGS:
+                self.dropping += 1
+            return
+        if self.dropping or tag not in ALLOWED_TAGS:
+            return
+        allowed = ALLOWED_ATTRIBUTES['*'] | ALLOWED_ATTRIBUTES.get(tag, frozenset())
+        parts = [tag]
+        for name, value in attrs:
+            if name not in allowed or value is None:
+                continue
+            if name in URL_ATTRIBUTES and not safe_url(value):
+                continue
+            parts.append('{}="{}"'.format(name, html.escape(value)))
+        self.out.append('<{}>'.format(' '.join(parts)))
+        if tag not in VOID_TAGS:
+            self.open.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            # <svg/>, <script/>: nothing inside to drop, and no end tag will follow
+            return
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS and self.open and self.open[-1] == tag:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROP_CONTENT_TAGS:
+            self.dropping = max(0, self.dropping - 1)
+            return
+        if self.dropping or tag not in self.open:
+            return
+        # close whatever was left open inside tag
+        while self.open:
+            name = self.open.pop()
+            self.out.append('</{}>'.format(name))
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        if not self.dropping:
+            self.out.append(html.escape(data, quote=False))
+
+    def result(self):
+        self.close()
+        return ''.join(self.out) + ''.join('</{}>'.format(tag) for tag in reversed(self.open))
+
+
+def sanitize_html(text):
+    """text (HTML) without anything that could run script or break out of the page"""
+    sanitizer = Sanitizer()
+    sanitizer.feed(text)
+    return sanitizer.result()
+
+
+# ---- built-in Markdown subset ------------------------------------------
+
+HEADING_RE = re.compile(r'^(#{1,6})\s+(.*?)\s*#*\s*$')
+LIST_ITEM_RE = re.compile(r'^\s{0,3}([*+-]|\d+[.)])\s+(.*)$')
+RULE_RE = re.compile(r'^\s{0,3}([-*_])(\s*\1){2,}\s*$')
+INLINE_RE = re.compile(r'`([^`]+)`'
+                       r'|!\[([^\]]*)\]\(([^)\s]+)(?:\s+"([^"]*)")?\)'
+                       r'|\[([^\]]+)\]\(([^)\s]+)(?:\s+"([^"]*)")?\)'
+                       r'|(\*\*|__)(.+?)\8'
+                       r'|(\*|_)(.+?)\10')
+
+
+def render_inline(text):
+    """code, images, links, strong and em of one block, everything else escaped"""
+    out = []
+    position = 0
+    for match in INLINE_RE.finditer(text):
+        out.append(html.escape(text[position:match.start()], quote=False))
+        position = match.end()
+        code, alt, src, img_title, label, href, link_title, strong_mark, strong, em_mark, em = match.groups()
+        if code is not None:
+            out.append('<code>{}</code>'.format(html.escape(code, quote=False)))
+        elif src is not None:
+            title = ' title="{}"'.format(html.escape(img_title)) if img_title else ''
+            out.append('<img src="{}" alt="{}"{}>'.format(html.escape(src), html.escape(alt), title))
+        elif href is not None:
+            title = ' title="{}"'.format(html.escape(link_title)) if link_title else ''
+            out.append('<a href="{}"{}>{}</a>'.format(html.escape(href), title, render_inline(label)))
+        elif strong is not None:
+            out.append('<strong>{}</strong>'.format(render_inline(strong)))
+        else:
+            out.append('<em>{}</em>'.format(render_inline(em)))
+    out.append(html.escape(text[position:], quote=False))
+    return ''.join(out)
+
+def render_basic(source):
+    """Markdown subset to HTML, used when the markdown package is not installed"""
+    out = []
+    lines = source.replace('\r\n', '\n').split('\n')
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+        if not stripped:
+            i += 1
+        elif stripped.startswith('```'):
+            code = []
+            i += 1
+            while i < len(lines) and not lines[i].strip().startswith('```'):
+                code.append(lines[i])
+                i += 1
+            i += 1
+            out.append('<pre><code>{}</code></pre>'.format(html.escape('\n'.join(code), quote=False)))
+        elif HEADING_RE.match(stripped):
+            hashes, text = HEADING_RE.match(stripped).groups()
+            out.append('<h{0}>{1}</h{0}>'.format(len(hashes), render_inline(text)))
+            i += 1
+        elif RULE_RE.match(line):
+            out.append('<hr>')
+            i += 1
+        elif LIST_ITEM_RE.match(line):
+            ordered = LIST_ITEM_RE.match(line).group(1)[0].isdigit()
+            items = []
+            while i < len(lines) and LIST_ITEM_RE.match(lines[i]):
+                items.append(render_inline(LIST_ITEM_RE.match(lines[i]).group(2)))
+                i += 1
+            tag = 'ol' if ordered else 'ul'
+            out.append('<{0}>{1}</{0}>'.format(tag, ''.join('<li>{}</li>'.format(item) for item in items)))
+        elif stripped.startswith('>'):
+            quoted = []
+            while i < len(lines) and lines[i].strip().startswith('>'):
+                quoted.append(lines[i].strip()[1:].lstrip())
+                i += 1
+            out.append('<blockquote>{}</blockquote>'.format(render_basic('\n'.join(quoted))))
+        else:
+            paragraph = []
+            while i < len(lines) and lines[i].strip() and not (
+                    HEADING_RE.match(lines[i].strip()) or LIST_ITEM_RE.match(lines[i])
+                    or lines[i].strip().startswith(('```', '>'))):
+                paragraph.append(lines[i].strip())
+                i += 1
+            out.append('<p>{}</p>'.format(render_inline('\n'.join(paragraph))))
+    return '\n'.join(out)
+
+
+def render_markdown(source):
+    """Markdown source to (unsanitized) HTML"""
+    if markdown is not None:
+        return markdown.markdown(source, extensions=MARKDOWN_EXTENSIONS)
+    return render_basic(source)
+
+def content_hash(source, kind):
+    """identifies what a rendering was made from, kind is 'markdown' or 'html'"""
+    digest = hashlib.sha256('{}:{}:'.format(RENDER_VERSION, kind).encode('utf-8'))
+    digest.update(source.encode('utf-8'))
+    return digest.hexdigest()
+
+def page_html(page):
+    """the HTML a page displays, its rendering for Markdown pages"""
+    if page.get('is_markdown') and page.get('html') is not None:
+        return page['html']
+    return page.get('content') or ''
+
+
+class ContentRenderer(object):
+    """renders and sanitizes page content, memoized in a bounded LRU by content hash"""
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def render(self, source, kind):
+        """sanitized HTML of source, kind is 'markdown' or 'html'"""
+        key = content_hash(source, kind)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+        result = sanitize_html(render_markdown(source) if kind == 'markdown' else source)
+        with self._lock:
+            self._entries[key] = result
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return result
+
+    def render_page(self, page, sanitize=False):
+        """fill in page['html'] (Markdown pages) or sanitize page['content'] (HTML pages, if sanitize).
+        returns False when the stored rendering was already current and nothing was rendered
+        """
+        source = page.get('content') or ''
+        if not page.get('is_markdown'):
+            # html and content_hash are only kept for Markdown pages
+            page['html'] = page['content_hash'] = None
+            if sanitize:
+                page['content'] = self.render(source, 'html')
+            return sanitize
+        key = content_hash(source, 'markdown')
+        if page.get('content_hash') == key and page.get('html') is not None:
+            return False
+        page['html'] = self.render(source, 'markdown')
+        page['content_hash'] = key
+        return True
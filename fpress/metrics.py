@@ -0,0 +1,231 @@
+# metrics.py
+# request instrumentation: Server-Timing header and Prometheus /metrics
+#
+# Every request measures its wall time, the time and number of database calls
+# (TimedDatabase wraps the collections) and the time spent rendering
+# templates.  The totals go out with the response as a Server-Timing header
+# (visible in the browser's network panel) and are aggregated per route into
+# histograms that /metrics exports in the Prometheus text format.
+# Each worker process keeps its own numbers.
+#
+# /metrics answers admins, scrapers sending `Authorization: Bearer
+# <METRICS_TOKEN>` and the client addresses in METRICS_ALLOW.  The address
+# check trusts request.remote_addr, which behind a reverse proxy is the
+# proxy's own address, so METRICS_ALLOW is empty by default and only safe
+# with ProxyFix (or without a proxy).
+import hmac
+import threading
+import time
+
+from flask import g, has_app_context, request
+
+# upper bounds (seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# the collection calls that are timed
+DB_OPERATIONS = frozenset(['find', 'find_one', 'find_page', 'insert_one', 'insert', 'update_one',
+                           'update_many', 'delete_many', 'remove'])
+
+METRIC_HELP = {
+    'fpress_request_duration_seconds': ('histogram', "Wall time of requests by route"),
+    'fpress_requests_total': ('counter', "Requests by route and status"),
+    'fpress_db_call_duration_seconds': ('histogram', "Database calls by collection and operation"),
+    'fpress_template_render_duration_seconds': ('histogram', "Template rendering by template"),
+}
+
+
+def scrape_allowed(request, config):
+    """True if request may read /metrics: bearer token or allowed address, see above"""
+    token = config.get('METRICS_TOKEN')
+    if token:
+        scheme, _, value = (request.headers.get('Authorization') or '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(value.strip().encode('utf-8'),
+                                                               token.encode('utf-8')):
+            return True
+    return request.remote_addr in (config.get('METRICS_ALLOW') or ())
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+
+class RequestTimer(object):
+    """measurements of the current request, lives on g"""
+    __slots__ = ('start', 'db_time', 'db_calls', 'template_time', 'render_starts', 'cache')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_time = 0.0
+        self.db_calls = 0
+        self.template_time = 0.0
+        self.render_starts = []
+        # 'hit' or 'miss' when a view used the page cache
+        self.cache = None
+
+
+def current_timer():
+    """the RequestTimer of the current request, None outside requests"""
+    if not has_app_context():
+        return None
+    return g.get('request_timer')
+
+
+class Metrics(object):
+    """process wide counters and histograms"""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # (name, labels) => [bucket counts..., sum, count]
+        self._histograms = {}
+        # (name, labels) => value
+        self._counters = {}
+        # callables returning [(name, type, help, labels, value)], read at scrape time
+        self._collectors = []
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(labels))
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    # ---- hooks ---------------------------------------------------------
+
+    def db_call(self, collection, operation, seconds):
+        self.observe('fpress_db_call_duration_seconds', (('collection', collection), ('operation', operation)), seconds)
+        timer = current_timer()
+        if timer is not None:
+            timer.db_time += seconds
+            timer.db_calls += 1
+
+    def template_started(self, sender, template, context, **extra):
+        timer = current_timer()
+        if timer is not None:
+            timer.render_starts.append(time.perf_counter())
+
+    def template_finished(self, sender, template, context, **extra):
+        timer = current_timer()
+        if timer is None or not timer.render_starts:
+            return
+        seconds = time.perf_counter() - timer.render_starts.pop()
+        if not timer.render_starts:
+            # nested renders are part of the outer one
+            timer.template_time += seconds
+        self.observe('fpress_template_render_duration_seconds', (('template', template.name or '-'),), seconds)
+
+    def start_request(self):
+        g.request_timer = RequestTimer()
+
+    def finish_request(self, response):
+        """record the request and add the Server-Timing header"""
+        timer = current_timer()
+        if timer is None:
+            return response
+        total = time.perf_counter() - timer.start
+        route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+        labels = (('route', route), ('method', request.method))
+        self.observe('fpress_request_duration_seconds', labels, total)
+        self.inc('fpress_requests_total', labels + (('status', response.status_code),))
+        timings = ['app;dur={:.2f}'.format(total * 1000),
+                   'db;dur={:.2f};desc="{} calls"'.format(timer.db_time * 1000, timer.db_calls),
+                   'tpl;dur={:.2f}'.format(timer.template_time * 1000)]
+        if timer.cache:
+            timings.append('cache;desc="{}"'.format(timer.cache))
+        response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+    # ---- export --------------------------------------------------------
+
+    def render(self):
+        """all metrics in the Prometheus text exposition format"""
+        with self._lock:
+            histograms = dict((key, list(entry)) for key, entry in self._histograms.items())
+            counters = dict(self._counters)
+        samples = {}
+        for (name, labels), entry in sorted(histograms.items()):
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', '+Inf'),)), entry[-1]))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), entry[-2]))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), entry[-1]))
+        for (name, labels), value in sorted(counters.items()):
+            samples.setdefault(name, []).append('{}{} {}'.format(name, format_labels(labels), value))
+        help_texts = dict(METRIC_HELP)
+        for collector in self._collectors:
+            for name, kind, text, labels, value in collector():
+                help_texts.setdefault(name, (kind, text))
+                samples.setdefault(name, []).append('{}{} {}'.format(name, format_labels(labels), value))
+        out = []
+        for name in sorted(samples):
+            kind, text = help_texts.get(name, ('untyped', name))
+            out.append('# HELP {} {}'.format(name, text))
+            out.append('# TYPE {} {}'.format(name, kind))
+            out.extend(samples[name])
+        return '\n'.join(out) + '\n'
+
+
+class TimedCollection(object):
+    """collection wrapper reporting the duration of each call to a Metrics"""
+    def __init__(self, collection, name, metrics):
+        self.collection = collection
+        self.name = name
+        self.metrics = metrics
+        self._methods = {}
+
+    def __getattr__(self, attr):
+        if attr not in DB_OPERATIONS:
+            return getattr(self.collection, attr)
+        method = self._methods.get(attr)
+        if method is None:
+            target = getattr(self.collection, attr)
+
+            def method(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return target(*args, **kwargs)
+                finally:
+                    self.metrics.db_call(self.name, attr, time.perf_counter() - start)
+            self._methods[attr] = method
+        return method
+
+
+class TimedDatabase(object):
+    """database wrapper handing out TimedCollections, anything else passes through"""
+    def __init__(self, db, metrics):
+        self.db = db
+        self.metrics = metrics
+        self._collections = {}
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = TimedCollection(self.db[name], name, self.metrics)
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        value = getattr(self.db, name)
+        # attributes of the wrapped database (shared...) pass through, collections are timed
+        if callable(value) or not hasattr(value, 'find'):
+            return value
+        return self[name]
@@ -0,0 +1,70 @@
+# migrate.py
+# copy the site's collections from one storage backend to another
+#
+#   python migrate.py tinymongo tinydb sqlite fpress.sqlite3
+#
+# Documents keep their _id, so links to /page/edit/<id> etc. stay valid.
+# They are inserted batch_size at a time, except into TinyMongo, which
+# rewrites a collection's whole file on every write: each collection is
+# inserted there in one write.
+# Afterwards point DATABASE_BACKEND / DATABASE_PATH in app.cfg at the target.
+import argparse
+import sys
+
+from storage import BACKENDS, COLLECTIONS, open_backend
+
+
+def iter_documents(collection, batch_size):
+    """stream documents, backends that can fetch in batches do so"""
+    if hasattr(collection, 'iter_documents'):
+        return collection.iter_documents(batch_size=batch_size)
+    return iter(collection.find())
+
+def migrate(source, target, collections=None, batch_size=500, force=False, log=print):
+    """copy collections from source to target backend, returns {collection: count}"""
+    counts = {}
+    for name in collections or COLLECTIONS:
+        src, dst = source[name], target[name]
+        if dst.find_one() is not None:
+            if not force:
+                raise ValueError("target collection '{}' is not empty (use --force to replace it)".format(name))
+            dst.delete_many({})
+        # None: the whole collection in one batch
+        insert_size = None if getattr(dst, 'rewrites_file', False) else batch_size
+        count = 0
+        batch = []
+        for doc in iter_documents(src, batch_size):
+            batch.append(dict(doc))
+            if insert_size is not None and len(batch) >= insert_size:
+                dst.insert(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            dst.insert(batch)
+            count += len(batch)
+        counts[name] = count
+        log("{}: {} documents".format(name, count))
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="copy FlaskPress data between storage backends")
+    parser.add_argument('source_backend', choices=sorted(BACKENDS))
+    parser.add_argument('source_path', help="TinyMongo folder or SQLite file")
+    parser.add_argument('target_backend', choices=sorted(BACKENDS))
+    parser.add_argument('target_path', help="TinyMongo folder or SQLite file")
+    parser.add_argument('--name', default='blog', help="database name (TinyMongo), default: blog")
+    parser.add_argument('--collections', nargs='+', default=COLLECTIONS, help="collections to copy")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--force', action='store_true', help="replace non-empty target collections")
+    args = parser.parse_args(argv)
+
+    source = open_backend(args.source_backend, args.source_path, args.name)
+    target = open_backend(args.target_backend, args.target_path, args.name)
+    try:
+        migrate(source, target, args.collections, args.batch_size, args.force)
+    except ValueError as e:
+        sys.exit(str(e))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# navigation.py
+# precomputed navigation menu and sidebar/footer fragments
+#
+# The menu lists the published pages with show_nav set.  It is built with one
+# scan of the pages and rebuilt only when a save changes a field the menu
+# depends on (title, slug, show_nav, is_published), so rendering a menu is a
+# lookup.  Pages name other pages as sidebar_left, sidebar_right and footer
+# (by slug); the content of those pages is cached as ready-to-insert
+# fragments, and the model remembers who references which slug so a change
+# to a sidebar page invalidates exactly the pages showing it.
+import threading
+
+from markupsafe import Markup
+
+from markup import page_html
+from routing import HOME_SLUG
+
+# fields of a page that name a fragment page
+FRAGMENT_FIELDS = ('sidebar_left', 'sidebar_right', 'footer')
+
+
+def nav_signature(page):
+    """what the menu knows about a page, None if it is not in the menu"""
+    if not (page.get('show_nav') and page.get('is_published') and page.get('slug')):
+        return None
+    return (page['slug'], page.get('title') or page['slug'])
+
+def fragment_refs(page):
+    """slugs of the fragment pages a page shows"""
+    return set(page.get(field) for field in FRAGMENT_FIELDS if page.get(field))
+
+
+class NavigationModel(object):
+    """menu items, fragment cache and fragment references of the site"""
+    def __init__(self, max_fragments=1024):
+        self.max_fragments = max_fragments
+        self._lock = threading.RLock()
+        self._epoch = None
+        self._built = False
+        self.menu = []
+        # page _id => nav_signature, to tell whether a save changes the menu
+        self._signatures = {}
+        # page _id => (slug, fragment slugs it shows)
+        self._refs = {}
+        # fragment slug => set of slugs of the pages showing it
+        self._referrers = {}
+        # fragment slug => Markup
+        self._fragments = {}
+
+    def ensure(self, db, epoch=None):
+        """build the model if needed, rebuilt when another process changed pages (epoch)"""
+        if epoch == self._epoch and self._built:
+            return
+        with self._lock:
+            if epoch != self._epoch:
+                self._built = False
+                self._epoch = epoch
+            if not self._built:
+                self._build(db)
+
+    def _build(self, db):
+        self._signatures = {}
+        self._refs = {}
+        self._referrers = {}
+        self._fragments = {}
+        for page in db.pages.find():
+            self._signatures[page['_id']] = nav_signature(page)
+            self._reference(page)
+        self._build_menu()
+        self._built = True
+
+    def _build_menu(self):
+        items = [{'slug': sig[0], 'title': sig[1]} for sig in self._signatures.values() if sig is not None]
+        # home first, the rest by title
+        items.sort(key=lambda item: (item['slug'] != HOME_SLUG, item['title'].lower()))
+        self.menu = items
+
+    def _reference(self, page):
+        self._unreference(page['_id'])
+        refs = fragment_refs(page)
+        self._refs[page['_id']] = (page.get('slug'), refs)
+        for ref in refs:
+            self._referrers.setdefault(ref, set()).add(page.get('slug'))
+
+    def _unreference(self, page_id):
+        slug, refs = self._refs.pop(page_id, (None, ()))
+        for ref in refs:
+            referrers = self._referrers.get(ref)
+            if referrers is not None:
+                referrers.discard(slug)
+                if not referrers:
+                    del self._referrers[ref]
+
+    def page_saved(self, page, old_slug=None):
+        """update the model after a save.
+        returns (menu changed, slugs of the pages showing this page as a fragment)
+        """
+        with self._lock:
+            if not self._built:
+                return False, set()
+            signature = nav_signature(page)
+            menu_changed = self._signatures.get(page['_id']) != signature
+            self._signatures[page['_id']] = signature
+            if menu_changed:
+                self._build_menu()
+            self._reference(page)
+            stale = set()
+            for slug in (old_slug, page.get('slug')):
+                if slug:
+                    self._fragments.pop(slug, None)
+                    stale.update(self._referrers.get(slug, ()))
+            return menu_changed, stale
+
+    def page_removed(self, page):
+        """forget a deleted page, returns the same as page_saved"""
+        with self._lock:
+            if not self._built:
+                return False, set()
+            menu_changed = self._signatures.pop(page['_id'], None) is not None
+            if menu_changed:
+                self._build_menu()
+            self._unreference(page['_id'])
+            self._fragments.pop(page.get('slug'), None)
+            return menu_changed, set(self._referrers.get(page.get('slug'), ()))
+
+    def fragment(self, db, slug):
+        """content of the page at slug as Markup, empty if there is none"""
+        if not slug:
+            return Markup('')
+        fragment = self._fragments.get(slug)
+        if fragment is not None:
+            return fragment
+        page = db.pages.find_one({'slug': slug})
+        fragment = Markup(page_html(page)) if page else Markup('')
+        with self._lock:
+            if len(self._fragments) >= self.max_fragments:
+                self._fragments.clear()
+            self._fragments[slug] = fragment
+        return fragment
@@ -0,0 +1,115 @@
+# pagecache.py
+# rendered page output cache for the site() view
+#
+# Responses are validated by ETag only.  A page shows more than itself (menu,
+# sidebars, breadcrumbs, embedded pages), so its modified_at is no
+# Last-Modified: a client revalidating with If-Modified-Since alone would get
+# a 304 for a copy that is out of date.
+import collections
+import hashlib
+import threading
+
+from flask import make_response, request
+
+from compression import negotiate, set_encoded_body
+
+# body is the rendered HTML, etag a strong validator of the body and encoded
+# the compressed bodies made so far, encoding => bytes
+CachedPage = collections.namedtuple('CachedPage', 'body etag encoded')
+
+
+def make_cached_page(body):
+    etag = hashlib.sha1(body.encode('utf-8')).hexdigest()
+    return CachedPage(body, etag, {})
+
+
+class PageCache(object):
+    """bounded LRU of rendered pages keyed by (slug, theme, variant).
+    The variant describes the viewer (anonymous, user, admin, owner...) since
+    the page template renders differently for each of them.
+    """
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        # slug => set of keys, so a page save drops every variant of that page
+        self._keys_by_slug = {}
+        self._lock = threading.Lock()
+        self._token = None
+        self.hits = 0
+        self.misses = 0
+
+    def sync(self, token):
+        """clear the cache when token changes. The token summarizes the state
+        the cached pages were rendered from, e.g. the epochs of the pages and
+        meta collections, which move when another worker process writes them
+        """
+        if token != self._token:
+            self.clear()
+            self._token = token
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._keys_by_slug.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self._forget(old_key)
+
+    def _forget(self, key):
+        keys = self._keys_by_slug.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_slug[key[0]]
+
+    def invalidate(self, slug):
+        """drop every cached variant of a page"""
+        with self._lock:
+            for key in self._keys_by_slug.pop(slug, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """drop everything, e.g. when the site meta (brand, theme...) changes"""
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_slug.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def cached_page_response(entry, public=True, max_age=0, compressor=None):
+    """response for a cached page, 304 if the client's copy is current.
+    with a compressor (see compression.py) the body is compressed once per
+    entry and encoding
+    """
+    response = make_response(entry.body)
+    response.set_etag(entry.etag)
+    if compressor is not None:
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate(request.accept_encodings)
+        if encoding is not None and len(entry.body) >= compressor.min_size:
+            body = entry.encoded.get(encoding)
+            if body is None:
+                body = entry.encoded[encoding] = compressor.encode(entry.body.encode('utf-8'), encoding)
+            set_encoded_body(response, body, encoding)
+    if public:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
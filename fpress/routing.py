@@ -0,0 +1,158 @@
+# routing.py
+# slug trie: pages arranged by their path-like slugs (people/dirk-gently)
+#
+# slugify() keeps '/' so slugs form a hierarchy.  The trie holds every
+# published page under its slug segments, so listing the ancestors of a page
+# (breadcrumbs) and the pages directly below a prefix (section index pages)
+# cost O(depth) instead of a scan of all pages.  Looking a page up by its
+# slug is left to the slug index of the pages collection (see indexes.py).
+# page_saved/page_removed in app.py keep it current.
+import threading
+
+HOME_SLUG = 'home'
+
+
+def split_slug(slug):
+    """path segments of a slug, empty segments dropped"""
+    return [part for part in (slug or '').split('/') if part]
+
+
+class SlugNode(object):
+    __slots__ = ('children', 'page')
+
+    def __init__(self):
+        # segment => SlugNode
+        self.children = {}
+        # summary of the page at this path: {'_id', 'slug', 'title'}, or None
+        self.page = None
+
+
+class SlugTrie(object):
+    """published pages by slug segment"""
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._epoch = None
+        self._built = False
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.root = SlugNode()
+            # _id => slug, to find the node of a page being removed or renamed
+            self.slugs = {}
+            self._built = False
+
+    def ensure(self, db, epoch=None):
+        """build the trie if needed, rebuilt when another process changed pages (epoch)"""
+        with self._lock:
+            if epoch != self._epoch:
+                self.clear()
+                self._epoch = epoch
+            if not self._built:
+                for page in db.pages.find({'is_published': True}):
+                    self.add(page)
+                self._built = True
+
+    def _node(self, slug, create=False):
+        node = self.root
+        for part in split_slug(slug):
+            child = node.children.get(part)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[part] = SlugNode()
+            node = child
+        return node
+
+    def add(self, page):
+        """insert (or move, or drop if unpublished) a page"""
+        with self._lock:
+            self.remove(page['_id'])
+            slug = page.get('slug')
+            if not page.get('is_published') or not split_slug(slug):
+                return
+            node = self._node(slug, create=True)
+            node.page = {'_id': page['_id'], 'slug': slug, 'title': page.get('title') or slug}
+            self.slugs[page['_id']] = slug
+
+    def remove(self, page_id):
+        """drop a page, pruning path nodes nothing hangs off any more"""
+        with self._lock:
+            slug = self.slugs.pop(page_id, None)
+            if slug is None:
+                return
+            path = [self.root]
+            parts = split_slug(slug)
+            for part in parts:
+                node = path[-1].children.get(part)
+                if node is None:
+                    return
+                path.append(node)
+            path[-1].page = None
+            for i in range(len(parts), 0, -1):
+                if path[i].page is not None or path[i].children:
+                    break
+                del path[i - 1].children[parts[i - 1]]
+
+    def breadcrumbs(self, slug, url_for_slug):
+        """(title, url) of the published ancestors of slug, home first.
+        url_for_slug(slug) makes the link of an ancestor
+        """
+        crumbs = []
+        with self._lock:
+            parts = split_slug(slug)
+            if parts == [HOME_SLUG]:
+                return crumbs
+            home = self.root.children.get(HOME_SLUG)
+            if home is not None and home.page is not None:
+                crumbs.append((home.page['title'], url_for_slug(None)))
+            node = self.root
+            for part in parts[:-1]:
+                node = node.children.get(part)
+                if node is None:
+                    break
+                if node.page is not None:
+                    crumbs.append((node.page['title'], url_for_slug(node.page['slug'])))
+        return crumbs
+
+    def children(self, prefix):
+        """summaries of the published pages directly below prefix, by title.
+        For a segment without a page of its own, the pages below it stand in.
+        """
+        with self._lock:
+            node = self._node(prefix)
+            if node is None:
+                return []
+            found = []
+            pending = list(node.children.values())
+            while pending:
+                child = pending.pop()
+                if child.page is not None:
+                    found.append(child.page)
+                else:
+                    pending.extend(child.children.values())
+        return sorted(found, key=lambda page: page['title'].lower())
+
+    def related(self, slug):
+        """slugs of the pages whose breadcrumbs or child list show slug:
+        the nearest published ancestor and every published descendant
+        """
+        related = []
+        with self._lock:
+            parts = split_slug(slug)
+            node = self.root
+            for part in parts[:-1]:
+                node = node.children.get(part)
+                if node is None:
+                    break
+                if node.page is not None:
+                    related.append(node.page['slug'])
+            related = related[-1:]
+            node = self._node(slug)
+            pending = list(node.children.values()) if node is not None else []
+            while pending:
+                child = pending.pop()
+                if child.page is not None:
+                    related.append(child.page['slug'])
+                pending.extend(child.children.values())
+        return related
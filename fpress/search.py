@@ -0,0 +1,135 @@
+# search.py
+# inverted full-text index for the /search route
+#
+# Pages are tokenized from their tag-stripped text once, when they are saved,
+# instead of lower()-ing every page's raw HTML on every search.  Queries are
+# multi-term AND, ranked with BM25 (title terms count title_boost times).
+import heapq
+import html
+import math
+import re
+import threading
+
+from markup import page_html
+from utils import remove_html_tags, snippet
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """lowercase word tokens of a plain text string"""
+    return TOKEN_RE.findall(text.lower())
+
+def page_text(page):
+    """plain text of a page's (rendered) content, tags stripped and entities decoded"""
+    return html.unescape(remove_html_tags(page_html(page)))
+
+
+class SearchIndex(object):
+    """term => {page _id: weighted term frequency} postings with BM25 ranking.
+    Only slug, title and snippet are kept per page, enough to render results.
+    """
+    def __init__(self, k1=1.2, b=0.75, title_boost=3.0):
+        self.k1 = k1
+        self.b = b
+        self.title_boost = title_boost
+        self._lock = threading.RLock()
+        self._built = False
+        self._epoch = None
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.postings = {}
+            # _id => (length, terms, result dict)
+            self.docs = {}
+            self.total_length = 0
+            self._built = False
+
+    def build(self, db):
+        """index every page, only done once per process"""
+        with self._lock:
+            if not self._built:
+                for page in db.pages.find():
+                    self.add(page)
+                self._built = True
+
+    def ensure(self, db, epoch=None):
+        """build the index if needed. epoch is the pages collection epoch,
+        when another process changed pages the index is rebuilt from scratch
+        """
+        if epoch != self._epoch:
+            with self._lock:
+                self.clear()
+                self._epoch = epoch
+        if not self._built:
+            self.build(db)
+
+    def add(self, page):
+        """index (or re-index) a page"""
+        text = page_text(page)
+        title = page.get('title') or ''
+        frequencies = {}
+        for term in tokenize(text):
+            frequencies[term] = frequencies.get(term, 0) + 1
+        title_terms = tokenize(title)
+        for term in title_terms:
+            frequencies[term] = frequencies.get(term, 0) + self.title_boost
+        length = sum(frequencies.values())
+        result = {'_id': page['_id'], 'slug': page.get('slug'), 'title': title,
+                  'snippet': page.get('snippet') or snippet(text)}
+        with self._lock:
+            self.remove(page['_id'])
+            for term, tf in frequencies.items():
+                self.postings.setdefault(term, {})[page['_id']] = tf
+            self.docs[page['_id']] = (length, tuple(frequencies), result)
+            self.total_length += length
+
+    def remove(self, page_id):
+        """drop a page from the index"""
+        with self._lock:
+            entry = self.docs.pop(page_id, None)
+            if entry is None:
+                return
+            length, terms, result = entry
+            self.total_length -= length
+            for term in terms:
+                posting = self.postings.get(term)
+                if posting is not None:
+                    posting.pop(page_id, None)
+                    if not posting:
+                        del self.postings[term]
+
+    def search(self, query, page=1, per_page=20):
+        """pages containing ALL query terms, best first
+        returns (list of result dicts for the requested page, total matches)
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return [], 0
+        with self._lock:
+            postings = [self.postings.get(term) for term in terms]
+            if not all(postings):
+                return [], 0
+            # intersect starting from the rarest term
+            postings.sort(key=len)
+            matches = [_id for _id in postings[0] if all(_id in p for p in postings[1:])]
+            total = len(matches)
+            if not total:
+                return [], 0
+            n_docs = len(self.docs)
+            avg_length = float(self.total_length) / n_docs
+            idfs = [math.log(1 + (n_docs - len(p) + 0.5) / (len(p) + 0.5)) for p in postings]
+            k1, b = self.k1, self.b
+
+            def score(_id):
+                norm = k1 * (1 - b + b * self.docs[_id][0] / avg_length)
+                s = 0.0
+                for idf, posting in zip(idfs, postings):
+                    tf = posting[_id]
+                    s += idf * tf * (k1 + 1) / (tf + norm)
+                return s
+
+            start = (max(page, 1) - 1) * per_page
+            best = heapq.nlargest(start + per_page, matches, key=score)
+            return [self.docs[_id][2] for _id in best[start:]], total
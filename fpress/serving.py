@@ -0,0 +1,113 @@
+# serving.py
+# serving uploaded files: validators, caching headers, ranges and proxy offload
+#
+# Every response carries a strong ETag made from the file's SHA-256.  Blob
+# paths (blob/<sha256>/<filename>) can never change, so they are cacheable
+# forever (Cache-Control: immutable).  Range requests get 206 partial content.
+# With UPLOAD_OFFLOAD set the worker only answers with an X-Accel-Redirect
+# (nginx) or X-Sendfile (Apache, lighttpd) header and the front proxy sends
+# the bytes, including ranges.
+import hashlib
+import logging
+import mimetypes
+import os
+import sys
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+
+from flask import abort, current_app, request, send_file
+from werkzeug.security import safe_join
+
+ACCESS_LOG = logging.getLogger('fpress.access')
+
+OFFLOAD_MODES = ('x-accel-redirect', 'x-sendfile')
+# a year, the longest max-age worth sending
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+BLOCK_SIZE = 64 * 1024
+
+
+def configure_access_log(stream=None):
+    """send the access log to stream (stderr by default), one line per request"""
+    if ACCESS_LOG.handlers:
+        return
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+    ACCESS_LOG.addHandler(handler)
+    ACCESS_LOG.setLevel(logging.INFO)
+    ACCESS_LOG.propagate = False
+
+
+class FileHashCache(object):
+    """SHA-256 of files that have no hash in their path, computed once per
+    (size, mtime) of the file and kept in a bounded LRU
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filename, stat):
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(filename)
+                return entry[1]
+        hasher = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                hasher.update(block)
+        digest = hasher.hexdigest()
+        with self._lock:
+            self._entries[filename] = (stamp, digest)
+            self._entries.move_to_end(filename)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return digest
+
+FILE_HASHES = FileHashCache()
+
+
+def send_upload(directory, path, served_path=None, sha256=None, mimetype=None, immutable=False,
+                max_age=0, offload=None, offload_prefix='/_uploads/'):
+    """response for the file at path below directory.
+    served_path is the public path (for the log), sha256 the known content hash
+    (computed and memoized if None), immutable marks content that never changes.
+    """
+    filename = safe_join(directory, path)
+    if filename is None or not os.path.isfile(filename):
+        abort(404)
+    if sha256 is None:
+        sha256 = FILE_HASHES.get(filename, os.stat(filename))
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(served_path or path)[0] or 'application/octet-stream'
+    if immutable:
+        max_age = IMMUTABLE_MAX_AGE
+
+    if offload:
+        # headers only, the proxy sends the body (and handles Range itself)
+        response = current_app.response_class(mimetype=mimetype)
+        if offload == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = offload_prefix.rstrip('/') + '/' + quote(path)
+        elif offload == 'x-sendfile':
+            response.headers['X-Sendfile'] = filename
+        else:
+            raise ValueError("UPLOAD_OFFLOAD must be one of {}".format(', '.join(OFFLOAD_MODES)))
+        response.set_etag(sha256)
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response = response.make_conditional(request)
+    else:
+        # werkzeug answers If-None-Match with 304 and Range with 206
+        response = send_file(filename, mimetype=mimetype, conditional=True, etag=sha256, max_age=max_age)
+    if immutable:
+        response.cache_control.immutable = True
+
+    sent = 0 if offload or response.status_code == 304 else response.content_length or 0
+    ACCESS_LOG.info('path=%s status=%d bytes=%d range=%s offload=%s',
+                    served_path or path, response.status_code, sent,
+                    request.headers.get('Range', '-'), offload or '-',
+                    extra={'path': served_path or path, 'status': response.status_code,
+                           'bytes': sent, 'offload': offload})
+    return response
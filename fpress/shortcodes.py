@@ -0,0 +1,324 @@
+# shortcodes.py
+# shortcodes: dynamic content placed in a page, e.g. [[embed about]]
+#
+#   [[embed <slug>]]             the content of another page
+#   [[sidebar <slug>]]           the same, as an <aside class="sidebar">
+#   [[recent count=5]]           links to the newest published pages
+#   [[files count=10]]           links to the newest uploaded files
+#
+# A page is compiled once, at save: its HTML is split into literal segments
+# and shortcode calls, stored as page['shortcodes'] (None when it has none,
+# the usual case, so expanding it is free) together with the dependencies of
+# those calls in page['shortcode_deps'] ('page:<slug>', 'pages' for the
+# list of published pages, 'files').  At view time every call is looked up
+# in a result cache before it is run.
+#
+# The dependency graph maps each dependency to the pages using it.  Editing
+# page B drops the results depending on 'page:B' and returns the pages
+# embedding B (and, transitively, the pages embedding those), so site() can
+# invalidate exactly those entries of the page cache and keep caching pages
+# with dynamic content.  'pages' changes only when the recent list would:
+# a page is published, unpublished, created, deleted, renamed or retitled.
+import html
+import re
+import shlex
+import threading
+
+from flask import url_for
+from markupsafe import Markup, escape
+
+from markup import page_html
+
+SHORTCODE_RE = re.compile(r'\[\[\s*([a-z_]+)\b([^\[\]]*)\]\]')
+# embedded pages embedding pages... stop here
+MAX_DEPTH = 3
+MAX_COUNT = 50
+
+
+def page_dep(slug):
+    return 'page:{}'.format(slug)
+
+def listing_signature(page):
+    """what the recent list knows about a page, None if it is not listed"""
+    if not (page.get('is_published') and page.get('slug')) or page.get('is_sidebar'):
+        return None
+    return (page['slug'], page.get('title') or page['slug'], page.get('created_at') or '')
+
+def count_arg(args, default):
+    try:
+        return max(1, min(MAX_COUNT, int(args.get('count', default))))
+    except ValueError:
+        return default
+
+
+class Shortcode(object):
+    """render(expansion, args) returns the HTML of a call,
+    depends(args) its dependencies, positional the name of an unnamed argument
+    """
+    __slots__ = ('name', 'render', 'depends', 'positional')
+
+    def __init__(self, name, render, depends, positional=None):
+        self.name = name
+        self.render = render
+        self.depends = depends
+        self.positional = positional
+
+
+def render_embed(expansion, args):
+    return expansion.page_content(args.get('slug'), '<div class="embed">{}</div>')
+
+def render_sidebar(expansion, args):
+    return expansion.page_content(args.get('slug'), '<aside class="sidebar">{}</aside>')
+
+def render_recent(expansion, args):
+    pages = [page for page in expansion.db.pages.find() if listing_signature(page) is not None]
+    pages.sort(key=lambda page: page.get('created_at') or '', reverse=True)
+    items = ['<li><a href="{}">{}</a></li>'.format(escape(url_for('site', path=page['slug'])),
+                                                  escape(page.get('title') or page['slug']))
+             for page in pages[:count_arg(args, 5)]]
+    return '<ul class="recent-pages">{}</ul>'.format(''.join(items))
+
+def render_files(expansion, args):
+    files = sorted(expansion.db.files.find(), key=lambda f: f.get('created_at') or '', reverse=True)
+    items = ['<li><a href="{}">{}</a></li>'.format(escape(f.get('url') or ''), escape(f.get('title') or ''))
+             for f in files[:count_arg(args, 10)]]
+    return '<ul class="file-list">{}</ul>'.format(''.join(items))
+
+BUILTIN = [
+    Shortcode('embed', render_embed, lambda args: [page_dep(args.get('slug'))], positional='slug'),
+    Shortcode('sidebar', render_sidebar, lambda args: [page_dep(args.get('slug'))], positional='slug'),
+    Shortcode('recent', render_recent, lambda args: ['pages'], positional='count'),
+    Shortcode('files', render_files, lambda args: ['files'], positional='count'),
+]
+
+
+class Expansion(object):
+    """one page view's expansion, tracks the embedding chain against cycles"""
+    def __init__(self, engine, db):
+        self.engine = engine
+        self.db = db
+        self.stack = []
+
+    def page_content(self, slug, wrapper):
+        """the expanded content of the page at slug in wrapper, empty if missing or cyclic"""
+        if not slug or slug in self.stack or len(self.stack) >= MAX_DEPTH:
+            return ''
+        page = self.db.pages.find_one({'slug': slug})
+        if page is None:
+            return ''
+        program = self.engine.program(page)
+        if program is None:
+            return wrapper.format(page_html(page))
+        self.stack.append(slug)
+        try:
+            return wrapper.format(self.engine.expand_program(self, program))
+        finally:
+            self.stack.pop()
+
+
+class ShortcodeEngine(object):
+    """compiles pages, expands them with cached call results and tracks who depends on what"""
+    def __init__(self, max_results=1024):
+        self.max_results = max_results
+        self.shortcodes = {}
+        for shortcode in BUILTIN:
+            self.register(shortcode)
+        self._lock = threading.RLock()
+        self._epoch = None
+        self._built = False
+        # page _id => (slug, dependencies)
+        self._refs = {}
+        # dependency => set of slugs of the pages using it
+        self._referrers = {}
+        # page _id => listing_signature, to tell whether a save changes the recent list
+        self._signatures = {}
+        # (name, args) => HTML, and dependency => result keys
+        self._results = {}
+        self._results_by_dep = {}
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, shortcode):
+        self.shortcodes[shortcode.name] = shortcode
+
+    # ---- compile -------------------------------------------------------
+
+    def parse_args(self, shortcode, text):
+        """'about' / 'count=5 title="x y"' => dict"""
+        try:
+            words = shlex.split(html.unescape(text))
+        except ValueError:
+            words = text.split()
+        args = {}
+        for word in words:
+            key, sep, value = word.partition('=')
+            if sep:
+                args[key] = value
+            elif shortcode.positional and shortcode.positional not in args:
+                args[shortcode.positional] = word
+        return args
+
+    def compile(self, content):
+        """(segments, dependencies) of HTML content, segments is None without shortcodes.
+        segments are literal strings and {'name': ..., 'args': {...}} calls
+        """
+        segments = []
+        deps = set()
+        position = 0
+        for match in SHORTCODE_RE.finditer(content):
+            shortcode = self.shortcodes.get(match.group(1))
+            if shortcode is None:
+                # not ours, left as written
+                continue
+            args = self.parse_args(shortcode, match.group(2))
+            if match.start() > position:
+                segments.append(content[position:match.start()])
+            segments.append({'name': shortcode.name, 'args': args})
+            deps.update(shortcode.depends(args))
+            position = match.end()
+        if not segments:
+            return None, []
+        if position < len(content):
+            segments.append(content[position:])
+        return segments, sorted(deps)
+
+    def compile_page(self, page):
+        """store the compiled content of a page being saved in page['shortcodes'] and page['shortcode_deps']"""
+        page['shortcodes'], page['shortcode_deps'] = self.compile(page_html(page))
+
+    def program(self, page):
+        """the compiled segments of a page, compiled now if it was saved before shortcodes existed"""
+        if 'shortcodes' in page:
+            return page['shortcodes']
+        return self.compile(page_html(page))[0]
+
+    def page_deps(self, page):
+        if 'shortcode_deps' in page:
+            return page['shortcode_deps'] or []
+        return self.compile(page_html(page))[1]
+
+    # ---- expand --------------------------------------------------------
+
+    def expand(self, db, page):
+        """the content of a page with its shortcodes expanded, as Markup"""
+        program = self.program(page)
+        if program is None:
+            return Markup(page_html(page))
+        expansion = Expansion(self, db)
+        expansion.stack.append(page.get('slug'))
+        return Markup(self.expand_program(expansion, program))
+
+    def expand_program(self, expansion, program):
+        return ''.join(segment if isinstance(segment, str) else self.call(expansion, segment)
+                       for segment in program)
+
+    def call(self, expansion, segment):
+        shortcode = self.shortcodes.get(segment['name'])
+        if shortcode is None:
+            return ''
+        args = segment.get('args') or {}
+        key = (shortcode.name, tuple(sorted(args.items())))
+        # an embedded page's output depends on where it is embedded from only through cycles
+        cacheable = len(expansion.stack) == 1
+        if cacheable:
+            result = self._results.get(key)
+            if result is not None:
+                self.hits += 1
+                return result
+        self.misses += 1
+        result = shortcode.render(expansion, args)
+        if cacheable:
+            with self._lock:
+                if len(self._results) >= self.max_results:
+                    self._results.clear()
+                    self._results_by_dep.clear()
+                self._results[key] = result
+                for dep in shortcode.depends(args):
+                    self._results_by_dep.setdefault(dep, set()).add(key)
+        return result
+
+    # ---- dependency graph ----------------------------------------------
+
+    def ensure(self, db, epoch=None):
+        """build the graph if needed, rebuilt when another process changed pages or files (epoch)"""
+        if epoch == self._epoch and self._built:
+            return
+        with self._lock:
+            if epoch != self._epoch:
+                self._built = False
+                self._epoch = epoch
+            if not self._built:
+                self._build(db)
+
+    def _build(self, db):
+        self._refs = {}
+        self._referrers = {}
+        self._signatures = {}
+        self._results = {}
+        self._results_by_dep = {}
+        for page in db.pages.find():
+            self._signatures[page['_id']] = listing_signature(page)
+            self._reference(page)
+        self._built = True
+
+    def _reference(self, page):
+        self._unreference(page['_id'])
+        deps = self.page_deps(page)
+        self._refs[page['_id']] = (page.get('slug'), deps)
+        for dep in deps:
+            self._referrers.setdefault(dep, set()).add(page.get('slug'))
+
+    def _unreference(self, page_id):
+        slug, deps = self._refs.pop(page_id, (None, ()))
+        for dep in deps:
+            referrers = self._referrers.get(dep)
+            if referrers is not None:
+                referrers.discard(slug)
+                if not referrers:
+                    del self._referrers[dep]
+
+    def _invalidate(self, deps):
+        """drop the results depending on deps, returns the slugs of the pages showing them"""
+        stale = set()
+        pending = list(deps)
+        while pending:
+            dep = pending.pop()
+            for key in self._results_by_dep.pop(dep, ()):
+                self._results.pop(key, None)
+            for slug in self._referrers.get(dep, ()):
+                if slug and slug not in stale:
+                    stale.add(slug)
+                    # pages embedding that page are stale as well
+                    pending.append(page_dep(slug))
+        return stale
+
+    def page_saved(self, page, old_slug=None):
+        """update the graph after a save, returns the slugs of the pages to re-render"""
+        with self._lock:
+            if not self._built:
+                return set()
+            deps = set(page_dep(slug) for slug in (old_slug, page.get('slug')) if slug)
+            signature = listing_signature(page)
+            if self._signatures.get(page['_id']) != signature:
+                deps.add('pages')
+            self._signatures[page['_id']] = signature
+            self._reference(page)
+            return self._invalidate(deps)
+
+    def page_removed(self, page):
+        """forget a deleted page, returns the same as page_saved"""
+        with self._lock:
+            if not self._built:
+                return set()
+            deps = set([page_dep(page.get('slug'))])
+            if self._signatures.pop(page['_id'], None) is not None:
+                deps.add('pages')
+            self._unreference(page['_id'])
+            return self._invalidate(deps)
+
+    def files_changed(self):
+        """a file was uploaded, renamed or deleted, returns the slugs of the pages to re-render"""
+        with self._lock:
+            if not self._built:
+                return set()
+            return self._invalidate(['files'])
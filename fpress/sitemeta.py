@@ -0,0 +1,103 @@
+# sitemeta.py
+# cached site settings (the meta document) and lazily computed request globals
+import threading
+
+from flask import current_app, g
+from flask.ctx import _AppCtxGlobals
+
+from utils import token_generator
+
+DEFAULT_THEME = 'default'
+DEFAULT_BRAND = 'FlaskPress'
+DEFAULT_STYLESHEET = "https://cdnjs.cloudflare.com/ajax/libs/bulma/0.8.0/css/bulma.min.css"
+
+
+class MetaCache(object):
+    """in-process, versioned snapshot of the meta document, one per app
+    (app.extensions['fpress'].meta_cache).
+    Readers share one snapshot until a writer calls invalidate(), which bumps
+    the version so the next reader reloads from the database.  A write by
+    another worker process (see coherence.py) also forces a reload.
+    The snapshot is shared, treat it as read-only (copy it before changing it).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._snapshot_version = None
+        self.version = 0
+
+    def get(self, db):
+        """return the cached meta document, loading it if stale"""
+        snapshot = self._snapshot
+        version = (self.version, db.meta.epoch())
+        if snapshot is not None and self._snapshot_version == version:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or self._snapshot_version != version:
+                # remember the version we loaded against, an invalidate() that
+                # races with the load forces another reload on the next read
+                self._snapshot = db.meta.find_one() or {}
+                self._snapshot_version = version
+            return self._snapshot
+
+    def invalidate(self):
+        """call after writing the meta document"""
+        with self._lock:
+            self.version += 1
+
+
+def _meta(g):
+    state = current_app.extensions['fpress']
+    return state.meta_cache.get(g.get('db') or state.db)
+
+def _theme(g):
+    return g.meta.get('theme', DEFAULT_THEME)
+
+def _brand(g):
+    return g.meta.get('brand', DEFAULT_BRAND)
+
+def _navbackground(g):
+    return g.meta.get('navbackground', False)
+
+def _stylesheet(g):
+    stylesheet = g.meta.get('stylesheet')
+    if stylesheet is None:
+        stylesheet = DEFAULT_STYLESHEET
+    return stylesheet
+
+def _macro_csrf_token(g):
+    return token_generator(size=24)
+
+# attributes of g that are computed on first access, name => loader(g)
+LAZY_ATTRIBUTES = {
+    'meta': _meta,
+    'theme': _theme,
+    'brand': _brand,
+    'navbackground': _navbackground,
+    'stylesheet': _stylesheet,
+    'macro_csrf_token': _macro_csrf_token,
+}
+
+
+class LazyGlobals(_AppCtxGlobals):
+    """flask.g replacement, site settings are only looked up when a view or
+    template actually touches them (static files and 404s pay nothing)
+    install with app.app_ctx_globals_class = LazyGlobals
+    """
+    def __getattr__(self, name):
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            pass
+        loader = LAZY_ATTRIBUTES.get(name)
+        if loader is None:
+            raise AttributeError(name)
+        value = loader(self)
+        self.__dict__[name] = value
+        return value
+
+
+def refresh_site_globals():
+    """forget lazily computed settings on g, e.g. after the meta document changed"""
+    for name in LAZY_ATTRIBUTES:
+        g.pop(name, None)
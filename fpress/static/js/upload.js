@@ -29,7 +29,25 @@ function show_alert(message, alert) {
 
 }
 
+// Chunk size in bytes, the page may set UPLOAD_CHUNK_SIZE before loading this script
+var chunk_size = (typeof UPLOAD_CHUNK_SIZE !== "undefined") ? UPLOAD_CHUNK_SIZE : 2 * 1024 * 1024;
+
+// The request currently in flight (so it can be cancelled)
+var request = null;
+
+// Id of an upload, derived from the file so a failed upload of the same file
+// resumes where it stopped (also after reloading the page)
+function upload_id_for(file) {
+
+  var id = `${file.size}-${file.lastModified}-${file.name}`.replace(/[^A-Za-z0-9_-]/g, "");
+
+  return id.substring(0, 64).padEnd(8, "0");
+
+}
+
 // Function to upload file
+// The file is sent in chunks using the Dropzone chunking fields, the server
+// reports how many bytes it has so an interrupted upload can be resumed
 function upload(url) {
 
   // Reject if the file input is empty & throw alert
@@ -41,15 +59,6 @@ function upload(url) {
 
   }
 
-  // Create a new FormData instance
-  var data = new FormData();
-
-  // Create a XMLHTTPRequest instance
-  var request = new XMLHttpRequest();
-
-  // Set the response type
-  request.responseType = "json";
-
   // Clear any existing alerts
   alert_wrapper.innerHTML = "";
 
@@ -71,25 +80,55 @@ function upload(url) {
   // Get a reference to the file
   var file = input.files[0];
 
-  // Get a reference to the filename
-  var filename = file.name;
+  // Get a reference to the upload id
+  var upload_id = upload_id_for(file);
+
+  // Ask the server how much of this file it already has
+  request = new XMLHttpRequest();
+  request.responseType = "json";
+  request.addEventListener("load", function (e) {
+
+    var offset = (request.status == 200 && request.response) ? request.response.received : 0;
 
-  // Get a reference to the filesize & set a cookie
-  var filesize = file.size;
-  document.cookie = `filesize=${filesize}`;
+    send_chunk(url, file, upload_id, offset);
 
-  // Append the file to the FormData instance
-  data.append("file", file);
+  });
+  request.addEventListener("error", upload_failed);
+  request.open("get", `${url}/status?dzuuid=${encodeURIComponent(upload_id)}`);
+  request.send();
+
+  cancel_btn.onclick = function () {
+
+    request.abort();
+
+  };
+
+}
+
+// Send the chunk of file starting at offset, then the next one
+function send_chunk(url, file, upload_id, offset) {
+
+  // Create a new FormData instance with the Dropzone chunk fields
+  var data = new FormData();
+  data.append("dzuuid", upload_id);
+  data.append("dzchunkindex", Math.floor(offset / chunk_size));
+  data.append("dzchunksize", chunk_size);
+  data.append("dzchunkbyteoffset", offset);
+  data.append("dztotalfilesize", file.size);
+  data.append("dztotalchunkcount", Math.ceil(file.size / chunk_size));
+  data.append("file", file.slice(offset, offset + chunk_size), file.name);
+
+  // Create a XMLHTTPRequest instance
+  request = new XMLHttpRequest();
+
+  // Set the response type
+  request.responseType = "json";
 
   // request progress handler
   request.upload.addEventListener("progress", function (e) {
 
-    // Get the loaded amount and total filesize (bytes)
-    var loaded = e.loaded;
-    var total = e.total
-
-    // Calculate percent uploaded
-    var percent_complete = (loaded / total) * 100;
+    // Calculate percent uploaded of the whole file
+    var percent_complete = ((offset + e.loaded) / file.size) * 100;
 
     // Update the progress text and progress bar
     progress.setAttribute("style", `width: ${Math.floor(percent_complete)}%`);
@@ -97,33 +136,37 @@ function upload(url) {
 
   })
 
-  // request load handler (transfer complete)
+  // request load handler (chunk transfer complete)
   request.addEventListener("load", function (e) {
 
-    if (request.status == 200) {
+    var response = request.response || {};
 
-      show_alert(`${request.response.message}`, "success");
+    if (request.status == 200 && response.complete) {
 
-    }
-    else {
+      show_alert(`${response.message}`, "success");
 
-      show_alert(`Error uploading file`, "danger");
+      reset();
 
     }
+    else if (request.status == 200 || (request.status == 409 && response.received != null)) {
 
-    reset();
+      // Continue where the server says it is
+      send_chunk(url, file, upload_id, response.received);
 
-  });
+    }
+    else {
 
-  // request error handler
-  request.addEventListener("error", function (e) {
+      reset();
 
-    reset();
+      show_alert(response.message || `Error uploading file`, "danger");
 
-    show_alert(`Error uploading file`, "warning");
+    }
 
   });
 
+  // request error handler, the upload can be resumed by uploading the same file again
+  request.addEventListener("error", upload_failed);
+
   // request abort handler
   request.addEventListener("abort", function (e) {
 
@@ -137,11 +180,14 @@ function upload(url) {
   request.open("post", url);
   request.send(data);
 
-  cancel_btn.addEventListener("click", function () {
+}
 
-    request.abort();
+// Connection problems, the next attempt resumes the upload
+function upload_failed(e) {
 
-  })
+  reset();
+
+  show_alert(`Error uploading file, try again to resume the upload`, "warning");
 
 }
 
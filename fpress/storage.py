@@ -0,0 +1,401 @@
+# storage.py
+# pluggable storage backends
+#
+# The app only needs a handful of pymongo style calls from a collection:
+#   find, find_one, insert_one, insert, update_one, update_many, delete_many, remove
+# Three backends provide them:
+#   tinymongo  the original flat JSON files (TinyMongo)
+#   sqlite     one SQLite database in WAL mode, documents stored as JSON with
+#              the slug/username/owner fields copied into indexed columns
+#   journal    JSON snapshot + append-only write journal, see journal.py
+# Pick one in app.cfg with DATABASE_BACKEND / DATABASE_PATH / DATABASE_NAME.
+import json
+import os
+import sqlite3
+import threading
+import uuid
+
+# the collections the app uses, in the order migrate.py copies them
+COLLECTIONS = ['pages', 'users', 'files', 'meta', 'deleted', 'blobs', 'tasks']
+
+# fields copied out of the JSON document into their own indexed SQLite column
+SQLITE_INDEXED_FIELDS = ['slug', 'username', 'owner']
+
+
+class InsertOneResult(object):
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+class UpdateResult(object):
+    def __init__(self, matched_count, modified_count):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+
+class DeleteResult(object):
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+
+def new_id():
+    """document _id in the same format TinyMongo uses"""
+    return uuid.uuid4().hex
+
+def has_operators(doc):
+    """True if doc is an update document ($set etc.) rather than a replacement"""
+    return any(key.startswith('$') for key in doc)
+
+def apply_update(doc, update):
+    """apply a $set/$unset update document to doc (in place)"""
+    for operator, fields in update.items():
+        if operator == '$set':
+            doc.update(fields)
+        elif operator == '$unset':
+            for field in fields:
+                doc.pop(field, None)
+        else:
+            raise NotImplementedError("update operator {} is not supported".format(operator))
+    return doc
+
+
+################ TinyMongo backend ################
+
+class TinyMongoCollection(object):
+    """thin adapter over a TinyMongo collection.
+    update_one() keeps accepting a whole replacement document, which older
+    TinyMongo releases merged and newer ones reject.
+    """
+    # every write rewrites the collection's JSON file, bulk loads go in one insert()
+    rewrites_file = True
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, filter=None, *args, **kwargs):
+        return self.collection.find(filter or {}, *args, **kwargs)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        return self.collection.find_one(filter or {}, *args, **kwargs)
+
+    def insert_one(self, doc):
+        return self.collection.insert_one(doc)
+
+    def insert(self, docs):
+        """a document or a list of documents, a list is written to the file once"""
+        if not isinstance(docs, list):
+            return self.insert_one(docs)
+        insert_many = getattr(self.collection, 'insert_many', None)
+        if not docs or insert_many is None:
+            return [self.insert_one(doc) for doc in docs]
+        result = insert_many(docs)
+        return [InsertOneResult(_id) for _id in result.inserted_ids]
+
+    def update_one(self, filter, doc):
+        if has_operators(doc):
+            return self.collection.update_one(filter, doc)
+        replace_one = getattr(self.collection, 'replace_one', None)
+        if replace_one is None:
+            return self.collection.update_one(filter, doc)
+        return replace_one(filter, doc)
+
+    def update_many(self, filter, doc):
+        return self.collection.update_many(filter, doc)
+
+    def delete_many(self, filter):
+        self._reopen_table()
+        return self.collection.delete_many(filter)
+
+    def remove(self, filter):
+        return self.delete_many(filter)
+
+    def _reopen_table(self):
+        """TinyMongo replaces its TinyDB object when another collection is opened, and
+        deletes turn off merging writes with the file only on the current one's storage.
+        A table opened earlier would merge the deleted documents back, so open it again.
+        """
+        table = getattr(self.collection, 'table', None)
+        tinydb = getattr(self.collection.parent, 'tinydb', None)
+        if table is None or tinydb is None:
+            return
+        storage = getattr(table, '_storage', None)
+        # TinyDB 3 tables write through a StorageProxy
+        storage = getattr(storage, '_storage', storage)
+        if storage is not getattr(tinydb, '_storage', None):
+            self.collection.table = None
+
+    def refresh(self):
+        """forget what TinyDB remembers about the file (query cache, last document id),
+        call after another process wrote to it
+        """
+        table = getattr(self.collection, 'table', None)
+        if table is None:
+            # not opened yet, the first read loads the file
+            return
+        table.clear_cache()
+        # the next insert must not reuse an id the other process handed out
+        table._init_last_id(table._read())
+
+
+class TinyMongoBackend(object):
+    """database of TinyMongo collections, JSON files in a folder"""
+    def __init__(self, path='tinydb', name='blog'):
+        from tinymongo import TinyMongoClient
+        self.db = TinyMongoClient(path)[name]
+        self._collections = {}
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = TinyMongoCollection(self.db[name])
+        return collection
+
+    def collection_names(self):
+        return list(COLLECTIONS)
+
+
+################ SQLite backend ################
+
+class SQLiteCollection(object):
+    """a collection stored in one SQLite table.
+    Filters are plain {field: value} equality filters (what the app uses),
+    _id and the SQLITE_INDEXED_FIELDS are matched on indexed columns.
+    """
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+        self.table = '"{}"'.format(name.replace('"', '""'))
+        self._created = False
+
+    def _ensure_table(self):
+        if self._created:
+            return
+        with self.backend.write() as conn:
+            columns = ''.join(', {} TEXT'.format(field) for field in SQLITE_INDEXED_FIELDS)
+            conn.execute('CREATE TABLE IF NOT EXISTS {} (_id TEXT PRIMARY KEY, doc TEXT NOT NULL{})'
+                         .format(self.table, columns))
+            for field in SQLITE_INDEXED_FIELDS:
+                conn.execute('CREATE INDEX IF NOT EXISTS "{0}_{1}" ON {2} ({1})'
+                             .format(self.name, field, self.table))
+        self._created = True
+
+    def _where(self, query):
+        """SQL WHERE clause and parameters for an equality filter"""
+        clauses, params = [], []
+        for field, value in (query or {}).items():
+            if field.startswith('$') or isinstance(value, dict):
+                raise NotImplementedError("query operators are not supported by the sqlite backend")
+            if field == '_id' or field in SQLITE_INDEXED_FIELDS:
+                column = field
+            else:
+                column = "json_extract(doc, '$.\"{}\"')".format(field.replace('"', ''))
+            if value is None:
+                clauses.append('{} IS NULL'.format(column))
+            else:
+                if isinstance(value, (list, tuple)):
+                    value = json.dumps(value)
+                clauses.append('{} = ?'.format(column))
+                params.append(value)
+        if not clauses:
+            return '', params
+        return ' WHERE ' + ' AND '.join(clauses), params
+
+    def _row(self, doc):
+        return [doc['_id'], json.dumps(doc, default=str)] + \
+               [self._column_value(doc.get(field)) for field in SQLITE_INDEXED_FIELDS]
+
+    @staticmethod
+    def _column_value(value):
+        return value if isinstance(value, str) else None
+
+    def iter_documents(self, filter=None, batch_size=500):
+        """generator over matching documents, fetched batch_size rows at a time"""
+        self._ensure_table()
+        where, params = self._where(filter)
+        cursor = self.backend.read().execute(
+            'SELECT doc FROM {}{} ORDER BY rowid'.format(self.table, where), params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for (doc,) in rows:
+                yield json.loads(doc)
+
+    def find(self, filter=None, *args, **kwargs):
+        return list(self.iter_documents(filter))
+
+    def find_one(self, filter=None, *args, **kwargs):
+        self._ensure_table()
+        where, params = self._where(filter)
+        row = self.backend.read().execute(
+            'SELECT doc FROM {}{} ORDER BY rowid LIMIT 1'.format(self.table, where), params).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _insert_rows(self, conn, docs):
+        for doc in docs:
+            if doc.get('_id') is None:
+                doc['_id'] = new_id()
+        placeholders = ', '.join('?' * (2 + len(SQLITE_INDEXED_FIELDS)))
+        conn.executemany('INSERT INTO {} (_id, doc, {}) VALUES ({})'
+                         .format(self.table, ', '.join(SQLITE_INDEXED_FIELDS), placeholders),
+                         [self._row(doc) for doc in docs])
+
+    def insert_one(self, doc):
+        self._ensure_table()
+        with self.backend.write() as conn:
+            self._insert_rows(conn, [doc])
+        return InsertOneResult(doc['_id'])
+
+    def insert(self, docs):
+        """a document or a list of documents, a list is written in one transaction"""
+        if not isinstance(docs, list):
+            return self.insert_one(docs)
+        self._ensure_table()
+        with self.backend.write() as conn:
+            self._insert_rows(conn, docs)
+        return [InsertOneResult(doc['_id']) for doc in docs]
+
+    def update_one(self, filter, doc):
+        """update the first match with $set/$unset or replace it with a whole document"""
+        self._ensure_table()
+        with self.backend.write() as conn:
+            where, params = self._where(filter)
+            row = conn.execute('SELECT doc FROM {}{} ORDER BY rowid LIMIT 1'
+                               .format(self.table, where), params).fetchone()
+            if row is None:
+                return UpdateResult(0, 0)
+            current = json.loads(row[0])
+            if has_operators(doc):
+                new_doc = apply_update(dict(current), doc)
+            else:
+                new_doc = dict(doc)
+            new_doc['_id'] = current['_id']
+            values = self._row(new_doc)
+            conn.execute('UPDATE {} SET doc = ?, {} WHERE _id = ?'
+                         .format(self.table, ', '.join('{} = ?'.format(f) for f in SQLITE_INDEXED_FIELDS)),
+                         values[1:] + [current['_id']])
+        return UpdateResult(1, int(new_doc != current))
+
+    def update_many(self, filter, doc):
+        """$set/$unset update of every match, in one transaction"""
+        if not has_operators(doc):
+            raise ValueError("update_many needs an update document ($set/$unset)")
+        self._ensure_table()
+        with self.backend.write() as conn:
+            where, params = self._where(filter)
+            rows = conn.execute('SELECT doc FROM {}{}'.format(self.table, where), params).fetchall()
+            changed = []
+            for (raw,) in rows:
+                current = json.loads(raw)
+                new_doc = apply_update(dict(current), doc)
+                if new_doc != current:
+                    values = self._row(new_doc)
+                    changed.append(values[1:] + [current['_id']])
+            conn.executemany('UPDATE {} SET doc = ?, {} WHERE _id = ?'
+                             .format(self.table, ', '.join('{} = ?'.format(f) for f in SQLITE_INDEXED_FIELDS)),
+                             changed)
+        return UpdateResult(len(rows), len(changed))
+
+    def delete_many(self, filter):
+        self._ensure_table()
+        with self.backend.write() as conn:
+            where, params = self._where(filter)
+            cursor = conn.execute('DELETE FROM {}{}'.format(self.table, where), params)
+        return DeleteResult(cursor.rowcount)
+
+    def remove(self, filter):
+        return self.delete_many(filter)
+
+
+class SQLiteBackend(object):
+    """database of SQLite tables, one connection per thread, WAL journal.
+    WAL lets readers proceed while another process or thread is writing.
+    """
+    def __init__(self, path='fpress.sqlite3', name=None):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._collections = {}
+
+    def read(self):
+        """this thread's connection"""
+        conn = getattr(self._local, 'conn', None)
+        # never reuse a connection inherited from the parent of a forked worker
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def write(self):
+        """context manager for a write transaction"""
+        return _WriteTransaction(self)
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = SQLiteCollection(self, name)
+        return collection
+
+    def collection_names(self):
+        rows = self.read().execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+        names = [row[0] for row in rows]
+        return [name for name in COLLECTIONS if name in names] + \
+               sorted(name for name in names if name not in COLLECTIONS)
+
+
+class _WriteTransaction(object):
+    """serializes writers within the process, commits or rolls back on exit"""
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __enter__(self):
+        self.backend._write_lock.acquire()
+        self.conn = self.backend.read()
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.backend._write_lock.release()
+
+
+def journal_backend(path, name='blog', **options):
+    # imported here, journal.py builds on this module
+    from journal import JournalBackend
+    return JournalBackend(path, name, **options)
+
+
+BACKENDS = {
+    'tinymongo': TinyMongoBackend,
+    'sqlite': SQLiteBackend,
+    'journal': journal_backend,
+}
+
+def open_backend(backend, path, name='blog', **options):
+    """open a storage backend by name"""
+    try:
+        cls = BACKENDS[backend]
+    except KeyError:
+        raise ValueError("unknown DATABASE_BACKEND {!r}, choose one of {}".format(backend, sorted(BACKENDS)))
+    return cls(path, name, **options)
+
+DEFAULT_PATHS = {'tinymongo': 'tinydb', 'sqlite': 'fpress.sqlite3', 'journal': 'journaldb'}
+
+def open_database(config):
+    """open the backend configured in app.cfg"""
+    backend = config.get('DATABASE_BACKEND', 'tinymongo')
+    options = {}
+    if backend == 'journal':
+        if config.get('MULTIPROCESS'):
+            raise ValueError("the journal backend keeps the data in one process, it cannot be used with MULTIPROCESS")
+        options = {'commit_window': config.get('JOURNAL_COMMIT_WINDOW', 0.002),
+                   'fsync': config.get('JOURNAL_FSYNC', True),
+                   'compact_bytes': config.get('JOURNAL_COMPACT_BYTES', 4 * 1024 * 1024)}
+    path = config.get('DATABASE_PATH') or DEFAULT_PATHS.get(backend)
+    return open_backend(backend, path, config.get('DATABASE_NAME', 'blog'), **options)
@@ -0,0 +1,272 @@
+# tasks.py
+# background tasks: work that follows a save runs after the response
+#
+# Views store the document, enqueue the follow-up work and answer at once
+# (e.g. page_edit redirects while the page is re-indexed).  Tasks have a name,
+# which selects the handler registered for it, and a key, usually the _id of
+# the document they work on.  A task enqueued while an identical (name, key)
+# task is still waiting replaces it, so ten quick saves of a page index it
+# once.  Handlers must be idempotent and read the current document rather
+# than trust their arguments: a failed task is retried with exponential
+# backoff, up to max_attempts times.
+#
+# Tasks run on a small pool of worker threads, inside an app context.  With
+# durable=True every task is also stored in the `tasks` collection until it
+# is done, so tasks queued when a process stops are picked up again by the
+# next one.  workers=0 runs every task inline in enqueue() (tests, scripts).
+# The worker threads are stopped at interpreter exit, after the task each is
+# running.
+import atexit
+import collections
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+import time
+import traceback
+
+log = logging.getLogger('fpress.tasks')
+
+# a durable task still marked running after this many seconds belongs to a dead process
+STALE_SECONDS = 600
+
+
+class Task(object):
+    __slots__ = ('name', 'key', 'args', 'attempts', 'run_at', 'doc_id', 'error')
+
+    def __init__(self, name, key, args, attempts=0, run_at=0.0, doc_id=None):
+        self.name = name
+        self.key = key
+        self.args = args
+        self.attempts = attempts
+        self.run_at = run_at
+        # _id in the tasks collection (durable queues)
+        self.doc_id = doc_id
+        self.error = None
+
+
+def now_stamp():
+    return str(datetime.datetime.now())
+
+
+class TaskQueue(object):
+    """in-process task queue with retries and per (name, key) deduplication"""
+    def __init__(self, app, workers=2, max_attempts=5, retry_delay=1.0, durable=False, history=50):
+        self.app = app
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.durable = durable
+        self.handlers = {}
+        # (name, key) => Task waiting to run
+        self._waiting = {}
+        # (run_at, sequence, (name, key)), entries of replaced tasks are skipped
+        self._heap = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._started = False
+        self._stopping = False
+        # totals since start, and the last failures for the admin view
+        self.counts = collections.Counter()
+        self.failures = collections.deque(maxlen=history)
+
+    def register(self, name, handler):
+        """handler(key, **args) runs the tasks called name"""
+        self.handlers[name] = handler
+
+    def task(self, name):
+        """decorator form of register"""
+        def decorator(handler):
+            self.register(name, handler)
+            return handler
+        return decorator
+
+    def _collection(self):
+        return self.app.extensions['fpress'].db.tasks
+
+    # ---- enqueue -------------------------------------------------------
+
+    def enqueue(self, name, key, **args):
+        """schedule handlers[name](key, **args), replacing a waiting task with the same name and key.
+        returns False if it replaced one
+        """
+        if name not in self.handlers:
+            raise KeyError("no handler for task {}".format(name))
+        if self.workers <= 0:
+            self._execute(Task(name, key, args))
+            return True
+        self._start()
+        with self._cond:
+            task = self._waiting.get((name, key))
+            if task is not None:
+                task.args = args
+                if task.doc_id is not None:
+                    self._collection().update_one({'_id': task.doc_id}, {'$set': {'args': args}})
+                self.counts['deduplicated'] += 1
+                return False
+            task = Task(name, key, args)
+            if self.durable:
+                doc = {'name': name, 'key': key, 'args': args, 'attempts': 0, 'status': 'pending',
+                       'run_at': 0.0, 'created_at': now_stamp()}
+                self._collection().insert_one(doc)
+                task.doc_id = doc['_id']
+            self._schedule(task)
+            self.counts['enqueued'] += 1
+            return True
+
+    def _schedule(self, task):
+        """queue a task (lock held)"""
+        self._waiting[(task.name, task.key)] = task
+        heapq.heappush(self._heap, (task.run_at, next(self._sequence), (task.name, task.key)))
+        self._cond.notify()
+
+    # ---- workers -------------------------------------------------------
+
+    def _start(self):
+        # threads are started on first use, after a preforking server has forked
+        if self._started:
+            return
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+            if self.durable:
+                self._recover()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name='fpress-task-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            atexit.register(self.stop)
+
+    def _recover(self):
+        """queue the durable tasks left by a previous process (lock held)"""
+        collection = self._collection()
+        stale = time.time() - STALE_SECONDS
+        for doc in collection.find():
+            if doc.get('status') == 'running' and doc.get('started', 0) > stale:
+                # another worker process is on it
+                continue
+            if doc.get('status') not in ('pending', 'running') or (doc['name'], doc['key']) in self._waiting:
+                continue
+            if doc.get('status') == 'running':
+                collection.update_one({'_id': doc['_id']}, {'$set': {'status': 'pending'}})
+            self._schedule(Task(doc['name'], doc['key'], doc.get('args') or {}, attempts=doc.get('attempts', 0),
+                                run_at=doc.get('run_at', 0.0), doc_id=doc['_id']))
+            self.counts['recovered'] += 1
+
+    def _next(self):
+        """wait for the next due task, None when stopping"""
+        with self._cond:
+            while not self._stopping:
+                while self._heap:
+                    run_at, sequence, key = self._heap[0]
+                    task = self._waiting.get(key)
+                    if task is None or task.run_at != run_at:
+                        # replaced or rescheduled, a newer heap entry stands for it
+                        heapq.heappop(self._heap)
+                        continue
+                    break
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                task = self._waiting.pop(key)
+                self._running += 1
+                return task
+            return None
+
+    def _work(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            try:
+                self._execute(task)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._cond.notify_all()
+
+    def _execute(self, task):
+        handler = self.handlers[task.name]
+        if task.doc_id is not None:
+            self._collection().update_one({'_id': task.doc_id}, {'$set': {'status': 'running', 'started': time.time()}})
+        try:
+            with self.app.app_context():
+                handler(task.key, **task.args)
+        except Exception as e:
+            task.attempts += 1
+            task.error = '{}: {}'.format(type(e).__name__, e)
+            log.warning("task %s %s failed (attempt %d): %s", task.name, task.key, task.attempts, task.error)
+            self._failed(task, traceback.format_exc())
+        else:
+            self.counts['done'] += 1
+            if task.doc_id is not None:
+                self._collection().delete_many({'_id': task.doc_id})
+
+    def _failed(self, task, details):
+        with self._cond:
+            newer = (task.name, task.key) in self._waiting
+            if task.attempts < self.max_attempts and not newer and self.workers > 0:
+                task.run_at = time.time() + self.retry_delay * 2 ** (task.attempts - 1)
+                self._schedule(task)
+                self.counts['retried'] += 1
+                status = 'pending'
+            elif newer:
+                # a newer task for the same document replaces the failed one
+                status = None
+            else:
+                self.counts['failed'] += 1
+                self.failures.appendleft({'name': task.name, 'key': task.key, 'attempts': task.attempts,
+                                          'error': task.error, 'details': details, 'at': now_stamp()})
+                status = 'failed'
+        if task.doc_id is not None:
+            if status is None:
+                self._collection().delete_many({'_id': task.doc_id})
+            else:
+                self._collection().update_one({'_id': task.doc_id}, {'$set': {
+                    'status': status, 'attempts': task.attempts, 'run_at': task.run_at, 'error': task.error}})
+
+    # ---- inspection ----------------------------------------------------
+
+    def depth(self):
+        """tasks waiting (including retries not yet due)"""
+        return len(self._waiting)
+
+    def stats(self):
+        with self._cond:
+            waiting = list(self._waiting.values())
+            running = self._running
+        by_name = collections.Counter(task.name for task in waiting)
+        now = time.time()
+        return {'waiting': len(waiting), 'running': running,
+                'retrying': sum(1 for task in waiting if task.run_at > now),
+                'by_name': sorted(by_name.items()), 'counts': dict(self.counts),
+                'workers': self.workers, 'durable': self.durable}
+
+    def join(self, timeout=None):
+        """wait until nothing is waiting or running (retries included), True if drained"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._waiting or self._running:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self):
+        """let the worker threads finish their current task and exit, waiting tasks stay queued"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,103 @@
+# themes.py
+# theme templates: per-page template lookup, precompilation, bytecode cache
+#
+# A theme is a folder templates/themes/<theme>/.  site() renders a page with
+# themes/<g.theme>/<page.template>.html, e.g. themes/default/front_page.html,
+# falling back to the theme's page.html, then to the default theme's.  Only
+# the names in PAGE_TEMPLATES are page templates: the other files of a theme
+# (layout, navbar...) are partials, a page naming one gets page.html.  The
+# theme files are listed once at startup and every (theme, template) pair
+# resolves through a lookup table, so picking a template is a dict lookup
+# and a missing file is never discovered by catching TemplateNotFound.
+#
+# All templates are compiled when the served app starts (precompile_templates
+# in app.py), so the first request does not pay for it, and the compiled code
+# is kept in a Jinja bytecode cache on disk (TEMPLATE_CACHE_DIR): a restarted
+# worker loads it instead of compiling again.  Theme files added while the site runs are picked up on
+# the next start.
+import logging
+import os
+
+from jinja2 import FileSystemBytecodeCache, TemplateSyntaxError
+
+log = logging.getLogger('fpress.themes')
+
+THEMES_DIR = 'themes'
+DEFAULT_THEME = 'default'
+# the template of pages without one (or with one the theme lacks)
+PAGE_TEMPLATE = 'page'
+# the templates a page can choose, (name, label) as the page editor offers them
+PAGE_TEMPLATES = [
+    (PAGE_TEMPLATE, 'Standard'),
+    ('one_column', 'One column'),
+    ('sidebar_left', 'Left Sidebar'),
+    ('sidebar_right', 'Right Sidebar'),
+    ('sidebar_left_right', 'Sidebar Both'),
+    ('front_page', 'Front page'),
+]
+PAGE_TEMPLATE_NAMES = frozenset(name for name, label in PAGE_TEMPLATES)
+# lookups of names no theme has are memoized too, up to this many
+MAX_LOOKUPS = 4096
+
+
+def theme_template_path(theme, name):
+    return '{}/{}/{}.html'.format(THEMES_DIR, theme, name)
+
+def bytecode_cache(directory):
+    """a FileSystemBytecodeCache in directory (created if needed)"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return FileSystemBytecodeCache(directory, '__fpress_%s.cache')
+
+
+class ThemeRegistry(object):
+    """(theme, template name) => template path, from the files of templates/themes/"""
+    def __init__(self, jinja_env):
+        self.jinja_env = jinja_env
+        # theme => set of template names it has
+        self.themes = {}
+        self._lookup = {}
+        self.scan()
+
+    def scan(self):
+        """list the theme files, forgetting earlier lookups"""
+        themes = {}
+        for path in self.jinja_env.list_templates(extensions=['html']):
+            parts = path.split('/')
+            if len(parts) == 3 and parts[0] == THEMES_DIR:
+                themes.setdefault(parts[1], set()).add(parts[2][:-len('.html')])
+        self.themes = themes
+        self._lookup = {}
+
+    def resolve(self, theme, template=None):
+        """path of the template to render a page with"""
+        key = (theme, template)
+        path = self._lookup.get(key)
+        if path is None:
+            path = self._resolve(theme, template)
+            if len(self._lookup) < MAX_LOOKUPS:
+                self._lookup[key] = path
+        return path
+
+    def _resolve(self, theme, template):
+        if template not in PAGE_TEMPLATE_NAMES:
+            template = PAGE_TEMPLATE
+        for candidate_theme, name in ((theme, template), (theme, PAGE_TEMPLATE),
+                                      (DEFAULT_THEME, template), (DEFAULT_THEME, PAGE_TEMPLATE)):
+            if name in self.themes.get(candidate_theme, ()):
+                return theme_template_path(candidate_theme, name)
+        # no theme at all, render_template will say so
+        return theme_template_path(DEFAULT_THEME, PAGE_TEMPLATE)
+
+    def precompile(self):
+        """compile every template (through the bytecode cache, if any), returns how many"""
+        count = 0
+        for path in self.jinja_env.list_templates(extensions=['html']):
+            try:
+                self.jinja_env.get_template(path)
+            except TemplateSyntaxError as e:
+                # reported again when a view renders it
+                log.warning("template %s does not compile: %s", path, e)
+                continue
+            count += 1
+        return count
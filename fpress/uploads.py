@@ -0,0 +1,220 @@
+# uploads.py
+# streaming, resumable (chunked) uploads
+#
+# A file arrives either in one request or as a series of chunks using the
+# Dropzone.js chunking fields (dzuuid, dzchunkbyteoffset, dztotalfilesize...),
+# which static/js/upload.js sends as well.  Chunks are appended to a partial
+# file in UPLOAD_TMP_FOLDER while the SHA-256 is computed and the content type
+# is sniffed from the first bytes, so memory use does not depend on the file
+# size.  Size limits are checked before any data is written.  If a connection
+# drops the client asks for status() and continues from the bytes received.
+import collections
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+BLOCK_SIZE = 64 * 1024
+
+# upload ids come from the client, keep them boring
+UPLOAD_ID_RE = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
+# content type expected for each allowed extension
+EXTENSION_TYPES = {
+    'txt': 'text/plain',
+    'pdf': 'application/pdf',
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+}
+
+# path is the completed (partial) file, the caller moves it into place
+CompletedUpload = collections.namedtuple('CompletedUpload', 'path filename size sha256 content_type')
+
+
+class UploadError(Exception):
+    """an upload was refused, status is the HTTP status to answer with.
+    received tells a chunked client where to continue from.
+    """
+    def __init__(self, message, status=400, received=None):
+        super(UploadError, self).__init__(message)
+        self.message = message
+        self.status = status
+        self.received = received
+
+
+def sniff_content_type(head):
+    """content type from the first bytes of a file, None if unrecognized"""
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'GIF87a') or head.startswith(b'GIF89a'):
+        return 'image/gif'
+    if head.startswith(b'%PDF-'):
+        return 'application/pdf'
+    if b'\x00' not in head:
+        return 'text/plain'
+    return None
+
+def check_content_type(filename, head):
+    """sniffed content type of head, UploadError if it does not match the extension"""
+    extension = filename.rsplit('.', 1)[-1].lower()
+    sniffed = sniff_content_type(head)
+    expected = EXTENSION_TYPES.get(extension)
+    if expected is None or sniffed != expected:
+        raise UploadError("File content does not match its .{} extension".format(extension), status=415)
+    return sniffed
+
+
+class UploadManager(object):
+    """keeps partial uploads in a directory, one .part and one .json per upload"""
+    def __init__(self, directory, max_file_size=0, partial_ttl=24 * 3600):
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.partial_ttl = partial_ttl
+        # key => (bytes hashed, hash object), saves re-reading the partial file
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._cleaned = 0
+
+    def _key(self, owner, upload_id):
+        if not UPLOAD_ID_RE.match(upload_id or ''):
+            raise UploadError("Invalid upload id")
+        # the owner is part of the key, one user cannot resume another's upload
+        return hashlib.sha1('{}\0{}'.format(owner, upload_id).encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.part', base + '.json'
+
+    def _read_info(self, key):
+        part, info_path = self._paths(key)
+        try:
+            with open(info_path) as f:
+                info = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        info['received'] = os.path.getsize(part) if os.path.isfile(part) else 0
+        return info
+
+    def status(self, owner, upload_id):
+        """bytes received so far for an upload"""
+        info = self._read_info(self._key(owner, upload_id))
+        return info['received'] if info else 0
+
+    def check_size(self, size, remaining_quota=None):
+        """UploadError unless a file of size bytes is acceptable"""
+        if self.max_file_size and size > self.max_file_size:
+            raise UploadError("File is larger than the {} byte limit".format(self.max_file_size), status=413)
+        if remaining_quota is not None and size > remaining_quota:
+            raise UploadError("Upload would exceed your storage quota", status=413)
+
+    def receive(self, owner, upload_id, filename, stream, offset=0, total_size=None, remaining_quota=None):
+        """append a chunk read from stream at offset
+        total_size None means the whole file is in this request.
+        remaining_quota is only needed for the first chunk, it is kept with the upload.
+        returns (bytes received, CompletedUpload or None while incomplete)
+        """
+        key = self._key(owner, upload_id)
+        part, info_path = self._paths(key)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.cleanup()
+
+        info = self._read_info(key)
+        received = info['received'] if info else 0
+        if offset != received:
+            # client and server disagree, tell the client where to resume
+            raise UploadError("Upload out of sequence", status=409, received=received)
+        if info is not None:
+            # the quota was worked out once, when the upload started
+            remaining_quota = info.get('remaining_quota')
+        if total_size is not None:
+            self.check_size(total_size, remaining_quota)
+        if info is None:
+            info = {'filename': filename, 'total_size': total_size, 'content_type': None,
+                    'remaining_quota': remaining_quota, 'started': time.time()}
+            with open(info_path, 'w') as f:
+                json.dump(info, f)
+
+        hasher = self._hasher(key, part, received)
+        limit = total_size if total_size is not None else (self.max_file_size or None)
+        try:
+            with open(part, 'ab') as f:
+                while True:
+                    block = stream.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    if received == 0 and info.get('content_type') is None:
+                        info['content_type'] = check_content_type(filename, block)
+                        with open(info_path, 'w') as fi:
+                            json.dump(info, fi)
+                    received += len(block)
+                    if limit is not None and received > limit:
+                        raise UploadError("File is larger than announced or allowed", status=413)
+                    if remaining_quota is not None and received > remaining_quota:
+                        raise UploadError("Upload would exceed your storage quota", status=413)
+                    f.write(block)
+                    hasher.update(block)
+        except UploadError:
+            self.discard(owner, upload_id)
+            raise
+        with self._lock:
+            self._hashes[key] = (received, hasher)
+
+        if total_size is not None and received < total_size:
+            return received, None
+        if received == 0:
+            self.discard(owner, upload_id)
+            raise UploadError("Empty file")
+        completed = CompletedUpload(part, info['filename'], received, hasher.hexdigest(), info['content_type'])
+        with self._lock:
+            self._hashes.pop(key, None)
+        os.remove(info_path)
+        return received, completed
+
+    def _hasher(self, key, part, received):
+        """hash object fed with the first received bytes of the partial file"""
+        with self._lock:
+            state = self._hashes.get(key)
+        if state is not None and state[0] == received:
+            return state[1]
+        # resumed in another process or after a restart, hash what we have
+        hasher = hashlib.sha256()
+        if received:
+            with open(part, 'rb') as f:
+                remaining = received
+                while remaining:
+                    block = f.read(min(BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    hasher.update(block)
+                    remaining -= len(block)
+        return hasher
+
+    def discard(self, owner, upload_id):
+        """throw away a partial upload"""
+        key = self._key(owner, upload_id)
+        with self._lock:
+            self._hashes.pop(key, None)
+        for path in self._paths(key):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def cleanup(self):
+        """remove abandoned partial uploads (checked at most once an hour)"""
+        now = time.time()
+        if now - self._cleaned < 3600 or not os.path.isdir(self.directory):
+            return
+        self._cleaned = now
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > self.partial_ttl:
+                    os.remove(path)
+            except OSError:
+                pass
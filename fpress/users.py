@@ -1,15 +1,28 @@
 from werkzeug.security import generate_password_hash, check_password_hash
+from indexes import DuplicateKeyError
 
-def create_user(DB, username, password, email='', is_admin=False, is_active=True, bio="", avatar=""):
-    """create a user, hash the password"""
+# werkzeug hash method for new passwords, PASSWORD_HASH_METHOD in app.cfg
+PASSWORD_METHOD = 'scrypt'
+
+def hash_password(password, method=PASSWORD_METHOD):
+    """salted hash of a password, every password is hashed through here"""
+    return generate_password_hash(password, method=method)
+
+def create_user(DB, username, password, email='', is_admin=False, is_active=True, bio="", avatar="",
+                hasher=hash_password):
+    """create a user, hash the password (with hasher, e.g. AuthService.hash_password)"""
     # make sure username is UNIQUE
     u = DB.users.find_one({'username':username})
     if u:
         # user already exists, return None
         return None
-    hashedpw = generate_password_hash(password)
-    u = DB.users.insert_one({'username':username, 'password':hashedpw, 'is_admin':is_admin,
-                             'email':email, 'is_active':is_active, 'bio':bio, 'avatar':avatar})
+    hashedpw = hasher(password)
+    try:
+        u = DB.users.insert_one({'username':username, 'password':hashedpw, 'is_admin':is_admin,
+                                 'email':email, 'is_active':is_active, 'bio':bio, 'avatar':avatar})
+    except DuplicateKeyError:
+        # another process created the same user in the meantime
+        return None
     return u
 
 def createsuperuser(DB):
@@ -0,0 +1,37 @@
+# conftest.py
+# the fpress modules import each other as top-level modules (they run from
+# inside fpress/), so the tests put that folder on the path
+import os
+import sys
+
+import pytest
+
+FPRESS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fpress')
+if FPRESS_DIR not in sys.path:
+    sys.path.insert(0, FPRESS_DIR)
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """make_app(**settings) builds a seeded app whose files live in tmp_path"""
+    import app as appmod
+
+    def make(**settings):
+        config = {'DATABASE_PATH': str(tmp_path / 'db'), 'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+                  'TEMPLATE_CACHE_DIR': str(tmp_path / 'templates'), 'WTF_CSRF_ENABLED': False,
+                  'TASK_WORKERS': 0}
+        config.update(settings)
+        app = appmod.create_app(config)
+        appmod.seed(app)
+        return app
+    return make
+
+@pytest.fixture
+def admin_client():
+    """admin_client(app) is a test client logged in as admin"""
+    def client(app):
+        c = app.test_client()
+        with c.session_transaction() as session:
+            session.update(username='admin', is_authenticated=True, is_admin=True)
+        return c
+    return client
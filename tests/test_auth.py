@@ -0,0 +1,22 @@
+# test_auth.py
+# password pool: a timed-out hash still counts against the queue until it finishes
+import threading
+
+import pytest
+
+from auth import AuthService, Overloaded
+
+
+def test_timed_out_hash_keeps_its_queue_slot():
+    service = AuthService(workers=2, queue_limit=1, timeout=0.05)
+    release = threading.Event()
+    try:
+        with pytest.raises(Overloaded):
+            service._run(release.wait)
+        # still hashing, so the queue is still full
+        with pytest.raises(Overloaded):
+            service._run(lambda: True)
+    finally:
+        release.set()
+        service._pool.shutdown(wait=True)
+    assert service._pending == 0
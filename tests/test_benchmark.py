@@ -0,0 +1,25 @@
+# test_benchmark.py
+# the benchmark runs every scenario without errors and flags regressions
+import json
+
+import benchmark
+
+
+def test_every_scenario_runs_on_a_small_site(tmp_path, capsys):
+    output = str(tmp_path / 'results.json')
+    status = benchmark.main(['--pages', '30', '--files', '3', '--users', '2', '--threads', '2',
+                             '--requests', '8', '--warmup', '2', '--output', output])
+    assert status == 0
+    with open(output) as f:
+        results = json.load(f)
+    assert sorted(results['scenarios']) == sorted(benchmark.SCENARIOS)
+    for name, stats in results['scenarios'].items():
+        assert stats['errors'] == 0, (name, stats['exceptions'])
+
+def test_compare_reports_slower_scenarios():
+    baseline = {'scenarios': {'search': {'p50_ms': 10.0, 'p95_ms': 20.0, 'throughput_rps': 100.0}}}
+    same = {'scenarios': {'search': {'p50_ms': 11.0, 'p95_ms': 21.0, 'throughput_rps': 95.0}}}
+    slower = {'scenarios': {'search': {'p50_ms': 15.0, 'p95_ms': 21.0, 'throughput_rps': 70.0}}}
+    assert benchmark.compare(same, baseline) == []
+    regressions = benchmark.compare(slower, baseline)
+    assert [line.split(':')[0] for line in regressions] == ['search p50_ms', 'search throughput_rps']
@@ -0,0 +1,61 @@
+# test_blobs.py
+# content-addressed uploads: identical files share a blob until the last reference goes
+import hashlib
+import io
+import os
+
+from blobs import parse_blob_path
+
+
+def upload(client, data, filename):
+    response = client.post('/_upload', data={'file': (io.BytesIO(data), filename)})
+    assert response.status_code == 302
+    return response.headers['Location'].rsplit('/', 1)[-1]
+
+
+def test_identical_uploads_share_a_blob(make_app, admin_client):
+    app = make_app()
+    state = app.extensions['fpress']
+    client = admin_client(app)
+    data = b'the same words twice'
+    sha256 = hashlib.sha256(data).hexdigest()
+    first = upload(client, data, 'one.txt')
+    second = upload(client, data, 'two.txt')
+
+    assert state.db.blobs.find_one({'_id': sha256})['refs'] == 2
+    paths = [state.db.files.find_one({'_id': file_id})['filepath'] for file_id in (first, second)]
+    assert [parse_blob_path(path) for path in paths] == [(sha256, 'one.txt'), (sha256, 'two.txt')]
+    blob_files = [name for _, _, names in os.walk(state.blobs.root) for name in names]
+    assert blob_files == [sha256]
+    assert client.get('/uploads/' + paths[1]).data == data
+
+def test_blob_is_deleted_with_its_last_file(make_app, admin_client):
+    app = make_app()
+    state = app.extensions['fpress']
+    client = admin_client(app)
+    data = b'shared content'
+    sha256 = hashlib.sha256(data).hexdigest()
+    first = upload(client, data, 'one.txt')
+    second = upload(client, data, 'two.txt')
+
+    client.get('/file_delete/' + first)
+    assert state.db.files.find_one({'_id': first}) is None
+    assert state.db.blobs.find_one({'_id': sha256})['refs'] == 1
+    assert os.path.isfile(state.blobs.path(sha256))
+
+    client.get('/file_delete/' + second)
+    assert state.db.blobs.find_one({'_id': sha256}) is None
+    assert not os.path.isfile(state.blobs.path(sha256))
+
+def test_missing_blob_file_is_restored(make_app, tmp_path):
+    state = make_app().extensions['fpress']
+    data = b'lost and found'
+    sha256 = hashlib.sha256(data).hexdigest()
+    for name in ('a', 'b'):
+        (tmp_path / name).write_bytes(data)
+    assert state.blobs.add(str(tmp_path / 'a'), sha256, len(data)) is True
+    os.remove(state.blobs.path(sha256))
+    assert state.blobs.add(str(tmp_path / 'b'), sha256, len(data)) is True
+    assert state.db.blobs.find_one({'_id': sha256})['refs'] == 2
+    assert state.blobs.release(sha256) is False
+    assert state.blobs.release(sha256) is True
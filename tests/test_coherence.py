@@ -0,0 +1,35 @@
+from coherence import SharedState
+from indexes import IndexedDatabase
+from storage import TinyMongoBackend
+
+
+def two_workers(tmp_path):
+    """two databases over the same files, like two worker processes"""
+    shared = SharedState(str(tmp_path / 'coherence'))
+    return [IndexedDatabase(TinyMongoBackend(str(tmp_path / 'db')), shared=shared) for _ in range(2)]
+
+
+def test_reload_sees_writes_of_another_instance(tmp_path):
+    a, b = two_workers(tmp_path)
+    a.pages.insert_one({'slug': 'p', 'title': 'A'})
+    assert b.pages.find_one({'slug': 'p'})['title'] == 'A'
+
+    a.pages.update_one({'slug': 'p'}, {'$set': {'title': 'A2'}})
+    assert b.pages.find_one({'slug': 'p'})['title'] == 'A2'
+    assert [page['title'] for page in b.pages.find()] == ['A2']
+
+    a.pages.update_one({'slug': 'p'}, {'slug': 'p', 'title': 'A3'})
+    assert b.pages.find_one({'slug': 'p'})['title'] == 'A3'
+    assert b.pages.epoch() == 2
+
+
+def test_inserts_of_both_instances_are_kept(tmp_path):
+    a, b = two_workers(tmp_path)
+    b.pages.find()
+    a.pages.insert_one({'slug': 'one'})
+    b.pages.insert_one({'slug': 'two'})
+    a.pages.insert_one({'slug': 'three'})
+    expected = ['one', 'three', 'two']
+    assert sorted(page['slug'] for page in a.pages.find()) == expected
+    assert sorted(page['slug'] for page in b.pages.find()) == expected
+    assert sorted(page['slug'] for page in TinyMongoBackend(str(tmp_path / 'db'))['pages'].find()) == expected
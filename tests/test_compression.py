@@ -0,0 +1,108 @@
+# test_compression.py
+# compressed responses and fingerprinted static assets
+import gzip
+import os
+
+import pytest
+from flask import request
+
+import compression
+from assets import IMMUTABLE_MAX_AGE, AssetManifest, build_assets
+
+
+def accepted(app, header):
+    with app.test_request_context('/', headers={'Accept-Encoding': header}):
+        return compression.negotiate(request.accept_encodings)
+
+
+def test_negotiation_prefers_brotli_when_available(make_app, monkeypatch):
+    app = make_app()
+    monkeypatch.setattr(compression, 'ENCODINGS', ('br', 'gzip'))
+    assert accepted(app, 'gzip, deflate, br') == 'br'
+    assert accepted(app, 'gzip;q=1.0, br;q=0.5') == 'gzip'
+    assert accepted(app, 'gzip, br;q=0') == 'gzip'
+    assert accepted(app, 'deflate') is None
+    assert accepted(app, '') is None
+    monkeypatch.setattr(compression, 'ENCODINGS', ('gzip',))
+    assert accepted(app, 'br') is None
+
+def test_compressed_page_gets_a_weak_etag(make_app):
+    client = make_app().test_client()
+    plain = client.get('/')
+    assert 'Content-Encoding' not in plain.headers
+    assert not plain.headers['ETag'].startswith('W/')
+    assert 'Accept-Encoding' in plain.headers['Vary']
+
+    compressed = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.data) == plain.data
+    assert compressed.headers['ETag'] == 'W/' + plain.headers['ETag']
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+
+@pytest.mark.parametrize('encoding', ['gzip', None])
+def test_cached_page_revalidates(make_app, encoding):
+    client = make_app().test_client()
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+    etag = client.get('/', headers=headers).headers['ETag']
+    headers['If-None-Match'] = etag
+    response = client.get('/', headers=headers)
+    assert response.status_code == 304
+    assert response.data == b''
+    headers['If-None-Match'] = '"something-else"'
+    assert client.get('/', headers=headers).status_code == 200
+
+def test_small_responses_are_not_compressed(make_app):
+    client = make_app(COMPRESS_MIN_SIZE=10 ** 6).test_client()
+    assert 'Content-Encoding' not in client.get('/', headers={'Accept-Encoding': 'gzip'}).headers
+
+
+@pytest.fixture
+def static_folder(tmp_path):
+    folder = tmp_path / 'static'
+    (folder / 'css').mkdir(parents=True)
+    (folder / 'css' / 'site.css').write_text('/* comment */\nbody {\n  color : red;\n}\n')
+    return folder
+
+def test_asset_url_is_fingerprinted_once_built(make_app, static_folder):
+    app = make_app()
+    manifest = AssetManifest(str(static_folder))
+    with app.test_request_context('/'):
+        assert manifest.url('css/site.css') == '/static/css/site.css'
+        build_assets(str(static_folder))
+        manifest.reload()
+        url = manifest.url('css/site.css')
+        assert url.startswith('/static/dist/css/site.') and url.endswith('.css')
+        assert manifest.url('/static/css/site.css') == url
+        assert manifest.url('https://cdn.example.com/x.css') == 'https://cdn.example.com/x.css'
+    built = static_folder / url[len('/static/'):]
+    assert built.read_text() == 'body{color : red}\n'
+    assert os.path.isfile(str(built) + '.gz')
+
+    # changed content, new name, the old copy is removed
+    (static_folder / 'css' / 'site.css').write_text('body { color: blue; }\n')
+    build_assets(str(static_folder))
+    manifest.reload()
+    with app.test_request_context('/'):
+        assert manifest.url('css/site.css') != url
+    assert not built.exists()
+
+def test_fingerprinted_assets_are_immutable(make_app, static_folder):
+    app = make_app()
+    app.static_folder = str(static_folder)
+    manifest = build_assets(str(static_folder))
+    path = '/static/dist/' + manifest['css/site.css']
+    client = app.test_client()
+
+    response = client.get(path)
+    assert response.status_code == 200
+    assert response.cache_control.immutable
+    assert response.cache_control.public
+    assert response.cache_control.max_age == IMMUTABLE_MAX_AGE
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == b'body{color : red}\n'
+
+    compressed = client.get(path, headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.data) == response.data
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+    assert compressed.cache_control.immutable
@@ -0,0 +1,94 @@
+# test_export.py
+# incremental export: pages showing something that changed are re-rendered
+import os
+
+import pytest
+
+import export
+
+
+def run_export(app, output_dir):
+    return export.export_site(app.extensions['fpress'].db, str(output_dir),
+                              upload_folder=app.config['UPLOAD_FOLDER'],
+                              static_folder=app.static_folder, workers=1,
+                              app_config=dict(app.config))
+
+def read(output_dir, slug):
+    with open(export.page_filename(str(output_dir), slug), encoding='utf-8') as f:
+        return f.read()
+
+def add_page(db, slug, **fields):
+    page = {'slug': slug, 'title': slug.title(), 'owner': 'admin', 'content': '<p>{}</p>'.format(slug),
+            'is_markdown': False, 'is_published': True, 'created_at': '2024-01-01 00:00:00',
+            'modified_at': '2024-01-01 00:00:00'}
+    page.update(fields)
+    db.pages.insert_one(page)
+
+
+def test_unchanged_site_renders_nothing(make_app, tmp_path):
+    app = make_app()
+    out = tmp_path / 'site'
+    assert run_export(app, out)['rendered'] == 2
+    assert run_export(app, out)['rendered'] == 0
+
+def test_menu_change_rerenders_every_page(make_app, tmp_path):
+    app = make_app()
+    out = tmp_path / 'site'
+    run_export(app, out)
+    add_page(app.extensions['fpress'].db, 'contact', title='Contact Us', show_nav=True)
+    result = run_export(app, out)
+    assert result['rendered'] == 3
+    assert 'Contact Us' in read(out, 'home')
+
+def test_embedded_page_change_rerenders_embedding_page(make_app, tmp_path):
+    app = make_app()
+    db = app.extensions['fpress'].db
+    add_page(db, 'notice', content='<p>old notice</p>')
+    add_page(db, 'news', content='<p>[[embed notice]]</p>')
+    out = tmp_path / 'site'
+    run_export(app, out)
+    assert 'old notice' in read(out, 'news')
+
+    notice = db.pages.find_one({'slug': 'notice'})
+    db.pages.update_one({'_id': notice['_id']}, {'$set': {'content': '<p>new notice</p>',
+                                                          'modified_at': '2024-02-01 00:00:00'}})
+    result = run_export(app, out)
+    assert result['rendered'] == 2
+    assert 'new notice' in read(out, 'news')
+
+def test_child_list_change_rerenders_parent(make_app, tmp_path):
+    app = make_app()
+    db = app.extensions['fpress'].db
+    add_page(db, 'people', show_children=True)
+    out = tmp_path / 'site'
+    run_export(app, out)
+    add_page(db, 'people/dirk', title='Dirk Gently')
+    result = run_export(app, out)
+    # the new page and the list showing it
+    assert result['rendered'] == 2
+    assert 'Dirk Gently' in read(out, 'people')
+    assert os.path.isfile(export.page_filename(str(out), 'people/dirk'))
+
+def test_deleted_menu_page_is_removed(make_app, tmp_path):
+    app = make_app()
+    db = app.extensions['fpress'].db
+    out = tmp_path / 'site'
+    run_export(app, out)
+    assert os.path.isfile(export.page_filename(str(out), 'about'))
+    # about is in the menu, so deleting it re-renders everything as well
+    db.pages.delete_many({'slug': 'about'})
+    result = run_export(app, out)
+    assert result['removed'] == 1
+    assert not os.path.isfile(export.page_filename(str(out), 'about'))
+    assert 'About' not in read(out, 'home')
+
+def test_journal_backend_renders_in_process(make_app, tmp_path):
+    app = make_app(DATABASE_BACKEND='journal')
+    out = tmp_path / 'site'
+    config = dict(app.config)
+    with pytest.raises(ValueError):
+        run_export(app, out)
+    result = export.export_site(app.extensions['fpress'].db, str(out), upload_folder=app.config['UPLOAD_FOLDER'],
+                                static_folder=app.static_folder, workers=4, app_config=config, app=app)
+    assert result['rendered'] == 2
+    assert 'About' in read(out, 'home')
@@ -0,0 +1,74 @@
+# test_images.py
+# image derivatives: never wait for a rendering, never render the same thing twice
+import concurrent.futures
+import os
+import threading
+
+import pytest
+
+import images
+
+pytestmark = pytest.mark.skipif(images.Image is None, reason="needs Pillow")
+
+
+def make_image(path, width):
+    images.Image.new('RGB', (width, width // 2), (200, 30, 30)).save(str(path), 'PNG')
+    return str(path)
+
+def wait(store):
+    for future in list(store._pending.values()):
+        future.result(30)
+
+
+def test_missing_variant_is_rendered_in_the_background(tmp_path):
+    store = images.DerivativeStore(str(tmp_path / 'derived'), widths=(320,), workers=1)
+    source = make_image(tmp_path / 'wide.png', 800)
+    sha = 'ab' * 32
+    # the caller serves the original meanwhile
+    assert store.get(source, sha, 320) is None
+    assert store.pending(sha, 320)
+    wait(store)
+    rel = store.get(source, sha, 320)
+    assert rel == store.relpath(sha, 320)
+    assert images.image_size(os.path.join(store.directory, rel)) == (320, 160)
+    store._pool.shutdown()
+
+def test_narrow_image_is_not_submitted_again(tmp_path):
+    store = images.DerivativeStore(str(tmp_path / 'derived'), widths=(320,), workers=1)
+    source = make_image(tmp_path / 'narrow.png', 100)
+    sha = 'cd' * 32
+    assert store.get(source, sha, 320) is None
+    wait(store)
+    assert os.path.isfile(os.path.join(store.directory, store.relpath(sha, 320)) + images.NO_VARIANT)
+
+    submitted = []
+    store._submit = lambda *args: submitted.append(args)
+    assert store.get(source, sha, 320) is None
+    store.schedule(source, sha)
+    assert submitted == []
+    store._pool.shutdown()
+
+def test_known_width_skips_the_pool(tmp_path):
+    store = images.DerivativeStore(str(tmp_path / 'derived'), widths=(320,), workers=1)
+    assert store.get(str(tmp_path / 'missing.png'), 'ef' * 32, 320, image_width=300) is None
+    assert store._pool is None
+
+def test_concurrent_renderings_are_all_counted(tmp_path):
+    store = images.DerivativeStore(str(tmp_path / 'derived'), widths=(320,), workers=1)
+    rel = store.relpath('01' * 32, 320)
+    os.makedirs(os.path.dirname(os.path.join(store.directory, rel)))
+    with open(os.path.join(store.directory, rel), 'wb') as f:
+        f.write(b'x' * 100)
+    store.start_accounting()
+    done = concurrent.futures.Future()
+    done.set_result(True)
+
+    def finish():
+        for _ in range(200):
+            store._rendered(rel, done)
+    threads = [threading.Thread(target=finish) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store._size == 100 + 8 * 200 * 100
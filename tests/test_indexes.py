@@ -0,0 +1,135 @@
+import pytest
+
+from indexes import DuplicateKeyError, IndexedDatabase, encode_cursor
+from storage import TinyMongoBackend
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = IndexedDatabase(TinyMongoBackend(str(tmp_path / 'db')))
+    db.pages.insert_one({'slug': 'a', 'title': 'A', 'owner': 'admin'})
+    db.pages.insert_one({'slug': 'b', 'title': 'B', 'owner': 'admin'})
+    return db
+
+
+def stored(db, tmp_path):
+    """slugs as the backend has them, not the in-memory copy"""
+    return sorted(page['slug'] for page in TinyMongoBackend(str(tmp_path / 'db'))['pages'].find())
+
+
+def test_set_breaking_unique_index_is_not_written(db, tmp_path):
+    with pytest.raises(DuplicateKeyError):
+        db.pages.update_one({'slug': 'b'}, {'$set': {'slug': 'a'}})
+    assert stored(db, tmp_path) == ['a', 'b']
+    assert db.pages.find_one({'slug': 'b'})['title'] == 'B'
+
+
+def test_update_many_breaking_unique_index_is_not_written(db, tmp_path):
+    with pytest.raises(DuplicateKeyError):
+        db.pages.update_many({'owner': 'admin'}, {'$set': {'slug': 'same'}})
+    assert stored(db, tmp_path) == ['a', 'b']
+
+
+def test_update_many_colliding_with_another_document_is_not_written(db, tmp_path):
+    db.pages.insert_one({'slug': 'c', 'title': 'C', 'owner': 'ed'})
+    with pytest.raises(DuplicateKeyError):
+        db.pages.update_many({'owner': 'ed'}, {'$set': {'slug': 'a'}})
+    assert stored(db, tmp_path) == ['a', 'b', 'c']
+    assert db.pages.find_one({'slug': 'c'})['owner'] == 'ed'
+
+
+def test_update_many_writes_every_match(db, tmp_path):
+    db.pages.insert_one({'slug': 'c', 'title': 'C', 'owner': 'ed'})
+    result = db.pages.update_many({'owner': 'admin'}, {'$set': {'owner': 'ed'}})
+    assert result.matched_count == 2
+    assert sorted(page['slug'] for page in db.pages.find({'owner': 'ed'})) == ['a', 'b', 'c']
+    reopened = TinyMongoBackend(str(tmp_path / 'db'))['pages']
+    assert sorted(page['owner'] for page in reopened.find()) == ['ed', 'ed', 'ed']
+
+
+def test_hard_deleting_a_user_reassigns_pages_and_files(make_app, admin_client):
+    import users
+    app = make_app()
+    db = app.extensions['fpress'].db
+    users.create_user(db, 'ed', 'secret')
+    for slug in ('ed-one', 'ed-two'):
+        db.pages.insert_one({'slug': slug, 'title': slug, 'owner': 'ed', 'is_published': True})
+    db.files.insert_one({'title': 'ed.txt', 'owner': 'ed'})
+    user = db.users.find_one({'username': 'ed'})
+    admin_client(app).get('/user_delete/{}/hard'.format(user['_id']))
+    assert db.users.find_one({'username': 'ed'}) is None
+    assert list(db.pages.find({'owner': 'ed'})) == []
+    assert db.pages.find_one({'slug': 'ed-two'})['owner'] == 'admin'
+    assert db.files.find_one({'title': 'ed.txt'})['owner'] == 'admin'
+
+
+def test_set_keeps_indexes_current(db):
+    db.pages.update_one({'slug': 'b'}, {'$set': {'slug': 'c', 'title': 'C'}})
+    assert db.pages.find_one({'slug': 'b'}) is None
+    assert db.pages.find_one({'slug': 'c'})['title'] == 'C'
+    # the old slug is free again
+    db.pages.update_one({'slug': 'a'}, {'$set': {'slug': 'b'}})
+    assert db.pages.find_one({'slug': 'b'})['title'] == 'A'
+
+
+def test_unmirrored_operator_is_refused_on_unique_collections(db):
+    with pytest.raises(NotImplementedError):
+        db.pages.update_one({'slug': 'a'}, {'$inc': {'views': 1}})
+
+
+def listed(pages):
+    return [page['title'] for page in pages]
+
+@pytest.fixture
+def listing(tmp_path):
+    db = IndexedDatabase(TinyMongoBackend(str(tmp_path / 'listing')))
+    for title in ('delta', 'Alpha', 'echo', 'charlie', 'Bravo'):
+        db.pages.insert_one({'slug': title.lower(), 'title': title, 'owner': 'admin' if title < 'd' else 'ed'})
+    return db
+
+def test_find_page_walks_the_whole_listing(listing):
+    first, cursor = listing.pages.find_page(sort='title', limit=2)
+    assert listed(first) == ['Alpha', 'Bravo']
+    second, cursor = listing.pages.find_page(sort='title', after=cursor, limit=2)
+    assert listed(second) == ['charlie', 'delta']
+    last, cursor = listing.pages.find_page(sort='title', after=cursor, limit=2)
+    assert listed(last) == ['echo']
+    assert cursor is None
+
+def test_find_page_order_is_stable_across_inserts(listing):
+    first, cursor = listing.pages.find_page(sort='title', limit=2)
+    # one new page sorts before the cursor, one after: nothing repeats or goes missing
+    listing.pages.insert_one({'slug': 'aardvark', 'title': 'Aardvark'})
+    listing.pages.insert_one({'slug': 'zulu', 'title': 'zulu'})
+    rest, cursor = listing.pages.find_page(sort='title', after=cursor, limit=10)
+    assert listed(rest) == ['charlie', 'delta', 'echo', 'zulu']
+    assert cursor is None
+
+def test_find_page_ties_are_broken_by_id(listing):
+    seen = []
+    cursor = None
+    while True:
+        pages, cursor = listing.pages.find_page(sort='owner', after=cursor, limit=2)
+        seen.extend(page['_id'] for page in pages)
+        if cursor is None:
+            break
+    assert len(seen) == len(set(seen)) == 5
+
+def test_find_page_descending_filtered_and_projected(listing):
+    pages, cursor = listing.pages.find_page({'owner': 'admin'}, sort='title', descending=True, limit=2,
+                                            fields=['title'])
+    assert listed(pages) == ['charlie', 'Bravo']
+    assert set(pages[0]) == set(['_id', 'title'])
+    pages, cursor = listing.pages.find_page({'owner': 'admin'}, sort='title', descending=True, after=cursor,
+                                            limit=2, fields=['title'])
+    assert listed(pages) == ['Alpha']
+    assert cursor is None
+
+def test_find_page_cursor_past_the_end(listing):
+    last = listing.pages.find_one({'slug': 'echo'})
+    assert listing.pages.find_page(sort='title', after=encode_cursor(last['title'], last['_id'])) == ([], None)
+    past = encode_cursor('zzz', 'zzz')
+    assert listing.pages.find_page(sort='title', after=past) == ([], None)
+    assert listing.pages.find_page(sort='title', after=past, descending=True)[0][0]['title'] == 'echo'
+    with pytest.raises(ValueError):
+        listing.pages.find_page(sort='title', after='not a cursor')
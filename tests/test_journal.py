@@ -0,0 +1,54 @@
+# test_journal.py
+# group commit: writers keep appending while a batch is fsynced
+import threading
+
+import journal
+
+
+def test_append_does_not_wait_for_a_running_fsync(tmp_path, monkeypatch):
+    syncing = threading.Event()
+    release = threading.Event()
+
+    def slow_fsync(fileno):
+        syncing.set()
+        release.wait(5)
+    monkeypatch.setattr(journal.os, 'fsync', slow_fsync)
+
+    log = journal.Journal(str(tmp_path / 'db.journal'), commit_window=0)
+    try:
+        first = log.append({'n': 1})
+        assert syncing.wait(5)
+        appended = []
+        writer = threading.Thread(target=lambda: appended.append(log.append({'n': 2})))
+        writer.start()
+        writer.join(1)
+        assert appended == [first + 1]
+    finally:
+        release.set()
+    log.wait(first + 1)
+    log.close()
+    with open(str(tmp_path / 'db.journal')) as f:
+        assert len(f.read().splitlines()) == 2
+
+def test_reopened_backend_replays_the_journal(tmp_path):
+    backend = journal.JournalBackend(str(tmp_path), commit_window=0)
+    backend['pages'].insert_one({'_id': 'a', 'slug': 'a'})
+    backend['pages'].update_one({'_id': 'a'}, {'$set': {'title': 'A'}})
+    backend.close()
+    reopened = journal.JournalBackend(str(tmp_path), commit_window=0)
+    assert reopened['pages'].find_one({'_id': 'a'}) == {'_id': 'a', 'slug': 'a', 'title': 'A'}
+    reopened.close()
+
+def test_writes_after_a_torn_tail_survive_restarts(tmp_path):
+    backend = journal.JournalBackend(str(tmp_path), commit_window=0)
+    backend['pages'].insert_one({'_id': 'a'})
+    backend.close()
+    with open(backend.journal_path, 'ab') as f:
+        f.write(b'{"op": "put", "c": "pages", "doc": {"_id": "x"')
+    reopened = journal.JournalBackend(str(tmp_path), commit_window=0)
+    reopened['pages'].insert_one({'_id': 'b'})
+    reopened['pages'].insert_one({'_id': 'c'})
+    reopened.close()
+    last = journal.JournalBackend(str(tmp_path), commit_window=0)
+    assert sorted(page['_id'] for page in last['pages'].find()) == ['a', 'b', 'c']
+    last.close()
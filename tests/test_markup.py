@@ -0,0 +1,47 @@
+from markup import ContentRenderer, render_basic, safe_url, sanitize_html
+
+
+def test_script_and_handlers_are_removed():
+    html = '<p onclick="steal()">hi<script>alert(1)</script></p><style>p{}</style>'
+    assert sanitize_html(html) == '<p>hi</p>'
+
+
+def test_self_closing_dropped_tags_keep_the_rest():
+    html = '<p>a</p><script/><p>b</p><svg viewBox="0 0 1 1"/><p>c</p>'
+    assert sanitize_html(html) == '<p>a</p><p>b</p><p>c</p>'
+
+
+def test_nested_dropped_tags():
+    assert sanitize_html('<svg><svg></svg><path/></svg><p>after</p>') == '<p>after</p>'
+
+
+def test_self_closing_allowed_tags():
+    assert sanitize_html('<p>a<br/>b<img src="/x.png" alt="x"/></p>') == '<p>a<br>b<img src="/x.png" alt="x"></p>'
+
+
+def test_unsafe_urls_are_dropped():
+    assert not safe_url('javascript:alert(1)')
+    assert not safe_url(' java\tscript:alert(1)')
+    assert not safe_url('data:text/html,x')
+    assert safe_url('/page/about') and safe_url('https://example.org') and safe_url('mailto:a@b.c')
+    assert sanitize_html('<a href="javascript:x()">x</a>') == '<a>x</a>'
+
+
+def test_unclosed_tags_are_closed_and_text_escaped():
+    assert sanitize_html('<b>bold <i>both') == '<b>bold <i>both</i></b>'
+    assert sanitize_html('1 &lt; 2 &amp; <unknown>x</unknown>') == '1 &lt; 2 &amp; x'
+
+
+def test_basic_markdown():
+    html = render_basic('# Title\n\nSome *em* and **strong** [link](/x)\n\n- a\n- b')
+    assert html == ('<h1>Title</h1>\n<p>Some <em>em</em> and <strong>strong</strong> <a href="/x">link</a></p>\n'
+                    '<ul><li>a</li><li>b</li></ul>')
+
+
+def test_render_page_skips_unchanged_markdown():
+    renderer = ContentRenderer()
+    page = {'is_markdown': True, 'content': 'hello <script>x()</script>'}
+    assert renderer.render_page(page) is True
+    assert '<script' not in page['html']
+    assert renderer.render_page(page) is False
+    assert renderer.misses == 1
@@ -0,0 +1,16 @@
+# test_metrics.py
+# /metrics: not public by default, even from the loopback address a proxy uses
+
+def test_loopback_is_not_allowed_by_default(make_app):
+    client = make_app().test_client()
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 403
+
+def test_token_allows_scrape(make_app):
+    client = make_app(METRICS_TOKEN='s3cret').test_client()
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    response = client.get('/metrics', headers={'Authorization': 'Bearer s3cret'})
+    assert response.status_code == 200
+    assert b'fpress_requests_total' in response.data
+
+def test_admin_allowed(make_app, admin_client):
+    assert admin_client(make_app()).get('/metrics').status_code == 200
@@ -0,0 +1,19 @@
+# test_migrate.py
+# migrating into TinyMongo writes each collection's file once
+from migrate import migrate
+from storage import open_backend
+
+
+def test_migrate_into_tinymongo_in_one_write(tmp_path):
+    source = open_backend('sqlite', str(tmp_path / 'site.sqlite3'))
+    source['pages'].insert([{'_id': 'p{}'.format(i), 'slug': 'page-{}'.format(i)} for i in range(120)])
+    target = open_backend('tinymongo', str(tmp_path / 'tinydb'))
+    inserts = []
+    target['pages'].insert_one = inserts.append
+
+    counts = migrate(source, target, collections=['pages'], batch_size=50, log=lambda message: None)
+
+    assert counts == {'pages': 120}
+    assert inserts == []
+    pages = open_backend('tinymongo', str(tmp_path / 'tinydb'))['pages'].find()
+    assert sorted(page['_id'] for page in pages) == sorted('p{}'.format(i) for i in range(120))
@@ -0,0 +1,16 @@
+# test_pagecache.py
+# cached pages revalidate by ETag; If-Modified-Since alone never gets a 304
+
+def test_pages_revalidate_by_etag_only(make_app):
+    app = make_app()
+    db = app.extensions['fpress'].db
+    about = db.pages.find_one({'slug': 'about'})
+    db.pages.update_one({'_id': about['_id']}, {'$set': {'modified_at': '2024-01-01 00:00:00'}})
+    client = app.test_client()
+    response = client.get('/about')
+    assert response.status_code == 200
+    assert response.headers.get('Last-Modified') is None
+    etag = response.headers['ETag']
+    assert client.get('/about', headers={'If-None-Match': etag}).status_code == 304
+    stale = client.get('/about', headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+    assert stale.status_code == 200
@@ -0,0 +1,79 @@
+# test_routing.py
+# slug trie: breadcrumbs, child lists and the pages a change makes stale
+from routing import SlugTrie
+
+
+def summary(_id, slug, title=None, published=True):
+    return {'_id': _id, 'slug': slug, 'title': title or slug.rsplit('/', 1)[-1].title(),
+            'is_published': published}
+
+def make_trie(*pages):
+    trie = SlugTrie()
+    for page in pages:
+        trie.add(page)
+    return trie
+
+def url(slug):
+    return '/' + (slug or '')
+
+
+def test_breadcrumbs_list_published_ancestors_home_first():
+    trie = make_trie(summary(1, 'home'), summary(2, 'people'), summary(3, 'people/staff/dirk', 'Dirk'),
+                     summary(4, 'people/staff/richard'))
+    # people/staff has no page of its own, it is skipped
+    assert trie.breadcrumbs('people/staff/dirk', url) == [('Home', '/'), ('People', '/people')]
+    assert trie.breadcrumbs('people', url) == [('Home', '/')]
+    assert trie.breadcrumbs('home', url) == []
+    assert trie.breadcrumbs('nowhere/else', url) == [('Home', '/')]
+
+def test_children_are_sorted_by_title_and_skip_empty_segments():
+    trie = make_trie(summary(1, 'people'), summary(2, 'people/zaphod'), summary(3, 'people/arthur'),
+                     summary(4, 'people/staff/dirk'), summary(5, 'people/arthur/towel'),
+                     summary(6, 'people/marvin', published=False))
+    assert [page['slug'] for page in trie.children('people')] == ['people/arthur', 'people/staff/dirk',
+                                                                  'people/zaphod']
+    assert trie.children('nobody') == []
+
+def test_related_is_the_nearest_ancestor_and_every_descendant():
+    trie = make_trie(summary(1, 'a'), summary(2, 'a/b'), summary(3, 'a/b/c/d'), summary(4, 'a/b/c/d/e'))
+    assert trie.related('a/b/c') == ['a/b', 'a/b/c/d', 'a/b/c/d/e']
+    assert sorted(trie.related('a')) == ['a/b', 'a/b/c/d', 'a/b/c/d/e']
+
+def test_moving_and_unpublishing_prune_the_trie():
+    trie = make_trie(summary(1, 'people'), summary(2, 'people/staff/dirk'))
+    trie.add(summary(2, 'staff/dirk'))
+    assert trie.children('people') == []
+    assert 'staff' not in trie.root.children['people'].children
+    trie.add(summary(2, 'staff/dirk', published=False))
+    trie.remove(1)
+    assert trie.root.children == {}
+
+
+def save(client, db, slug, title, **fields):
+    data = {'title': title, 'slug': slug, 'content': '<p>{}</p>'.format(title), 'is_published': 'on'}
+    data.update(fields)
+    page = db.pages.find_one({'slug': slug})
+    client.post('/page/edit/' + page['_id'] if page else '/page/create', data=data)
+
+def anonymous_view(app, slug):
+    return app.test_client().get('/' + slug).get_data(as_text=True)
+
+def test_saving_and_removing_pages_refreshes_cached_listings(make_app, admin_client):
+    app = make_app()
+    db = app.extensions['fpress'].db
+    client = admin_client(app)
+    save(client, db, 'people', 'People', show_children='on')
+    save(client, db, 'people/dirk', 'Dirk Gently')
+    assert 'Dirk Gently' in anonymous_view(app, 'people')
+    assert 'href="/people"' in anonymous_view(app, 'people/dirk')
+
+    # both pages are now cached, a new child and a retitled parent must show
+    save(client, db, 'people/richard', 'Richard MacDuff')
+    assert 'Richard MacDuff' in anonymous_view(app, 'people')
+    save(client, db, 'people', 'Everybody', show_children='on')
+    assert 'Everybody' in anonymous_view(app, 'people/dirk')
+
+    dirk = db.pages.find_one({'slug': 'people/dirk'})
+    client.get('/page/delete/' + dirk['_id'])
+    assert 'Dirk Gently' not in anonymous_view(app, 'people')
+    assert 'Richard MacDuff' in anonymous_view(app, 'people')
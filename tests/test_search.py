@@ -0,0 +1,77 @@
+# test_search.py
+# full-text search: multi-term AND, BM25 ranking, index kept current by index_page_task
+from search import SearchIndex
+
+
+def make_index(*pages):
+    index = SearchIndex()
+    for _id, title, content in pages:
+        index.add({'_id': _id, 'slug': _id, 'title': title, 'content': content, 'is_markdown': False})
+    return index
+
+def slugs(results):
+    return [result['slug'] for result in results[0]]
+
+
+def test_every_term_must_match():
+    index = make_index(('a', 'Apples', '<p>red apples and green pears</p>'),
+                       ('b', 'Pears', '<p>green pears only</p>'),
+                       ('c', 'Plums', '<p>purple plums</p>'))
+    assert sorted(slugs(index.search('green pears'))) == ['a', 'b']
+    assert slugs(index.search('red pears')) == ['a']
+    assert index.search('red plums') == ([], 0)
+    assert index.search('kiwis pears') == ([], 0)
+    assert index.search('  ') == ([], 0)
+
+def test_ranking_prefers_frequent_and_title_terms():
+    filler = ' '.join(['words'] * 20)
+    index = make_index(('once', 'Notes', '<p>teapot {}</p>'.format(filler)),
+                       ('often', 'Notes', '<p>teapot teapot teapot {}</p>'.format(filler)),
+                       ('titled', 'Teapot', '<p>teapot {}</p>'.format(filler)))
+    assert slugs(index.search('teapot')) == ['titled', 'often', 'once']
+    # a short page with the same count of the term is the better match
+    index.add({'_id': 'short', 'slug': 'short', 'title': 'Notes', 'content': '<p>teapot</p>'})
+    ranked = slugs(index.search('teapot'))
+    assert ranked.index('short') < ranked.index('once')
+
+def test_results_are_paged():
+    index = make_index(*[('p{}'.format(n), 'Page', '<p>{}</p>'.format(' '.join(['common'] * (n + 1))))
+                         for n in range(5)])
+    first, total = index.search('common', page=1, per_page=2)
+    second, _ = index.search('common', page=2, per_page=2)
+    last, _ = index.search('common', page=3, per_page=2)
+    assert total == 5
+    assert len(first) == 2 and len(second) == 2 and len(last) == 1
+    assert len(set(r['slug'] for r in first + second + last)) == 5
+
+def test_removed_page_is_not_found():
+    index = make_index(('a', 'Apples', '<p>apples</p>'), ('b', 'More apples', '<p>apples</p>'))
+    index.remove('a')
+    assert slugs(index.search('apples')) == ['b']
+    assert index.total_length == index.docs['b'][0]
+
+def test_saving_and_deleting_pages_updates_the_index(make_app, admin_client):
+    app = make_app()
+    state = app.extensions['fpress']
+    client = admin_client(app)
+    assert b'href="airships"' not in client.get('/search?s=zeppelin').data
+    index = state.search_index
+    assert index._built
+
+    client.post('/page/create', data={'title': 'Airships', 'slug': 'airships', 'is_published': 'on',
+                                      'content': '<p>the zeppelin flies</p>'})
+    page = state.db.pages.find_one({'slug': 'airships'})
+    # index_page_task ran (inline, TASK_WORKERS is 0) and updated the built index
+    assert state.search_index is index
+    assert slugs(index.search('zeppelin')) == ['airships']
+    assert page['snippet'] == 'the zeppelin flies'
+    assert b'href="airships"' in client.get('/search?s=zeppelin flies').data
+
+    client.post('/page/edit/' + page['_id'], data={'title': 'Airships', 'slug': 'airships',
+                                                   'is_published': 'on', 'content': '<p>the blimp floats</p>'})
+    assert index.search('zeppelin') == ([], 0)
+    assert slugs(index.search('blimp')) == ['airships']
+
+    client.get('/page/delete/' + page['_id'])
+    assert index.search('blimp') == ([], 0)
+    assert b'href="airships"' not in client.get('/search?s=blimp').data
@@ -0,0 +1,60 @@
+# test_serving.py
+# serving uploads: strong ETags, ranges, immutable blob paths and proxy offload
+import hashlib
+import io
+import os
+
+from serving import IMMUTABLE_MAX_AGE
+
+DATA = b'0123456789' * 100
+
+
+def upload(app, admin_client):
+    client = admin_client(app)
+    response = client.post('/_upload', data={'file': (io.BytesIO(DATA), 'digits.txt')})
+    file_id = response.headers['Location'].rsplit('/', 1)[-1]
+    return '/uploads/' + app.extensions['fpress'].db.files.find_one({'_id': file_id})['filepath']
+
+
+def test_blob_paths_are_immutable_and_revalidate(make_app, admin_client):
+    app = make_app()
+    url = upload(app, admin_client)
+    client = app.test_client()
+    response = client.get(url)
+    assert response.data == DATA
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == IMMUTABLE_MAX_AGE
+    etag = response.headers['ETag']
+    assert not etag.startswith('W/')
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+def test_range_requests_get_partial_content(make_app, admin_client):
+    app = make_app()
+    url = upload(app, admin_client)
+    response = app.test_client().get(url, headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.data == DATA[10:20]
+    assert response.headers['Content-Range'] == 'bytes 10-19/{}'.format(len(DATA))
+
+def test_legacy_paths_are_hashed_and_cached_briefly(make_app):
+    app = make_app(UPLOAD_MAX_AGE=60)
+    folder = os.path.join(app.config['UPLOAD_FOLDER'], '202401')
+    os.makedirs(folder)
+    with open(os.path.join(folder, 'old.txt'), 'wb') as f:
+        f.write(DATA)
+    response = app.test_client().get('/uploads/202401/old.txt')
+    assert response.data == DATA
+    assert response.cache_control.max_age == 60
+    assert not response.cache_control.immutable
+    assert response.headers['ETag'].strip('"') == hashlib.sha256(DATA).hexdigest()
+    assert app.test_client().get('/uploads/../app.cfg').status_code == 404
+
+def test_offload_sends_headers_only(make_app, admin_client):
+    app = make_app(UPLOAD_OFFLOAD='x-accel-redirect', UPLOAD_OFFLOAD_PREFIX='/_internal/')
+    url = upload(app, admin_client)
+    response = app.test_client().get(url)
+    assert response.data == b''
+    assert response.headers['X-Accel-Redirect'].startswith('/_internal/blobs/')
+    assert response.cache_control.immutable
+    etag = response.headers['ETag']
+    assert app.test_client().get(url, headers={'If-None-Match': etag}).status_code == 304
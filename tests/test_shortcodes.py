@@ -0,0 +1,77 @@
+# test_shortcodes.py
+# shortcodes are compiled at save and their cached results dropped when what they show changes
+import io
+
+import pytest
+
+from shortcodes import ShortcodeEngine
+
+
+def create_page(client, title, content, slug=None):
+    client.post('/page/create', data={'title': title, 'slug': slug or title.lower(), 'content': content,
+                                      'is_published': 'on'})
+
+def view(client, slug):
+    return client.get('/' + slug).get_data(as_text=True)
+
+
+def test_saving_and_deleting_pages_refreshes_recent(make_app, admin_client):
+    app = make_app()
+    db = app.extensions['fpress'].db
+    client = admin_client(app)
+    create_page(client, 'Latest', '<p>[[recent count=10]]</p>')
+    assert 'Brand New' not in view(client, 'latest')
+
+    create_page(client, 'Brand New', '<p>new</p>', slug='brand-new')
+    assert 'Brand New' in view(client, 'latest')
+
+    page = db.pages.find_one({'slug': 'brand-new'})
+    client.get('/page/delete/' + page['_id'])
+    assert 'Brand New' not in view(client, 'latest')
+
+def test_uploading_and_deleting_files_refreshes_files(make_app, admin_client):
+    app = make_app()
+    db = app.extensions['fpress'].db
+    client = admin_client(app)
+    create_page(client, 'Downloads', '<p>[[files]]</p>')
+    assert 'report.txt' not in view(client, 'downloads')
+
+    response = client.post('/_upload', data={'file': (io.BytesIO(b'quarterly numbers'), 'report.txt')})
+    file_id = response.headers['Location'].rsplit('/', 1)[-1]
+    assert 'report.txt' in view(client, 'downloads')
+
+    client.get('/file_delete/' + file_id)
+    assert db.files.find_one({'_id': file_id}) is None
+    assert 'report.txt' not in view(client, 'downloads')
+
+def test_editing_an_embedded_page_refreshes_the_embedding_page(make_app, admin_client):
+    app = make_app()
+    db = app.extensions['fpress'].db
+    client = admin_client(app)
+    create_page(client, 'Notice', '<p>old notice</p>')
+    create_page(client, 'News', '<p>[[embed notice]]</p>')
+    assert 'old notice' in view(client, 'news')
+
+    notice = db.pages.find_one({'slug': 'notice'})
+    client.post('/page/edit/' + notice['_id'], data={'title': 'Notice', 'slug': 'notice',
+                                                     'content': '<p>new notice</p>', 'is_published': 'on'})
+    assert 'new notice' in view(client, 'news')
+
+@pytest.mark.parametrize('backend', ['tinymongo', 'sqlite', 'journal'])
+def test_compiled_segments_round_trip_through_the_page(make_app, admin_client, backend):
+    app = make_app(DATABASE_BACKEND=backend)
+    db = app.extensions['fpress'].db
+    client = admin_client(app)
+    content = '<p>see [[embed about]] and [[recent count=3]] or [[unknown thing]]</p>'
+    create_page(client, 'Combined', content)
+
+    page = db.pages.find_one({'slug': 'combined'})
+    engine = ShortcodeEngine()
+    assert page['shortcodes'] == engine.compile(content)[0]
+    assert page['shortcodes'][1] == {'name': 'embed', 'args': {'slug': 'about'}}
+    assert page['shortcode_deps'] == ['page:about', 'pages']
+    with app.test_request_context('/'):
+        expanded = engine.expand(db, page)
+    assert '<div class="embed">' in expanded
+    assert '[[unknown thing]]' in expanded
+    assert 'class="recent-pages"' in expanded
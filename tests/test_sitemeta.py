@@ -0,0 +1,68 @@
+# test_sitemeta.py
+# site settings: one cached meta snapshot per app, looked up only when used
+from flask import g
+
+import sitemeta
+from sitemeta import MetaCache
+
+
+def brand_of(app):
+    with app.test_request_context('/'):
+        app.preprocess_request()
+        return g.brand
+
+def test_apps_do_not_share_site_settings(make_app, tmp_path):
+    first = make_app()
+    second = make_app(DATABASE_PATH=str(tmp_path / 'other'))
+    db = first.extensions['fpress'].db
+    meta = db.meta.find_one()
+    db.meta.update_one({'_id': meta['_id']}, {'$set': {'brand': 'First Site'}})
+    first.extensions['fpress'].meta_cache.invalidate()
+    assert brand_of(first) == 'First Site'
+    assert brand_of(second) != 'First Site'
+
+class CountingMeta(object):
+    """db stand-in counting reads of the meta document"""
+    def __init__(self, db):
+        self.db = db
+        self.reads = 0
+
+    @property
+    def meta(self):
+        return self
+
+    def find_one(self):
+        self.reads += 1
+        return self.db.meta.find_one()
+
+    def epoch(self):
+        return self.db.meta.epoch()
+
+def test_meta_is_read_once_until_invalidated(make_app):
+    state = make_app().extensions['fpress']
+    db = CountingMeta(state.db)
+    cache = MetaCache()
+    first = cache.get(db)
+    assert cache.get(db) is first
+    assert db.reads == 1
+    cache.invalidate()
+    assert cache.get(db) is not first
+    assert db.reads == 2
+
+def test_settings_are_loaded_only_when_used(make_app, monkeypatch):
+    app = make_app()
+    loaded = []
+    original = sitemeta.LAZY_ATTRIBUTES['meta']
+    monkeypatch.setitem(sitemeta.LAZY_ATTRIBUTES, 'meta', lambda g: loaded.append(1) or original(g))
+    client = app.test_client()
+    assert client.get('/static/css/bulma-minty.css').status_code == 200
+    assert loaded == []
+    client.get('/')
+    assert loaded == [1]
+
+def test_admin_save_shows_the_new_brand(make_app, admin_client):
+    app = make_app()
+    client = admin_client(app)
+    assert 'Renamed Site' not in app.test_client().get('/').get_data(as_text=True)
+    client.post('/admin', data={'brand': 'Renamed Site', 'stylesheet': ''})
+    assert 'Renamed Site' in app.test_client().get('/').get_data(as_text=True)
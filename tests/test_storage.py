@@ -0,0 +1,21 @@
+# test_storage.py
+# storage backends: deletes reach the file
+import pytest
+
+from storage import open_backend
+
+
+@pytest.mark.parametrize('backend', ['tinymongo', 'sqlite', 'journal'])
+def test_delete_persists_after_other_collections_are_written(tmp_path, backend):
+    path = str(tmp_path / 'data')
+    db = open_backend(backend, path)
+    db['pages'].insert_one({'_id': 'home', 'slug': 'home'})
+    db['pages'].insert_one({'_id': 'about', 'slug': 'about'})
+    db['meta'].insert_one({'brand': 'FlaskPress'})
+    db['pages'].delete_many({'slug': 'about'})
+    if hasattr(db, 'close'):
+        db.close()
+    reopened = open_backend(backend, path)
+    assert [page['slug'] for page in reopened['pages'].find()] == ['home']
+    if hasattr(reopened, 'close'):
+        reopened.close()
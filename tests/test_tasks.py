@@ -0,0 +1,19 @@
+# test_tasks.py
+# worker threads run enqueued tasks and stop at exit
+import atexit
+
+from tasks import TaskQueue
+
+
+def test_workers_run_tasks_and_stop(make_app, monkeypatch):
+    registered = []
+    monkeypatch.setattr(atexit, 'register', registered.append)
+    queue = TaskQueue(make_app(), workers=2)
+    done = []
+    queue.register('note', lambda key: done.append(key))
+    queue.enqueue('note', 'a')
+    assert queue.join(5)
+    assert done == ['a']
+    assert queue.stop in registered
+    queue.stop()
+    assert not any(thread.is_alive() for thread in queue._threads)
@@ -0,0 +1,41 @@
+# test_themes.py
+# page templates: only the offered ones resolve, partials never render a page
+import pytest
+
+from themes import PAGE_TEMPLATES, theme_template_path
+
+
+def test_partials_are_not_page_templates(make_app):
+    themes = make_app().extensions['fpress'].themes
+    for partial in ('layout', 'navbar', 'footer', 'search', 'sidebar-right', '../page'):
+        assert themes.resolve('default', partial) == theme_template_path('default', 'page')
+
+@pytest.mark.parametrize('name', [name for name, label in PAGE_TEMPLATES])
+def test_every_offered_template_exists(make_app, name):
+    themes = make_app().extensions['fpress'].themes
+    assert themes.resolve('default', name) == theme_template_path('default', name)
+
+def test_one_column_hides_sidebars(make_app, admin_client):
+    app = make_app()
+    db = app.extensions['fpress'].db
+    db.pages.insert_one({'slug': 'side', 'title': 'Side', 'content': '<p>SIDEBAR TEXT</p>',
+                         'is_published': True, 'owner': 'admin'})
+    for template, shown in (('sidebar_left_right', True), ('one_column', False), ('sidebar_left', True),
+                            ('sidebar_right', False)):
+        slug = 'with-' + template
+        db.pages.insert_one({'slug': slug, 'title': slug, 'content': '<p>body</p>', 'is_published': True,
+                             'owner': 'admin', 'template': template, 'sidebar_left': 'side'})
+        body = app.test_client().get('/' + slug).get_data(as_text=True)
+        assert ('SIDEBAR TEXT' in body) == shown, template
+
+def test_page_edit_rejects_unknown_template(make_app, admin_client):
+    app = make_app()
+    client = admin_client(app)
+    response = client.post('/page/create', data={'title': 'Sneaky', 'slug': 'sneaky', 'content': 'x',
+                                                 'template': 'navbar', 'is_published': 'on'})
+    assert response.status_code == 200
+    assert b'Unknown page template' in response.data
+    assert app.extensions['fpress'].db.pages.find_one({'slug': 'sneaky'}) is None
+    client.post('/page/create', data={'title': 'Fine', 'slug': 'fine', 'content': 'x',
+                                      'template': 'one_column', 'is_published': 'on'})
+    assert app.extensions['fpress'].db.pages.find_one({'slug': 'fine'})['template'] == 'one_column'
@@ -0,0 +1,91 @@
+# test_uploads.py
+# streaming and resumable uploads: limits, quota, resume and content sniffing
+import io
+
+import pytest
+
+import uploads
+
+UPLOAD_ID = 'test-upload-0001'
+
+
+def send_chunk(client, data, offset, total, filename='notes.txt', upload_id=UPLOAD_ID):
+    return client.post('/_upload', data={'file': (io.BytesIO(data), filename), 'dzuuid': upload_id,
+                                         'dzchunkbyteoffset': str(offset), 'dztotalfilesize': str(total)})
+
+
+def test_interrupted_upload_resumes_from_status(make_app, admin_client):
+    app = make_app()
+    client = admin_client(app)
+    content = b'first half, ' + b'second half'
+    response = send_chunk(client, content[:12], 0, len(content))
+    assert response.get_json() == {'received': 12, 'complete': False}
+
+    # the client lost track, the server says where to continue
+    received = client.get('/_upload/status?dzuuid=' + UPLOAD_ID).get_json()['received']
+    assert received == 12
+    response = send_chunk(client, content[received:], received, len(content))
+    result = response.get_json()
+    assert result['complete'] is True
+    stored = app.extensions['fpress'].db.files.find_one({'_id': result['file_id']})
+    assert stored['size'] == len(content)
+    assert client.get('/_upload/status?dzuuid=' + UPLOAD_ID).get_json()['received'] == 0
+
+def test_out_of_sequence_chunk_is_refused(make_app, admin_client):
+    client = admin_client(make_app())
+    send_chunk(client, b'0123456789', 0, 30)
+    response = send_chunk(client, b'0123456789', 20, 30)
+    assert response.status_code == 409
+    assert response.get_json()['received'] == 10
+
+def test_oversized_upload_is_refused(make_app, admin_client):
+    client = admin_client(make_app(MAX_UPLOAD_SIZE=100))
+    response = send_chunk(client, b'x' * 50, 0, 500)
+    assert response.status_code == 413
+    assert client.get('/_upload/status?dzuuid=' + UPLOAD_ID).get_json()['received'] == 0
+
+def test_chunk_larger_than_chunk_size_is_refused(make_app, admin_client):
+    client = admin_client(make_app(MAX_UPLOAD_SIZE=0, UPLOAD_CHUNK_SIZE=1024))
+    size = 200 * 1024
+    assert send_chunk(client, b'x' * size, 0, size).status_code == 413
+
+def test_whole_file_is_not_bound_by_chunk_size(make_app, admin_client):
+    app = make_app(MAX_UPLOAD_SIZE=0, UPLOAD_CHUNK_SIZE=1024)
+    client = admin_client(app)
+    response = client.post('/_upload', data={'file': (io.BytesIO(b'x' * 200 * 1024), 'big.txt')})
+    assert response.status_code == 302
+    assert '/file_edit/' in response.headers['Location']
+    assert app.extensions['fpress'].db.files.find_one({'title': 'big.txt'})['size'] == 200 * 1024
+
+def test_quota_is_enforced(make_app, admin_client):
+    app = make_app(USER_UPLOAD_QUOTA=100)
+    app.extensions['fpress'].db.files.insert_one({'title': 'old.txt', 'owner': 'admin', 'size': 80})
+    client = admin_client(app)
+    assert send_chunk(client, b'x' * 10, 0, 30).status_code == 413
+    assert send_chunk(client, b'x' * 10, 0, 20).get_json()['complete'] is False
+
+def test_quota_is_summed_once_per_upload(make_app, admin_client, monkeypatch):
+    import app as appmod
+    app = make_app(USER_UPLOAD_QUOTA=100)
+    client = admin_client(app)
+    calls = []
+    quota = appmod.remaining_upload_quota
+    monkeypatch.setattr(appmod, 'remaining_upload_quota', lambda username: calls.append(username) or quota(username))
+    for offset in (0, 10, 20):
+        result = send_chunk(client, b'x' * 10, offset, 30).get_json()
+    assert result['complete'] is True
+    assert calls == ['admin']
+
+def test_content_must_match_extension(make_app, admin_client):
+    client = admin_client(make_app())
+    response = send_chunk(client, b'just some text', 0, 14, filename='picture.png')
+    assert response.status_code == 415
+    png = b'\x89PNG\r\n\x1a\n' + b'\x00' * 8
+    result = send_chunk(client, png, 0, len(png), filename='picture.png', upload_id='test-upload-0002')
+    assert result.get_json()['complete'] is True
+
+@pytest.mark.parametrize('head, content_type', [
+    (b'\x89PNG\r\n\x1a\n....', 'image/png'), (b'\xff\xd8\xff\xe0', 'image/jpeg'), (b'GIF89a', 'image/gif'),
+    (b'%PDF-1.7', 'application/pdf'), (b'plain words', 'text/plain'), (b'\x00\x01binary', None)])
+def test_sniff_content_type(head, content_type):
+    assert uploads.sniff_content_type(head) == content_type